@@ -0,0 +1,80 @@
+'''Compare the per variable and the bucketed averaging of the gradients
+
+Builds `ntowers` towers of random gradients for `nvars` variables of
+various shapes and reports, for `utils.average_gradients` with and
+without buckets, the number of ops it adds to the graph, the time of a
+step and whether the averaged gradients are identical, e.g.:
+
+    python benchmarks/average_gradients.py --ntowers 4 --nvars 300
+'''
+from time import time
+
+import gflags
+import numpy as np
+import tensorflow as tf
+
+from main_loop_tf.utils import average_gradients
+
+gflags.DEFINE_integer('ntowers', 4, 'The number of towers')
+gflags.DEFINE_integer('nvars', 300, 'The number of variables')
+gflags.DEFINE_integer('bucket_size_mb', 32, 'The size of the buckets')
+gflags.DEFINE_integer('steps', 50, 'The number of timed steps')
+gflags.DEFINE_integer('warmup', 5, 'The number of steps before timing')
+
+
+def random_shapes(nvars, rng):
+    '''Return the shapes of conv kernels, biases and BN params'''
+    shapes = []
+    for i in range(nvars):
+        c = int(rng.choice([16, 32, 64, 128]))
+        shapes.append([3, 3, c, c] if i % 3 == 0 else [c])
+    return shapes
+
+
+def benchmark(bucket_size_mb, cfg):
+    rng = np.random.RandomState(1609)
+    shapes = random_shapes(cfg.nvars, rng)
+    with tf.Graph().as_default() as graph:
+        variables = [tf.Variable(tf.zeros(s), name='var%d' % i)
+                     for i, s in enumerate(shapes)]
+        tower_grads = []
+        for t in range(cfg.ntowers):
+            with tf.name_scope('tower%d' % t):
+                tower_grads.append([(tf.random_normal(s, seed=t * 1000 + i),
+                                     v) for i, (s, v) in enumerate(
+                                         zip(shapes, variables))])
+        nops = len(graph.get_operations())
+        avg = average_gradients(tower_grads, bucket_size_mb=bucket_size_mb)
+        nops = len(graph.get_operations()) - nops
+        # Fetch the inputs as well, to compare the averages on the same
+        # random gradients
+        fetches = [[g for g, _ in grads] for grads in tower_grads]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            times = []
+            for step in range(cfg.warmup + cfg.steps):
+                start = time()
+                sess.run([g for g, _ in avg])
+                if step >= cfg.warmup:
+                    times.append(time() - start)
+            towers, out = sess.run([fetches, [g for g, _ in avg]])
+    expected = [np.mean([t[i] for t in towers], axis=0)
+                for i in range(len(shapes))]
+    max_err = max(np.abs(o - e).max() for o, e in zip(out, expected))
+    return nops, np.array(times), max_err
+
+
+def main(argv):
+    cfg = gflags.FLAGS
+    cfg(argv)
+    for name, bucket_size_mb in [('per variable', 0),
+                                 ('bucketed', cfg.bucket_size_mb)]:
+        nops, times, max_err = benchmark(bucket_size_mb, cfg)
+        print('{:12s}: {:5d} ops, {:.4f}s/step (median {:.4f}s), max abs '
+              'err vs numpy {:.2e}'.format(name, nops, times.mean(),
+                                           np.median(times), max_err))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
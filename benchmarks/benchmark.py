@@ -0,0 +1,118 @@
+'''Throughput of the main loop on synthetic data
+
+Runs a sweep of short trainings of a small convolutional model on the
+synthetic dataset (see `main_loop_tf/synthetic.py`), one process per
+configuration of the product of the `sweep_*` flags, and reports the
+steps/sec and the pixels/sec of each as JSON, e.g.:
+
+    python benchmarks/benchmark.py --sweep_batch_size "2 8" \
+        --sweep_devices "/cpu:0 /cpu:0,/cpu:1" --benchmark_json out.json
+
+The other flags are passed to every trial, e.g., `--synthetic_shape`,
+`--max_steps` or `--prefetch_depth`. Comparing the JSON of two versions
+of TensorFlow or of the loop shows the throughput regressions.
+'''
+from itertools import product
+import json
+import os
+import sys
+
+import gflags
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from main_loop_tf.main import run
+from main_loop_tf.trials import run_trial, step_secs
+
+gflags.DEFINE_spaceseplist('sweep_batch_size', '2', 'The batch sizes')
+gflags.DEFINE_spaceseplist('sweep_crop_size', 'none', 'The crop sizes, as '
+                           'height,width, or none')
+gflags.DEFINE_spaceseplist('sweep_seq_length', '0', 'The sequence lengths')
+gflags.DEFINE_spaceseplist('sweep_devices', '/cpu:0', 'The lists of devices '
+                           'of the towers, comma separated')
+gflags.DEFINE_spaceseplist('sweep_train_summary_freq', '10', 'The '
+                           'frequencies of the scalar training summaries')
+gflags.DEFINE_spaceseplist('sweep_input_mode', 'feed_dict', 'The input '
+                           'modes')
+gflags.DEFINE_integer('benchmark_depth', 3, 'The number of convolutions of '
+                      'the benchmark model', lower_bound=1)
+gflags.DEFINE_string('benchmark_json', None, 'The file the results are '
+                     'written to, as JSON')
+gflags.DEFINE_string('benchmark_trial', None, 'Internal: the file the '
+                     'throughput of a trial is written to')
+
+# The flags of each dimension of the sweep
+SWEEP = ['batch_size', 'crop_size', 'seq_length', 'devices',
+         'train_summary_freq', 'input_mode']
+
+
+def build_model(inputs, is_training):
+    '''A few 3x3 convolutions, applied to each frame of the sequences'''
+    cfg = gflags.cfg
+    shape = tf.shape(inputs)
+    net = tf.reshape(inputs, tf.concat([[-1], shape[-3:]], 0))
+    net.set_shape([None, None, None, inputs.get_shape()[-1]])
+    for _ in range(cfg.benchmark_depth):
+        net = slim.conv2d(net, 32, 3)
+    return slim.conv2d(net, cfg.nclasses, 1, activation_fn=None)
+
+
+def train_trial(argv):
+    '''Train for `max_steps` and write the throughput to `benchmark_trial`'''
+    run(argv, build_model)
+    cfg = gflags.cfg
+    throughput = dict(cfg.train_throughput)
+    h, w = cfg.crop_size or cfg.synthetic_shape[:2]
+    throughput['pixels_per_step'] = (cfg.batch_size * cfg.num_splits *
+                                     h * w * max(1, cfg.seq_length or 0))
+    with open(cfg.benchmark_trial, 'w') as f:
+        json.dump(throughput, f)
+
+
+def trial_args(values):
+    '''Return the flags of a configuration of the sweep'''
+    args = []
+    for name, value in zip(SWEEP, values):
+        if name == 'crop_size' and value == 'none':
+            continue
+        args += ['--' + name, value]
+    return args
+
+
+def main(argv):
+    cfg = gflags.FLAGS
+    cfg(argv)
+    if cfg.benchmark_trial:
+        return train_trial(argv)
+
+    results = []
+    for values in product(*[getattr(cfg, 'sweep_' + s) for s in SWEEP]):
+        cmd = ([sys.executable, os.path.abspath(__file__)] + argv[1:] +
+               ['--dataset', 'synthetic'] + trial_args(values))
+        config = dict(zip(SWEEP, values))
+        throughput = run_trial(cmd, 'benchmark_trial')
+        if throughput is None:
+            tf.logging.error('Trial failed: {}'.format(config))
+            continue
+        steps_per_sec = 1. / max(step_secs(throughput), 1e-8)
+        results.append({
+            'config': config,
+            'steps_per_sec': steps_per_sec,
+            'pixels_per_sec': steps_per_sec * throughput['pixels_per_step'],
+            'epoch': throughput})
+        tf.logging.info('{}: {:.2f} steps/s, {:.3g} pixels/s'.format(
+            config, steps_per_sec, results[-1]['pixels_per_sec']))
+
+    report = {'tensorflow': tf.__version__,
+              'numpy': np.__version__,
+              'results': results}
+    if cfg.benchmark_json:
+        with open(cfg.benchmark_json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv)
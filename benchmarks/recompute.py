@@ -0,0 +1,87 @@
+'''Measure the memory saved and the time added by `recompute.gradients`
+
+Trains a deep convolutional model on a batch of sequences with the
+gradients of `tf.gradients` and of `recompute.gradients` (with the
+automatically chosen checkpoints) and reports the peak memory of the step,
+from its RunMetadata, and the step time, e.g.:
+
+    python benchmarks/recompute.py --seq_length 16 --size 128
+'''
+from time import time
+
+import gflags
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from main_loop_tf import recompute
+
+gflags.DEFINE_integer('batch_size', 2, 'The batch size')
+gflags.DEFINE_integer('seq_length', 8, 'The length of the sequences')
+gflags.DEFINE_integer('size', 128, 'The size of the (square) frames')
+gflags.DEFINE_integer('depth', 12, 'The number of convolutions')
+gflags.DEFINE_integer('steps', 10, 'The number of timed steps')
+gflags.DEFINE_integer('warmup', 2, 'The number of steps before timing')
+
+
+def build_model(inputs, depth):
+    shape = tf.shape(inputs)
+    net = tf.reshape(inputs, tf.concat([[-1], shape[2:]], 0))
+    for _ in range(depth):
+        net = slim.conv2d(net, 32, 3)
+    return tf.reduce_mean(tf.square(net))
+
+
+def peak_bytes(run_metadata):
+    '''Return the max peak memory of the allocators used by a step'''
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peak = max(peak, mem.peak_bytes)
+    return peak
+
+
+def benchmark(checkpoints, cfg):
+    with tf.Graph().as_default():
+        inputs = tf.random_uniform([cfg.batch_size, cfg.seq_length, cfg.size,
+                                    cfg.size, 3])
+        loss = build_model(inputs, cfg.depth)
+        optimizer = tf.train.AdamOptimizer()
+        if checkpoints:
+            grads = recompute.compute_gradients(loss, checkpoints=checkpoints)
+        else:
+            grads = optimizer.compute_gradients(loss)
+        train_op = optimizer.apply_gradients(grads)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            times = []
+            for step in range(cfg.warmup + cfg.steps):
+                start = time()
+                sess.run(train_op)
+                if step >= cfg.warmup:
+                    times.append(time() - start)
+            run_metadata = tf.RunMetadata()
+            sess.run(train_op, options=tf.RunOptions(
+                trace_level=tf.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata)
+    return peak_bytes(run_metadata), np.mean(times)
+
+
+def main(argv):
+    cfg = gflags.FLAGS
+    cfg(argv)
+    base_peak, base_time = benchmark(None, cfg)
+    peak, step_time = benchmark('auto', cfg)
+    print('tf.gradients:        peak {:.1f} MB, {:.3f}s/step'.format(
+        base_peak / 1024. ** 2, base_time))
+    print('recompute.gradients: peak {:.1f} MB, {:.3f}s/step'.format(
+        peak / 1024. ** 2, step_time))
+    print('Peak memory {:+.1%}, step time {:+.1%}'.format(
+        peak / float(max(base_peak, 1)) - 1,
+        step_time / max(base_time, 1e-8) - 1))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -0,0 +1,95 @@
+'''Measure the overhead of the loop around `sess.run` on a trivial model
+
+Trains a single 1x1 convolution (as the model of `run_example.py`) on a
+tiny batch, so that the step time is dominated by the loop rather than by
+the model, with the loop of `main_loop` before and after the host side
+step accounting:
+
+- `eval`: reads `global_step` with an extra `Session.run` and formats the
+  description and the postfix of the progress bar at every step
+- `host`: counts the steps on the host and refreshes the progress bar at
+  most every `progress_secs` seconds (`utils.ThrottledProgress`)
+
+and reports the time per step of each, e.g.:
+
+    python benchmarks/step_overhead.py --steps 2000
+'''
+from time import time
+
+import gflags
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+from tqdm import tqdm
+
+from main_loop_tf.utils import ThrottledProgress
+
+gflags.DEFINE_integer('size', 8, 'The size of the (square) inputs')
+gflags.DEFINE_integer('steps', 1000, 'The number of timed steps')
+gflags.DEFINE_integer('warmup', 50, 'The number of steps before timing')
+gflags.DEFINE_float('progress_secs', 1., 'The refresh interval of the '
+                    'progress bar in host mode')
+
+
+def build_model(size):
+    inputs = tf.placeholder(tf.float32, [1, size, size, 3], name='inputs')
+    global_step = tf.Variable(0, trainable=False, name='global_step',
+                              dtype='int32')
+    loss = tf.reduce_mean(tf.square(slim.conv2d(inputs, 3, 1)))
+    train_op = tf.train.GradientDescentOptimizer(0.01).minimize(
+        loss, global_step=global_step)
+    return inputs, global_step, loss, train_op
+
+
+def benchmark(mode, cfg):
+    x = np.random.rand(1, cfg.size, cfg.size, 3).astype('float32')
+    with tf.Graph().as_default():
+        inputs, global_step, loss, train_op = build_model(cfg.size)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            nsteps = cfg.warmup + cfg.steps
+            cum_iter = global_step.eval(sess)
+            loss_value = 0
+            if mode == 'eval':
+                pbar = tqdm(total=nsteps)
+            else:
+                pbar = ThrottledProgress(cfg.progress_secs, total=nsteps)
+
+            def describe():
+                return ('({:3d}) Ep {:d}'.format(cum_iter, 1),
+                        {'loss': '{:.3f}'.format(loss_value)})
+
+            for step in range(nsteps):
+                if step == cfg.warmup:
+                    start = time()
+                if mode == 'eval':
+                    cum_iter = global_step.eval(sess)
+                loss_value, _ = sess.run([loss, train_op],
+                                         feed_dict={inputs: x})
+                if mode == 'eval':
+                    desc, postfix = describe()
+                    pbar.set_description(desc)
+                    pbar.set_postfix(postfix)
+                    pbar.update(1)
+                else:
+                    cum_iter += 1
+                    pbar.update(describe)
+            elapsed = time() - start
+            pbar.close()
+    return elapsed / cfg.steps
+
+
+def main(argv):
+    cfg = gflags.FLAGS
+    cfg(argv)
+    times = {mode: benchmark(mode, cfg) for mode in ['eval', 'host']}
+    for mode in ['eval', 'host']:
+        print('{:4s}: {:.3f} ms/step'.format(mode, times[mode] * 1000))
+    print('Overhead saved: {:.3f} ms/step ({:.1%})'.format(
+        (times['eval'] - times['host']) * 1000,
+        1 - times['host'] / times['eval']))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -0,0 +1,94 @@
+'''Compare the dynamic and the static split of the batches among towers
+
+The dynamic split feeds the size of the chunk of each tower, as
+`main_loop_tf` does by default, so the towers have an unknown batch
+dimension. The static split (`--static_tower_split`) pads the batches to a
+fixed size and masks the padding out of the loss.
+
+Both configurations build the training graph of `main_loop_tf` (i.e.,
+`build_graph`, with its masks and `average_gradients`) with a small
+convolutional model on `num_cpu_towers` CPU towers, and feed it the
+batches of the synthetic dataset prepared by `prepare_batch` (padded by
+`pad_batch` in the static split), alternating full and short batches,
+e.g.:
+
+    python benchmarks/tower_split.py --num_cpu_towers 4 --batch_size 4
+
+The other flags are passed to `main_loop_tf`, e.g., `--synthetic_shape`.
+'''
+from copy import deepcopy
+from time import time
+
+import gflags
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from main_loop_tf import main as loop
+from main_loop_tf.cpu_layout import configure_cpus
+
+gflags.DEFINE_integer('num_cpu_towers', 4, 'The number of CPU towers')
+gflags.DEFINE_integer('short_every', 4, 'Every how many steps a short '
+                      'batch (i.e., with one sample less) is fed')
+gflags.DEFINE_integer('timed_steps', 50, 'The number of timed steps')
+gflags.DEFINE_integer('warmup_steps', 5, 'The number of steps before '
+                      'timing')
+
+
+def build_model(inputs, is_training):
+    cfg = gflags.cfg
+    net = slim.conv2d(inputs, 32, 3)
+    net = slim.conv2d(net, 32, 3)
+    return slim.conv2d(net, cfg.nclasses, 1, activation_fn=None)
+
+
+def benchmark(argv, static, num_cpu_towers):
+    argv = list(argv) + [
+        '--dataset', 'synthetic', '--val_on_sets', '',
+        '--static_tower_split={}'.format(static),
+        '--devices', ','.join('/cpu:%d' % i for i in range(num_cpu_towers))]
+    with tf.Graph().as_default() as graph:
+        built = loop.build_graphs(argv, build_model, graph)
+        cfg = gflags.cfg
+        params = deepcopy(cfg.dataset_params)
+        params['batch_size'] *= cfg.num_splits
+        train = cfg.Dataset(which_set='train', return_list=False, **params)
+        npixels = np.prod(train.data_shape[:2])
+        minibatch = train.next()
+        short = {'data': minibatch['data'][:-1],
+                 'labels': minibatch['labels'][:-1]}
+        batches = [loop.prepare_batch(m, npixels)
+                   for m in (minibatch, short)]
+        train.finish()
+
+        placeholders = built['placeholders']
+        train_outs = built['train_outs'][:2]
+        feeds = [{p: v for p, v in zip(placeholders, list(b) + [1.])}
+                 for b in batches]
+        tf_config = tf.ConfigProto(allow_soft_placement=True)
+        configure_cpus(tf_config)
+        with tf.Session(config=tf_config) as sess:
+            sess.run(built['init_op'])
+            times = []
+            for step in range(cfg.warmup_steps + cfg.timed_steps):
+                is_short = cfg.short_every and step % cfg.short_every == 0
+                start = time()
+                sess.run(train_outs, feed_dict=feeds[int(bool(is_short))])
+                if step >= cfg.warmup_steps:
+                    times.append(time() - start)
+    return np.array(times)
+
+
+def main(argv):
+    cfg = gflags.FLAGS
+    cfg(argv)
+    for static in (False, True):
+        times = benchmark(argv, static, cfg.num_cpu_towers)
+        print('{:8s} split: {:.4f}s/step (median {:.4f}s, p90 {:.4f}s)'
+              .format('static' if static else 'dynamic', times.mean(),
+                      np.median(times), np.percentile(times, 90)))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
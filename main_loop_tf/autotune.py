@@ -0,0 +1,165 @@
+'''Search the batch size and thread counts with the best throughput
+
+Each candidate configuration is trained for `autotune_steps` steps in its
+own process (with the real model and dataset, no validation and a
+temporary checkpoints directory) and scored by its samples/sec, from the
+median step time. The knobs are tuned one after the other: the batch size
+(doubled while the throughput improves and the process fits
+`autotune_memory_mb`), the loader threads and the TensorFlow thread
+pools. The best configuration is cached per experiment (`cfg.hash`) and
+host, so that the next runs skip the search.
+'''
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+
+import gflags
+import tensorflow as tf
+
+from memory import host_memory_bytes, peak_rss_bytes
+from trials import run_trial, step_secs
+
+# The tuned flags. They do not change the hash of the experiment
+TUNED_FLAGS = ['batch_size', 'use_threads', 'nthreads', 'intra_op_threads',
+               'inter_op_threads']
+# The minimum relative improvement of the throughput to keep doubling the
+# batch size
+MIN_GAIN = 0.05
+
+
+def host_fingerprint():
+    '''Return a string that identifies the hardware and software of the
+    host'''
+    cpu = ''
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu = line.split(':', 1)[1].strip()
+                    break
+    except IOError:
+        pass
+    return '|'.join([platform.node(), cpu,
+                     str(multiprocessing.cpu_count()),
+                     str(host_memory_bytes()), tf.__version__])
+
+
+def cache_path():
+    cfg = gflags.cfg
+    h = hashlib.md5()
+    h.update(cfg.hash)
+    h.update(host_fingerprint())
+    h.update(repr(cfg.devices))
+    return os.path.join(cfg.autotune_cache_dir, h.hexdigest() + '.json')
+
+
+def save_trial():
+    '''Write the throughput and the memory of this (trial) process'''
+    cfg = gflags.cfg
+    throughput = getattr(cfg, 'train_throughput', None)
+    if not throughput:
+        return
+    with open(cfg.autotune_trial, 'w') as f:
+        json.dump({'samples_per_sec': (cfg.batch_size * cfg.num_splits /
+                                       max(step_secs(throughput), 1e-8)),
+                   'peak_rss_bytes': peak_rss_bytes()}, f)
+
+
+def _trial(argv, values):
+    '''Train with `values` in a new process, return its result or None'''
+    cfg = gflags.cfg
+    cmd = ([sys.executable] + list(argv) +
+           ['--max_steps', str(cfg.autotune_steps)] + tuned_args(values))
+    result = run_trial(cmd, 'autotune_trial', quiet=True)
+
+    memory_limit = (cfg.autotune_memory_mb * 1024 ** 2 or
+                    0.9 * host_memory_bytes())
+    if result is not None and result['peak_rss_bytes'] > memory_limit:
+        tf.logging.info('Autotune {}: over the memory limit'.format(values))
+        result = None
+    elif result is None:
+        tf.logging.info('Autotune {}: failed'.format(values))
+    else:
+        tf.logging.info('Autotune {}: {:.2f} samples/s, {:.0f} MB'.format(
+            values, result['samples_per_sec'],
+            result['peak_rss_bytes'] / 1024. ** 2))
+    return result
+
+
+def search(argv):
+    '''Return the best values of the tuned flags and their throughput'''
+    cfg = gflags.cfg
+    ncpus = multiprocessing.cpu_count()
+    best = {k: getattr(cfg, k) for k in TUNED_FLAGS}
+    trials = []
+
+    def score(values):
+        result = _trial(argv, values)
+        trials.append({'values': values, 'result': result})
+        return result['samples_per_sec'] if result is not None else -1
+
+    best_score = score(best)
+    if best_score < 0:
+        raise RuntimeError('The autotune trial with the configured values '
+                           'failed, run without --autotune to see why')
+
+    # 1) Batch size: double it while the throughput improves
+    while True:
+        values = dict(best, batch_size=best['batch_size'] * 2)
+        s = score(values)
+        if s < best_score * (1 + MIN_GAIN):
+            break
+        best, best_score = values, s
+
+    # 2) Loader threads, 3) TF thread pools
+    thread_counts = sorted(set([max(1, ncpus // 4), max(1, ncpus // 2),
+                                ncpus]))
+    candidates = ([{'use_threads': False}] +
+                  [{'use_threads': True, 'nthreads': n}
+                   for n in thread_counts],
+                  [{'intra_op_threads': n, 'inter_op_threads': m}
+                   for n in [0] + thread_counts for m in [0, 2]])
+    for group in candidates:
+        for c in group:
+            values = dict(best, **c)
+            if values == best:
+                continue
+            s = score(values)
+            if s > best_score:
+                best, best_score = values, s
+    return best, best_score, trials
+
+
+def autotune(argv):
+    '''Return the tuned flags, from the cache or from a new search'''
+    cfg = gflags.cfg
+    path = cache_path()
+    if os.path.exists(path):
+        with open(path) as f:
+            cached = json.load(f)
+        tf.logging.info('Autotuned values (cached in {}): {}'.format(
+            path, cached['values']))
+        return cached['values']
+
+    tf.logging.info('Autotuning {} ...'.format(', '.join(TUNED_FLAGS)))
+    best, best_score, trials = search(argv)
+    if not os.path.exists(cfg.autotune_cache_dir):
+        os.makedirs(cfg.autotune_cache_dir)
+    with open(path, 'w') as f:
+        json.dump({'values': best,
+                   'samples_per_sec': best_score,
+                   'host': host_fingerprint(),
+                   'hash': cfg.hash,
+                   'trials': trials}, f, indent=2, sort_keys=True)
+    tf.logging.info('Autotuned values: {} ({:.2f} samples/s, {} trials, '
+                    'cached in {})'.format(best, best_score, len(trials),
+                                           path))
+    return best
+
+
+def tuned_args(values):
+    '''Return the command line flags that set the tuned `values`'''
+    return ['--{}={}'.format(k, v) for k, v in sorted(values.iteritems())]
@@ -5,7 +5,24 @@ from main_loop_tf import gflags_ext
 # ============ Dataset params
 gflags.DEFINE_integer('batch_size', 1, 'The batch size', lower_bound=0)
 gflags_ext.DEFINE_intlist('crop_size', None, 'The training crop-size')
+gflags.DEFINE_bool('graph_augmentation', False, 'If True the training '
+                   'batches are loaded at full size and the crop (and '
+                   'random_flip and scale_range) are applied in the graph, '
+                   'rather than by the loader')
+gflags.DEFINE_bool('random_flip', False, 'If True the training samples are '
+                   'flipped horizontally with probability 0.5. Requires '
+                   'graph_augmentation')
+gflags_ext.DEFINE_floatlist('scale_range', None, 'The [min, max] range of '
+                            'the random scale of the training samples. '
+                            'Requires graph_augmentation and crop_size')
 gflags.DEFINE_string('dataset', None, 'The dataset')
+gflags_ext.DEFINE_intlist('synthetic_shape', [128, 128, 3], 'The (height, '
+                          'width, channels) of the frames of the synthetic '
+                          'dataset (i.e., with --dataset synthetic)')
+gflags.DEFINE_integer('synthetic_nclasses', 11, 'The number of classes of '
+                      'the synthetic dataset', lower_bound=2)
+gflags.DEFINE_integer('synthetic_nbatches', 100, 'The number of batches per '
+                      'epoch of the synthetic dataset', lower_bound=1)
 gflags.DEFINE_string('of', None, 'Whether to have the opt flow as an input')
 gflags.DEFINE_integer('seq_length', None, 'The length of the sequence, in '
                       'case the input is a video', lower_bound=0)
@@ -35,3 +52,56 @@ gflags.DEFINE_integer('val_overlap', None, 'The overlap (in number of frames) '
                       'of consecutive sequences of the same video for '
                       'validation. If negative not all the frames will be '
                       'returned')
+gflags.DEFINE_integer('prefetch_depth', 2, 'The number of training batches '
+                      'to prepare in advance in a background thread, while '
+                      'the current one is processed. If zero the batches are '
+                      'loaded synchronously', lower_bound=0)
+gflags.DEFINE_enum('input_mode', 'feed_dict', ['feed_dict', 'queue'], 'How '
+                   'to provide the training batches to the graph. With '
+                   '`feed_dict` the batches are fed to the placeholders at '
+                   'each step, with `queue` a feeder thread enqueues them in '
+                   'a TF queue of `prefetch_depth` elements that the graph '
+                   'dequeues directly')
+gflags.DEFINE_integer('nprocs', 0, 'The number of worker processes that '
+                      'load the batches. If zero the batches are loaded by '
+                      'the main process (and its threads, if use_threads is '
+                      'True)', lower_bound=0)
+gflags.DEFINE_bool('ordered_batches', True, 'If True the worker processes '
+                   'return the training batches in the same order as the '
+                   'dataset would, otherwise as soon as they are ready')
+gflags.DEFINE_string('shards_dir', None, 'If set, the batches are read from '
+                     'the memory-mapped shards of the dataset in this '
+                     'directory rather than from the original files. The '
+                     'shards can be created with `python -m '
+                     'main_loop_tf.shards --dataset <dataset> --shards_dir '
+                     '<dir>`')
+gflags.DEFINE_bool('compress_shards', False, 'Whether to compress the '
+                   'shards when converting a dataset')
+gflags.DEFINE_integer('val_cache_mb', 0, 'The maximum amount of memory (in '
+                      'MB) used to cache the decoded validation batches, '
+                      'that are otherwise loaded again at each validation',
+                      lower_bound=0)
+gflags.DEFINE_string('val_cache_spill_dir', None, 'If set, the validation '
+                     'batches that do not fit in val_cache_mb are cached in '
+                     'memory-mapped files in this directory')
+gflags.DEFINE_bool('uint8_inputs', False, 'If True the images and labels '
+                   'are fed to the graph as uint8 (or uint16) and the images '
+                   'are normalized in the graph, rather than on the host, '
+                   'according to remove_mean, divide_by_std, '
+                   'remove_per_img_mean and divide_by_per_img_std')
+gflags.DEFINE_integer('frame_cache_mb', 0, 'The maximum amount of memory (in '
+                      'MB) used to cache the loaded frames, so that the '
+                      'frames shared by overlapping sequences are loaded '
+                      'once, along with their optical flow if read from '
+                      'flow_store_dir. Not supported with nprocs. If zero '
+                      'the frames are not cached',
+                      lower_bound=0)
+gflags.DEFINE_string('flow_store_dir', None, 'If set, the optical flow is '
+                     'read from the flow precomputed in this directory rather '
+                     'than computed by the loader. The flow can be '
+                     'precomputed with `python -m main_loop_tf.flow_store '
+                     '--dataset <dataset> --of <method> --flow_store_dir '
+                     '<dir>`')
+gflags.DEFINE_string('stats_cache_dir', './dataset_stats', 'The directory '
+                     'where the statistics of the datasets (class '
+                     'frequencies, mean and std) are cached once computed')
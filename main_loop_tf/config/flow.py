@@ -12,6 +12,9 @@ gflags.DEFINE_integer('min_epochs', 1, 'The minimum number of epochs '
                       'before early stopping is possible', lower_bound=1)
 gflags.DEFINE_integer('max_epochs', 100, 'The maximum number of epochs',
                       lower_bound=1)
+gflags.DEFINE_integer('max_steps', 0, 'The maximum number of training '
+                      'steps. If zero only max_epochs limits the training',
+                      lower_bound=0)
 gflags.DEFINE_integer('patience', 100, 'The number of validation with no '
                       'improvement the model will wait before early stopping',
                       lower_bound=1)
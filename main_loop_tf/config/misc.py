@@ -7,6 +7,61 @@ gflags.DEFINE_integer('checkpoints_to_keep', 2, 'The number of checkpoints '
 gflags.DEFINE_string('checkpoints_dir', './checkpoints', 'The path where '
                      'the model checkpoints are stored')
 gflags.DEFINE_list('devices', ['/cpu:0'], 'A list of devices to use')
+gflags.DEFINE_integer('intra_op_threads', 0, 'The number of threads used '
+                      'by each op. If zero TensorFlow picks it',
+                      lower_bound=0)
+gflags.DEFINE_integer('inter_op_threads', 0, 'The number of ops run in '
+                      'parallel. If zero TensorFlow picks it', lower_bound=0)
+gflags.DEFINE_bool('numa_affinity', False, 'If True the CPU devices (e.g., '
+                   '/cpu:0,/cpu:1) are bound round robin to the NUMA nodes, '
+                   'with their threads on the cores of the node, and the '
+                   'gradients of the towers of each node are averaged '
+                   'locally before averaging them across the nodes')
+gflags.DEFINE_bool('static_tower_split', False, 'If True each device gets '
+                   'exactly batch_size (val_batch_size) samples, so that the '
+                   'towers have a static shape. The short batches are padded '
+                   'and the padding is masked out of the loss and of the '
+                   'confusion matrix')
+gflags.DEFINE_enum('val_graph', 'separate', ['separate', 'shared'],
+                   'Whether the validation has its own towers (separate) or '
+                   'reuses the training towers (shared), switching them to '
+                   'inference mode with an is_training tensor. With shared, '
+                   'build_model receives is_training as a boolean tensor '
+                   '(e.g., for slim.batch_norm) and the graph is smaller and '
+                   'faster to build')
+gflags.DEFINE_bool('graph_cache', False, 'If True the built graph is '
+                   'exported next to the checkpoints and imported instead '
+                   'of being rebuilt when the experiment is restarted with '
+                   'the same configuration and model source. Ignored in '
+                   'distributed mode')
+gflags.DEFINE_float('progress_secs', 1., 'The minimum number of seconds '
+                    'between two refreshes of the progress bar of the '
+                    'training')
+gflags.DEFINE_bool('memory_report', False, 'If True runs a few traced '
+                   'training steps with batch_size and half of it, reports '
+                   'the peak memory of each device, the largest ops, the '
+                   'memory of the host and the largest batch size that '
+                   'fits memory_budget_mb, saves the report in the '
+                   'checkpoints directory and exits')
+gflags.DEFINE_integer('memory_report_steps', 3, 'The number of steps traced '
+                      'per batch size by memory_report', lower_bound=1)
+gflags.DEFINE_float('memory_budget_mb', 0, 'The memory available to each '
+                    'device for memory_report. 0 for the memory of the host')
+gflags.DEFINE_bool('autotune', False, 'If True the batch size, the loader '
+                   'threads and the TF thread pools are tuned for '
+                   'throughput with short trainings before the training '
+                   '(or read from autotune_cache_dir). The tuned values do '
+                   'not change the hash of the experiment')
+gflags.DEFINE_integer('autotune_steps', 30, 'The number of training steps of '
+                      'each autotune trial', lower_bound=1)
+gflags.DEFINE_float('autotune_memory_mb', 0, 'The maximum memory of the '
+                    'process of an autotune trial. 0 for 90% of the memory '
+                    'of the host')
+gflags.DEFINE_string('autotune_cache_dir', './autotune', 'The directory '
+                     'where the autotuned values are cached, per experiment '
+                     'and host')
+gflags.DEFINE_string('autotune_trial', None, 'Internal: the file an autotune '
+                     'trial writes its throughput to')
 gflags.DEFINE_bool('debug_of', False,
                    'Show rgb and optical flow of each batch in a window ')
 gflags.DEFINE_string('restore_model', 'True', 'It can be the hash of the '
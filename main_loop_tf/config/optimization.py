@@ -3,7 +3,10 @@ from main_loop_tf import gflags_ext
 
 
 # ============ Learning
-# class_balance=None
+gflags.DEFINE_enum('class_balance', None, ['median_freq_cost',
+                                            'rare_freq_cost'],
+                   'If set, the loss of each pixel is weighted according to '
+                   'the frequency of its class in the training set')
 
 # ============ Optimizers
 # Common params for optimizers
@@ -50,6 +53,16 @@ gflags.DEFINE_float('weight_decay', 0, 'The weight decay')
 # gflags.DEFINE_float('dropout', 0, 'The dropout probability')
 
 # Gradient processing
+gflags.DEFINE_enum("recompute", None, ["collection", "auto"], "If set, only "
+                   "some activations (checkpoints) are kept for the backward "
+                   "pass and the others are recomputed, to save memory. The "
+                   "checkpoints are the tensors marked with "
+                   "recompute.checkpoint in build_model (collection) or "
+                   "about sqrt(n) of the n convolutions (auto)")
+gflags.DEFINE_integer("accumulate_steps", 1, "The gradients of this many "
+                      "batches are accumulated and the variables are updated "
+                      "once with their mean, for a larger effective batch "
+                      "size", lower_bound=1)
 gflags.DEFINE_float("max_grad_norm", None, "Clip gradients to this norm.")
 gflags.DEFINE_float("grad_noise_scale", None,
                     "Gradient noise scale {0.01, 0.3, 1.0} ")
@@ -58,3 +71,7 @@ gflags.DEFINE_string("thresh_loss", 0.7,
 gflags.DEFINE_string("grad_noise_decay", None,
                      "Gradient Noise Decay Schedule [neural_gpu]")
 gflags.DEFINE_float("grad_multiplier", None, "Gradient Multipliers")
+gflags.DEFINE_integer("grad_bucket_mb", 32, "The dense gradients of the "
+                      "towers are averaged in flat buckets of at most this "
+                      "size (in MB). If zero they are averaged one by one",
+                      lower_bound=0)
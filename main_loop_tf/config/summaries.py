@@ -24,7 +24,18 @@ gflags.DEFINE_bool('group_summaries', True, 'If True, groups the scalar '
                    'summaries by `layer_sublayer` rather than just by '
                    '`layer`. The total number of summaries remains unchanged')
 gflags.DEFINE_integer('train_summary_freq', 10,
-                      'How frequent save train summaries (in steps)')
+                      'How frequent save the scalar train summaries (in '
+                      'steps)')
+gflags.DEFINE_integer('train_norms_summary_freq', 100,
+                      'How frequent save the norms of the gradients of each '
+                      'variable (in steps). 0 disables them')
+gflags.DEFINE_integer('train_histograms_summary_freq', 1000,
+                      'How frequent save the histograms of the gradients and '
+                      'of the variables (in steps). 0 disables them')
+gflags.DEFINE_integer('trace_every_steps', 0, 'How frequent trace a '
+                      'training step and save its timeline (in Chrome trace '
+                      'format) in the train checkpoints directory (in '
+                      'steps). 0 disables the traces')
 gflags.DEFINE_integer('val_summary_freq', 10,
                       'How frequent save validation summaries (in steps)')
 gflags.DEFINE_bool('summary_per_subset', False,
@@ -0,0 +1,146 @@
+import glob
+import multiprocessing as mp
+import os
+import re
+import subprocess
+
+import gflags
+import tensorflow as tf
+
+
+def parse_cpulist(cpulist):
+    '''Parse a Linux cpu list (e.g., "0-3,8-11") into a list of cores'''
+    cores = []
+    for chunk in cpulist.strip().split(','):
+        if not chunk:
+            continue
+        if '-' in chunk:
+            first, last = chunk.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(chunk))
+    return cores
+
+
+def allowed_cores():
+    '''Return the cores this process can run on'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    # Python 2 has no sched_getaffinity, read the affinity from /proc
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpulist(line.split(':', 1)[1])
+    except IOError:
+        pass
+    return range(mp.cpu_count())
+
+
+def set_affinity(cores):
+    '''Restrict this process and its threads to `cores`
+
+    The threads started afterwards inherit the affinity. Return False if
+    the affinity could not be set.
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        return True
+    # Python 2 has no sched_setaffinity, use taskset (util-linux)
+    cmd = ['taskset', '--all-tasks', '--pid', '--cpu-list',
+           ','.join(str(c) for c in cores), str(os.getpid())]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+
+
+def numa_nodes():
+    '''Return the cores of each NUMA node usable by this process
+
+    Falls back to a single node with all the cores if the NUMA topology is
+    not available (e.g., not on Linux).
+    '''
+    allowed = set(allowed_cores())
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(paths, key=lambda p: int(re.findall(r'node(\d+)',
+                                                           p)[-1])):
+        with open(path) as f:
+            cores = [c for c in parse_cpulist(f.read()) if c in allowed]
+        if cores:
+            nodes.append(cores)
+    return nodes or [sorted(allowed)]
+
+
+def cpu_device_index(device):
+    '''Return the index of a CPU device (e.g., 1 for "/cpu:1") or None'''
+    match = re.search(r'cpu:(\d+)', device, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+def cpu_tower_groups(devices, nnodes):
+    '''Group the CPU towers by the NUMA node of their device
+
+    TensorFlow assigns the CPU devices to the NUMA nodes round robin.
+    Return a list of (device, tower indices) pairs, where device is the
+    device of the first tower of the group, or None if there is a single
+    group or some of the towers are not on CPU.
+    '''
+    idxs = [cpu_device_index(d) for d in devices]
+    if nnodes < 2 or None in idxs:
+        return None
+    groups = {}
+    for tower, idx in enumerate(idxs):
+        groups.setdefault(idx % nnodes, []).append(tower)
+    if len(groups) < 2:
+        return None
+    return [(devices[towers[0]], towers)
+            for _, towers in sorted(groups.items())]
+
+
+def configure_cpus(tf_config):
+    '''Configure the CPU devices and thread pools of a session
+
+    Creates a logical CPU device for each `/cpu:N` in `devices`, so that
+    the CPU towers do not collapse onto a single device, and sets the size
+    of the thread pools. With `numa_affinity` each CPU device is bound to
+    a NUMA node and its intra-op threads to the cores of the node, and the
+    process is restricted to the nodes used by the towers.
+
+    Params
+    ------
+    tf_config:
+        The `tf.ConfigProto` to be configured
+    '''
+    cfg = gflags.cfg
+    idxs = [cpu_device_index(d) for d in cfg.devices]
+    idxs = [i for i in idxs if i is not None]
+    if idxs:
+        tf_config.device_count['CPU'] = max(idxs) + 1
+    if cfg.intra_op_threads:
+        tf_config.intra_op_parallelism_threads = cfg.intra_op_threads
+    if cfg.inter_op_threads:
+        tf_config.inter_op_parallelism_threads = cfg.inter_op_threads
+
+    if not cfg.numa_affinity:
+        return
+    try:
+        tf_config.experimental.use_numa_affinity = True
+    except (AttributeError, ValueError):
+        tf.logging.warning('This version of TensorFlow does not support the '
+                           'NUMA affinity of the devices')
+        return
+    nodes = numa_nodes()
+    used = sorted(set(i % len(nodes) for i in idxs)) or [0]
+    cores = [c for n in used for c in nodes[n]]
+    if not set_affinity(cores):
+        tf.logging.warning('Could not restrict the process to the cores of '
+                           'the NUMA nodes {}'.format(used))
+    if not cfg.intra_op_threads:
+        # One thread per core of each node used
+        tf_config.intra_op_parallelism_threads = max(len(nodes[n])
+                                                     for n in used)
+    tf.logging.info('CPU devices on NUMA nodes {} ({} cores)'.format(
+        used, len(cores)))
@@ -0,0 +1,110 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import gflags
+import tensorflow as tf
+
+
+def cluster_spec():
+    '''Return the ClusterSpec of `ps_hosts` and `worker_hosts`'''
+    cfg = gflags.cfg
+    cluster = {'worker': cfg.worker_hosts}
+    if cfg.ps_hosts:
+        cluster['ps'] = cfg.ps_hosts
+    return tf.train.ClusterSpec(cluster)
+
+
+def free_ports(n):
+    '''Return `n` free TCP ports of localhost'''
+    socks = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        socks.append(s)
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+
+def launch_local_cluster(argv, nworkers, nps):
+    '''Run the experiment on a cluster of processes on localhost
+
+    Starts `nps` parameter servers and `nworkers` workers, each running
+    `argv` with its `job_name` and `task_index`, and waits for the chief
+    (i.e., the first worker). When the chief is done, the parameter
+    servers and the workers still waiting for their peers are terminated.
+
+    Return the exit code of the chief.
+    '''
+    cfg = gflags.cfg
+    ports = free_ports(nps + nworkers)
+    ps_hosts = ['localhost:%d' % p for p in ports[:nps]]
+    worker_hosts = ['localhost:%d' % p for p in ports[nps:]]
+
+    # Make the workers share the checkpoints directory of this run
+    if not os.path.exists(cfg.checkpoints_dir):
+        os.makedirs(cfg.checkpoints_dir)
+    common = ['--ps_hosts', ','.join(ps_hosts),
+              '--worker_hosts', ','.join(worker_hosts),
+              '--restore_model', os.path.basename(cfg.checkpoints_dir),
+              '--local_workers', '0']
+
+    def launch(job_name, task_index):
+        cmd = [sys.executable] + list(argv) + common + [
+            '--job_name', job_name, '--task_index', str(task_index)]
+        return subprocess.Popen(cmd)
+
+    ps = [launch('ps', i) for i in range(nps)]
+    workers = [launch('worker', i) for i in range(nworkers)]
+    tf.logging.info('Local cluster: {} ps, {} workers'.format(nps, nworkers))
+    try:
+        ret = workers[0].wait()
+        # Give the other workers a chance to finish their last step
+        deadline = time.time() + 30
+        for w in workers[1:]:
+            while w.poll() is None and time.time() < deadline:
+                time.sleep(0.5)
+    finally:
+        for p in ps + workers:
+            if p.poll() is None:
+                p.terminate()
+        for p in ps + workers:
+            p.wait()
+    return ret
+
+
+def run_ps(tf_config):
+    '''Serve the variables as the `task_index` parameter server'''
+    cfg = gflags.cfg
+    server = tf.train.Server(cluster_spec(), job_name='ps',
+                             task_index=cfg.task_index, config=tf_config)
+    server.join()
+
+
+def sharded_dataset(Dataset, nshards, index):
+    '''Return a subclass of Dataset that loads one shard of the training set
+
+    The videos (subsets) are split round robin among the shards or, if
+    there are fewer videos than shards, the frames of each video are split
+    in contiguous chunks, so that the sequences are not broken more than
+    needed. The other sets are not sharded.
+    '''
+    def get_names(self):
+        names = Dataset.get_names(self)
+        if self.which_set != 'train':
+            return names
+        subsets = sorted(names)
+        if len(subsets) >= nshards:
+            return {s: names[s] for s in subsets[index::nshards]}
+        ret = {}
+        for s in subsets:
+            fnames = names[s]
+            size = -(-len(fnames) // nshards)  # ceil
+            ret[s] = fnames[index * size:(index + 1) * size]
+        return ret
+
+    return type(Dataset.__name__, (Dataset,), {'get_names': get_names})
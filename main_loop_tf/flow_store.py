@@ -0,0 +1,174 @@
+import json
+import multiprocessing as mp
+import os
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+# The Dataset of the worker processes of `precompute_flow`
+_dataset = None
+
+
+def flow_store_path(store_dir, dataset, which_set, method):
+    '''Return the directory of the flow of a split for a flow method'''
+    return os.path.join(store_dir, dataset, which_set, method)
+
+
+def compute_flow(prev, cur, method):
+    '''Compute the optical flow between two RGB frames
+
+    Return the flow as a uint8 RGB image, where the hue encodes the
+    direction and the value the (normalized) magnitude of the flow.
+    '''
+    prev = cv2.cvtColor(to_uint8(prev), cv2.COLOR_RGB2GRAY)
+    cur = cv2.cvtColor(to_uint8(cur), cv2.COLOR_RGB2GRAY)
+    if method == 'Farn':
+        flow = cv2.calcOpticalFlowFarneback(prev, cur, None, 0.5, 3, 15, 3,
+                                            5, 1.2, 0)
+    elif method == 'TVL1':
+        try:
+            tvl1 = cv2.DualTVL1OpticalFlow_create()
+        except AttributeError:  # OpenCV 2
+            tvl1 = cv2.createOptFlow_DualTVL1()
+        flow = tvl1.calc(prev, cur, None)
+    else:
+        raise NotImplementedError('Unknown optical flow method: ' + method)
+
+    mag, ang = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+    hsv = np.zeros(prev.shape + (3,), dtype='uint8')
+    hsv[..., 0] = ang * 180 / np.pi / 2
+    hsv[..., 1] = 255
+    hsv[..., 2] = cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+
+def to_uint8(img):
+    if img.dtype == np.uint8:
+        return img
+    if img.max() <= 1:
+        img = img * 255
+    return np.clip(img, 0, 255).astype('uint8')
+
+
+def _init_worker(Dataset, which_set, params):
+    global _dataset
+    _dataset = Dataset(which_set=which_set, **params)
+
+
+def _compute_subset_flow(args):
+    subset, fnames, method, path = args
+    flows = None
+    prev = None
+    for i, fname in enumerate(fnames):
+        frame = _dataset.load_sequence([(subset, fname)])['data'][0][..., :3]
+        if flows is None:
+            flows = np.lib.format.open_memmap(
+                os.path.join(path, subset_filename(subset)), mode='w+',
+                dtype='uint8', shape=(len(fnames),) + frame.shape[:2] + (3,))
+        # The first frame of each subset has no motion
+        flows[i] = 0 if prev is None else compute_flow(prev, frame, method)
+        prev = frame
+    if flows is not None:
+        flows.flush()
+    return subset
+
+
+def subset_filename(subset):
+    return subset.replace(os.sep, '_') + '.npy'
+
+
+def precompute_flow(Dataset, dataset_name, which_set, method, store_dir,
+                    nprocs=None):
+    '''Compute the optical flow of each frame of a split and store it
+
+    The flow of each frame w.r.t. the previous frame of its subset (i.e.,
+    video) is computed once, in `nprocs` processes, and stored as uint8 RGB
+    images in one memory-mappable file per subset, in a directory keyed on
+    the dataset, the split and the flow method. This allows to share the
+    flow between the runs on the same dataset.
+    '''
+    path = flow_store_path(store_dir, dataset_name, which_set, method)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    params = {'batch_size': 1, 'use_threads': False,
+              'shuffle_at_each_epoch': False, 'return_list': False}
+    names = Dataset(which_set=which_set, **params).get_names()
+    index = {}
+    tasks = []
+    for subset, fnames in sorted(names.items()):
+        fnames = sorted(fnames)
+        index[subset] = {'file': subset_filename(subset),
+                         'frames': fnames}
+        tasks.append((subset, fnames, method, path))
+
+    pool = mp.Pool(nprocs or mp.cpu_count(), initializer=_init_worker,
+                   initargs=(Dataset, which_set, params))
+    for _ in tqdm(pool.imap_unordered(_compute_subset_flow, tasks),
+                  total=len(tasks), desc='Flow of ' + which_set):
+        pass
+    pool.close()
+    pool.join()
+
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump({'method': method, 'subsets': index}, f)
+    tf.logging.info('Optical flow of {} stored in {}'.format(which_set,
+                                                             path))
+
+
+class FlowStore(object):
+    '''Read the flow precomputed by `precompute_flow`'''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.subsets = {}
+        for subset, v in index['subsets'].items():
+            self.subsets[subset] = (v['file'], {fname: i for i, fname in
+                                                enumerate(v['frames'])})
+        self._flows = {}
+
+    def get(self, subset, fname):
+        '''Return the uint8 RGB flow of a frame'''
+        filename, rows = self.subsets[subset]
+        if subset not in self._flows:
+            self._flows[subset] = np.load(os.path.join(self.path, filename),
+                                          mmap_mode='r')
+        return self._flows[subset][rows[fname]]
+
+
+def flow_store_dataset(Dataset, store_dir, dataset_name, method):
+    '''Return a subclass of Dataset that reads the flow from a FlowStore
+
+    The flow of each frame is concatenated to its channels when the frames
+    are loaded, so that the data augmentation (e.g., the crop) is applied
+    consistently to the frames and to their flow. The Dataset should not
+    compute the flow itself, i.e., `return_optical_flow` should be unset.
+    '''
+    def load_sequence(self, sequence):
+        ret = Dataset.load_sequence(self, sequence)
+        if not hasattr(self, 'flow_store'):
+            self.flow_store = FlowStore(flow_store_path(
+                store_dir, dataset_name, self.which_set, method))
+        flows = np.array([self.flow_store.get(subset, fname)
+                          for subset, fname in sequence])
+        data = ret['data']
+        if data.dtype != np.uint8:
+            # Match the range of the frames
+            flows = flows.astype(data.dtype)
+            if data.max() <= 1:
+                flows /= 255.
+        ret['data'] = np.concatenate([data, flows], axis=-1)
+        return ret
+
+    return type(Dataset.__name__, (Dataset,),
+                {'load_sequence': load_sequence})
+
+
+if __name__ == '__main__':
+    import sys
+    from main_loop_tf.main import store_flow
+
+    store_flow(sys.argv)
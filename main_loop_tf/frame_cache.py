@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+
+def frame_cache_dataset(Dataset, max_bytes):
+    '''Return a subclass of Dataset that caches the frames it loads
+
+    The sequences are loaded one frame at a time through the original
+    `load_sequence` and the frames are stored in a `FrameCache`, so that
+    overlapping sequences of the same subset (video) load and preprocess
+    each frame once.
+
+    Params
+    ------
+    Dataset:
+        A `dataset_loaders` Dataset class
+    max_bytes:
+        The maximum size of the cached frames
+    '''
+    def load_sequence(self, sequence):
+        frames = []
+        for subset, fname in sequence:
+            key = (self.which_set, subset, fname)
+            frame = self.frame_cache.get(key)
+            if frame is None:
+                frame = Dataset.load_sequence(self, [(subset, fname)])
+                self.frame_cache.put(key, frame)
+            frames.append(frame)
+        return stack_frames(frames)
+
+    return type(Dataset.__name__, (Dataset,),
+                {'load_sequence': load_sequence,
+                 'frame_cache': FrameCache(max_bytes)})
+
+
+def stack_frames(frames):
+    '''Merge the dicts returned by `load_sequence` for single frames'''
+    ret = {}
+    for k, v in frames[0].items():
+        if isinstance(v, np.ndarray):
+            ret[k] = np.concatenate([f[k] for f in frames], axis=0)
+        elif isinstance(v, list):
+            ret[k] = [el for f in frames for el in f[k]]
+        else:  # e.g., the subset
+            ret[k] = v
+    return ret
+
+
+def nbytes(frame):
+    return sum(v.nbytes for v in frame.values() if isinstance(v, np.ndarray))
+
+
+class FrameCache(object):
+    '''A thread-safe LRU cache of frames with a budget in bytes
+
+    The frames are grouped by subset (i.e., video): when the cache is full
+    the frames of the least recently used subset are evicted first, since
+    the sequences of a subset are usually consumed consecutively.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._subsets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        subset_key, fname = key[:-1], key[-1]
+        with self._lock:
+            frames = self._subsets.get(subset_key)
+            if frames is None or fname not in frames:
+                self.misses += 1
+                return None
+            # Mark the subset and the frame as the most recently used
+            self._subsets[subset_key] = self._subsets.pop(subset_key)
+            frame, size = frames.pop(fname)
+            frames[fname] = (frame, size)
+            self.hits += 1
+            self.bytes_saved += size
+            return frame
+
+    def put(self, key, frame):
+        subset_key, fname = key[:-1], key[-1]
+        size = nbytes(frame)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            frames = self._subsets.setdefault(subset_key, OrderedDict())
+            if fname in frames:
+                return
+            # Evict the least recently used frames
+            while self.nbytes + size > self.max_bytes:
+                lru_key = next(iter(self._subsets))
+                lru_frames = self._subsets[lru_key]
+                if lru_frames:
+                    _, (_, lru_size) = lru_frames.popitem(last=False)
+                    self.nbytes -= lru_size
+                if not lru_frames and lru_key != subset_key:
+                    del self._subsets[lru_key]
+                elif not lru_frames:
+                    # The subset of the new frame is the only one left
+                    self._subsets[subset_key] = self._subsets.pop(lru_key)
+            frames[fname] = (frame, size)
+            self.nbytes += size
+
+    @property
+    def hit_rate(self):
+        return self.hits / float(max(1, self.hits + self.misses))
+
+    def __str__(self):
+        return ('Frame cache: {:.1%} hit rate, {:.1f} MB saved, {:.1f}/{:.1f} '
+                'MB used'.format(self.hit_rate, self.bytes_saved / 1024. ** 2,
+                                 self.nbytes / 1024. ** 2,
+                                 self.max_bytes / 1024. ** 2))
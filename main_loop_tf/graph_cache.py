@@ -0,0 +1,187 @@
+'''Cache of the built graphs, to restart an experiment without rebuilding
+
+Building the towers of a large model (and their gradients) can take
+minutes. The first run exports the graph as a MetaGraph next to the
+checkpoints, along with the names of the placeholders, fetches and ops
+the main loop needs; the following runs with the same configuration
+import it and bind them back by name.
+
+The key of the cache covers the flags that can change the graph (all
+but `RUNTIME_FLAGS`, including `devices` and `static_tower_split` that
+do not change the hash of the experiment), the shapes and class weights
+computed from the dataset, the version of TensorFlow and the source of
+`build_model` and of main_loop_tf. Changes to modules imported by `build_model` are not
+tracked: remove the cache (`graph_*.meta`) after editing them.
+'''
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import gflags
+import tensorflow as tf
+
+# The flags that do not change the graph, e.g., those of the input
+# pipeline, of the session, of the validation and of the schedule
+RUNTIME_FLAGS = ['autotune', 'autotune_cache_dir', 'autotune_memory_mb',
+                 'autotune_steps', 'autotune_trial', 'benchmark_json',
+                 'benchmark_trial', 'checkpoints_dir', 'compress_shards',
+                 'debug', 'debug_of', 'do_validation_only', 'flow_store_dir',
+                 'frame_cache_mb', 'graph_cache', 'help',
+                 'inter_op_threads', 'intra_op_threads', 'job_name',
+                 'local_ps', 'local_workers', 'max_epochs', 'max_steps',
+                 'memory_budget_mb', 'memory_report', 'memory_report_steps',
+                 'min_epochs', 'nprocs', 'nthreads', 'ordered_batches',
+                 'overlap', 'patience', 'prefetch_depth', 'progress_secs',
+                 'ps_hosts', 'restore_model', 'save_gif_frames_on_disk',
+                 'save_gif_on_disk', 'save_raw_predictions_on_disk',
+                 'seq_per_subset', 'shards_dir', 'show_heatmaps_summaries',
+                 'show_samples_summaries', 'stateful_validation',
+                 'stats_cache_dir', 'summary_per_subset',
+                 'supervisor_master', 'sweep_batch_size', 'sweep_crop_size',
+                 'sweep_devices', 'sweep_input_mode', 'sweep_seq_length',
+                 'sweep_train_summary_freq', 'synthetic_nbatches',
+                 'task_index', 'thresh_loss', 'trace_every_steps',
+                 'train_summary_freq', 'use_threads', 'val_cache_mb',
+                 'val_cache_spill_dir', 'val_every_epochs', 'val_overlap',
+                 'val_skip_first', 'val_summary_freq', 'worker_hosts']
+# The frequencies of the tiers of summaries only change the graph when
+# they are zero, i.e., the tier is disabled
+SUMMARY_FREQ_FLAGS = ['train_histograms_summary_freq',
+                      'train_norms_summary_freq']
+# The keys of the built graphs that are not stored in the cache. The saver
+# is rebuilt by `tf.train.import_meta_graph`
+NOT_CACHED = ['saver', 'sync_optimizer', 'chief_queue_runner']
+
+
+def graph_key(build_model):
+    '''Return the key of the graphs built by `build_model` with cfg'''
+    cfg = gflags.cfg
+    h = hashlib.md5()
+    flags = {k: v for k, v in gflags.FLAGS.FlagValuesDict().iteritems()
+             if k not in RUNTIME_FLAGS}
+    for k in SUMMARY_FREQ_FLAGS:
+        flags[k] = flags[k] > 0
+    h.update(repr(sorted(flags.items())))
+    h.update(repr((cfg.feed_input_shape, cfg.val_input_shape,
+                   cfg.class_weights)))
+    h.update(tf.__version__)
+    here = os.path.dirname(os.path.abspath(__file__))
+    sources = [inspect.getsourcefile(build_model)]
+    sources += sorted(glob.glob(os.path.join(here, '*.py')) +
+                      glob.glob(os.path.join(here, 'config', '*.py')))
+    for path in sources:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _encode(obj):
+    '''Replace the tensors, the variables and the ops in `obj` with their
+    names'''
+    if isinstance(obj, tf.Tensor):
+        return {'tensor': obj.name}
+    if isinstance(obj, tf.Variable):
+        return {'variable': obj.name}
+    if isinstance(obj, tf.Operation):
+        return {'op': obj.name}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(o) for o in obj]
+    if isinstance(obj, dict):
+        return {'dict': {k: _encode(v) for k, v in obj.iteritems()}}
+    return obj
+
+
+def _decode(obj, graph):
+    '''Inverse of `_encode`'''
+    if isinstance(obj, list):
+        return [_decode(o, graph) for o in obj]
+    if isinstance(obj, dict):
+        if 'tensor' in obj:
+            return graph.get_tensor_by_name(obj['tensor'])
+        if 'variable' in obj:
+            # The variables are rebuilt from their collections by
+            # `tf.train.import_meta_graph`
+            for v in (graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES) +
+                      graph.get_collection(tf.GraphKeys.LOCAL_VARIABLES)):
+                if v.name == obj['variable']:
+                    return v
+            raise KeyError('The variable {} is not in the graph'.format(
+                obj['variable']))
+        if 'op' in obj:
+            return graph.get_operation_by_name(obj['op'])
+        return {k: _decode(v, graph) for k, v in obj['dict'].iteritems()}
+    return obj
+
+
+class GraphCache(object):
+    '''The MetaGraph and the bindings of the graphs with key `key`
+
+    Params
+    ------
+    cache_dir:
+        The directory of the cache, i.e., the checkpoints directory
+    key:
+        The key of the graphs, see `graph_key`
+    '''
+    def __init__(self, cache_dir, key):
+        self.meta_path = os.path.join(cache_dir, 'graph_%s.meta' % key)
+        self.bindings_path = os.path.join(cache_dir, 'graph_%s.json' % key)
+
+    def exists(self):
+        return (os.path.exists(self.meta_path) and
+                os.path.exists(self.bindings_path))
+
+    def save(self, built):
+        '''Export the default graph and the bindings of `built`'''
+        cache_dir = os.path.dirname(self.meta_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        bindings = {k: _encode(v) for k, v in built.iteritems()
+                    if k not in NOT_CACHED}
+        tf.train.export_meta_graph(
+            filename=self.meta_path,
+            saver_def=built['saver'].as_saver_def(),
+            clear_devices=False)
+        # Write the bindings last: a run interrupted while exporting does
+        # not leave a cache that looks complete
+        bindings = json.dumps(bindings)
+        with open(self.bindings_path, 'w') as f:
+            f.write(bindings)
+        self.check(built)
+
+    def check(self, built):
+        '''Load the cache in a new graph and compare its bindings with
+        those of `built`
+
+        Removes the cache and raises a ValueError if they differ.
+        '''
+        with tf.Graph().as_default():
+            loaded = self.load()
+            wrong = sorted(k for k, v in built.iteritems()
+                           if k not in NOT_CACHED and
+                           _encode(loaded.get(k)) != _encode(v))
+        if wrong:
+            os.remove(self.bindings_path)
+            os.remove(self.meta_path)
+            raise ValueError('The graph cache does not restore {}, run with '
+                             '--graph_cache=false'.format(', '.join(wrong)))
+
+    def load(self):
+        '''Import the graph in the default graph and return its bindings
+
+        The bindings are the same as those saved, with the saver of the
+        MetaGraph and no sync optimizer (the cache is not used in
+        distributed mode).
+        '''
+        saver = tf.train.import_meta_graph(self.meta_path,
+                                           clear_devices=False)
+        with open(self.bindings_path) as f:
+            bindings = json.load(f)
+        graph = tf.get_default_graph()
+        built = {str(k): _decode(v, graph) for k, v in bindings.iteritems()}
+        built['saver'] = saver
+        built['sync_optimizer'] = None
+        built['chief_queue_runner'] = None
+        return built
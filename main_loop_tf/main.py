@@ -1,4 +1,5 @@
 from copy import deepcopy
+from functools import partial
 import hashlib
 import logging
 import os
@@ -13,13 +14,33 @@ from tensorflow.contrib import slim
 from tensorflow.python.framework import ops
 from tensorflow.python.training import training
 from tensorflow.python.training.supervisor import Supervisor
-from tqdm import tqdm
 
 import gflags
 import loss
-from utils import (apply_loss, compute_chunk_size, save_repos_hash,
-                   average_gradients, process_gradients, TqdmHandler)
+from utils import (accumulate_gradients, apply_loss, compute_chunk_size,
+                   expand_sample_mask, pad_batch, save_repos_hash,
+                   add_weight_decay, average_gradients, l2_penalty,
+                   l2_penalty_scale,
+                   process_gradients, ThrottledProgress, TqdmHandler)
 from loss import mean_iou as compute_mean_iou
+from prefetch import Prefetcher, QueueFeeder
+from process_pool import process_pool_dataset
+from shards import convert_to_shards, shard_dataset
+from validate import IMG_QUEUE_SIZE, validate, finish_validation
+from preprocessing import augment_batch, normalize_inputs
+from frame_cache import frame_cache_dataset
+from flow_store import flow_store_dataset, precompute_flow
+from stats import class_balance_weights, dataset_stats
+from cpu_layout import configure_cpus, cpu_tower_groups, numa_nodes
+import recompute
+from distributed import (cluster_spec, launch_local_cluster, run_ps,
+                         sharded_dataset)
+from graph_cache import GraphCache, graph_key
+from profiling import StepTimer, save_chrome_trace
+from synthetic import synthetic_dataset
+from autotune import TUNED_FLAGS, autotune, save_trial, tuned_args
+from memory import (forecast_batch_size, host_memory_bytes, peak_rss_bytes,
+                    rss_bytes, save_report, step_memory)
 
 # config module load all flags from source files
 import config  # noqa
@@ -48,12 +69,72 @@ gflags.DEFINE_string('model_name', 'my_model', 'The name of the model, '
                      'for the checkpoint file')
 gflags.DEFINE_string('supervisor_master', '', 'The "master" string for the '
                      'Supervisor')
+gflags.DEFINE_list('ps_hosts', [], 'The host:port of the parameter servers '
+                   'of the cluster')
+gflags.DEFINE_list('worker_hosts', [], 'The host:port of the workers of the '
+                   'cluster')
+gflags.DEFINE_enum('job_name', None, ['ps', 'worker'], 'The job of this '
+                   'process in the cluster')
+gflags.DEFINE_integer('task_index', 0, 'The index of this process in its '
+                      'job. The worker 0 is the chief', lower_bound=0)
+gflags.DEFINE_integer('local_workers', 0, 'If nonzero, the experiment is '
+                      'run on a cluster of this many workers (and local_ps '
+                      'parameter servers) on localhost', lower_bound=0)
+gflags.DEFINE_integer('local_ps', 1, 'The number of parameter servers of '
+                      'the local cluster', lower_bound=1)
+gflags.DEFINE_bool('sync_replicas', True, 'If True the gradients of the '
+                   'workers are aggregated synchronously, otherwise each '
+                   'worker updates the variables asynchronously')
 
 
 def run(argv, build_model):
     __parse_config(argv)
+    cfg = gflags.cfg
+    if cfg.local_workers and cfg.job_name is None:
+        # Run the experiment in a cluster of processes on this host
+        return launch_local_cluster(argv, cfg.local_workers, cfg.local_ps)
+    if (cfg.autotune and not cfg.autotune_trial and cfg.job_name is None and
+            not cfg.do_validation_only):
+        # Parse the config again with the best batch size and threads
+        argv = list(argv) + tuned_args(autotune(argv))
+        __parse_config(argv)
     # Run main with the remaining arguments
-    __run(build_model)
+    ret = __run(build_model)
+    if cfg.autotune_trial:
+        save_trial()
+    return ret
+
+
+def convert(argv):
+    '''Convert the training and validation sets to memory-mapped shards
+
+    The shards are written in the `shards_dir` directory and can be used
+    in place of the Dataset in the following runs by setting `shards_dir`.
+    '''
+    gflags.mark_flags_as_required(['shards_dir'])
+    __parse_config(argv)
+    cfg = gflags.cfg
+    shards_dir = os.path.join(cfg.shards_dir, cfg.dataset)
+    convert_to_shards(cfg.RawDataset, 'train', cfg.dataset_params,
+                      shards_dir, compress=cfg.compress_shards)
+    for s in cfg.val_on_sets:
+        convert_to_shards(cfg.RawDataset, s, cfg.valid_params, shards_dir,
+                          compress=cfg.compress_shards)
+
+
+def store_flow(argv):
+    '''Precompute the optical flow of the training and validation sets
+
+    The flow is computed with the `of` method and stored in
+    `flow_store_dir`, where the following runs with the same dataset and
+    flow method will read it.
+    '''
+    gflags.mark_flags_as_required(['of', 'flow_store_dir'])
+    __parse_config(argv)
+    cfg = gflags.cfg
+    for s in ['train'] + list(cfg.val_on_sets):
+        precompute_flow(cfg.BaseDataset, cfg.dataset, s, cfg.of,
+                        cfg.flow_store_dir, cfg.nprocs or None)
 
 
 def __parse_config(argv=None):
@@ -81,17 +162,49 @@ def __parse_config(argv=None):
 
     # ============ gsheet
     # Save params for log, excluding non JSONable and not interesting objects
-    exclude_list = ['checkpoints_dir', 'checkpoints_to_keep', 'dataset',
+    exclude_list = ['autotune', 'autotune_cache_dir', 'autotune_memory_mb',
+                    'autotune_steps', 'autotune_trial', 'benchmark_json',
+                    'benchmark_trial', 'checkpoints_dir',
+                    'checkpoints_to_keep', 'compress_shards', 'dataset',
                     'debug', 'debug_of', 'devices', 'do_validation_only',
-                    'group_summaries', 'help', 'hyperparams_summaries',
-                    'max_epochs', 'min_epochs', 'model_name', 'nthreads',
-                    'patience', 'return_middle_frame_only', 'restore_model',
+                    'flow_store_dir', 'frame_cache_mb', 'grad_bucket_mb',
+                    'graph_augmentation', 'graph_cache', 'group_summaries',
+                    'help', 'hyperparams_summaries', 'input_mode',
+                    'inter_op_threads', 'intra_op_threads', 'job_name',
+                    'local_ps', 'local_workers', 'max_epochs', 'max_steps',
+                    'memory_budget_mb', 'memory_report', 'memory_report_steps',
+                    'min_epochs', 'model_name', 'nprocs', 'nthreads',
+                    'numa_affinity', 'ordered_batches', 'patience',
+                    'prefetch_depth', 'progress_secs', 'ps_hosts', 'recompute',
+                    'restore_model', 'return_middle_frame_only',
                     'save_gif_frames_on_disk', 'save_gif_on_disk',
-                    'save_raw_predictions_on_disk', 'show_heatmaps_summaries',
-                    'show_samples_summaries', 'supervisor_master',
-                    'thresh_loss', 'train_summary_freq', 'use_threads',
-                    'val_every_epochs', 'val_on_sets', 'val_skip_first',
-                    'val_summary_freq', 'summary_per_subset']
+                    'save_raw_predictions_on_disk', 'shards_dir',
+                    'show_heatmaps_summaries', 'show_samples_summaries',
+                    'static_tower_split', 'stats_cache_dir',
+                    'summary_per_subset', 'supervisor_master',
+                    'sweep_batch_size', 'sweep_crop_size', 'sweep_devices',
+                    'sweep_input_mode', 'sweep_seq_length',
+                    'sweep_train_summary_freq', 'sync_replicas', 'task_index',
+                    'thresh_loss', 'trace_every_steps',
+                    'train_histograms_summary_freq',
+                    'train_norms_summary_freq', 'train_summary_freq',
+                    'uint8_inputs', 'use_threads', 'val_cache_mb',
+                    'val_cache_spill_dir', 'val_every_epochs', 'val_graph',
+                    'val_on_sets', 'val_skip_first', 'val_summary_freq',
+                    'worker_hosts']
+    if cfg.dataset != 'synthetic':
+        exclude_list += ['synthetic_nbatches', 'synthetic_nclasses',
+                         'synthetic_shape']
+    # The flags added after the first experiments are hashed only when they
+    # differ from their default, so that the hash (hence the checkpoints
+    # directory) of the previous experiments does not change
+    hashed_if_set = ['accumulate_steps', 'class_balance', 'random_flip',
+                     'scale_range']
+    exclude_list += [k for k in hashed_if_set if getattr(cfg, k) ==
+                     fl[k].default]
+    if cfg.autotune:
+        # The tuned values do not change the experiment
+        exclude_list += TUNED_FLAGS
     param_dict = {k: deepcopy(v) for (k, v) in cfg.__dict__.iteritems()
                   if k not in exclude_list}
     h = hashlib.md5()
@@ -130,21 +243,43 @@ def __parse_config(argv=None):
 
     # ============ A bunch of derived params
     cfg._FLOATX = 'float32'
+    cfg.input_dtype = cfg._FLOATX
+    cfg.label_dtype = 'int32'
     cfg.num_gpus = len([el for el in cfg.devices if 'gpu' in el])
     cfg.num_cpus = len([el for el in cfg.devices if 'cpu' in el])
     cfg.num_splits = cfg.num_gpus + cfg.num_cpus
+    cfg.is_chief = cfg.job_name != 'worker' or cfg.task_index == 0
+    cfg.tower_groups = None
+    if cfg.numa_affinity:
+        # Average the gradients of the towers of each NUMA node locally
+        cfg.tower_groups = cpu_tower_groups(cfg.devices, len(numa_nodes()))
 
     # Dataset
-    try:
-        Dataset = getattr(dataset_loaders, cfg.dataset)
-    except AttributeError:
-        Dataset = getattr(dataset_loaders, cfg.dataset.capitalize() +
-                          'Dataset')
-    cfg.Dataset = Dataset
+    if cfg.dataset == 'synthetic':
+        # Random batches in memory, to benchmark the loop
+        Dataset = synthetic_dataset(cfg.synthetic_shape,
+                                    cfg.synthetic_nclasses,
+                                    cfg.synthetic_nbatches)
+    else:
+        try:
+            Dataset = getattr(dataset_loaders, cfg.dataset)
+        except AttributeError:
+            Dataset = getattr(dataset_loaders, cfg.dataset.capitalize() +
+                              'Dataset')
+    cfg.Dataset = cfg.BaseDataset = Dataset
     dataset_params = {}
     dataset_params['batch_size'] = cfg.batch_size
     dataset_params['data_augm_kwargs'] = {}
-    dataset_params['data_augm_kwargs']['crop_size'] = cfg.crop_size
+    if cfg.graph_augmentation:
+        # The crop is applied in the graph on the full size batches
+        dataset_params['data_augm_kwargs']['crop_size'] = None
+    else:
+        if cfg.random_flip or cfg.scale_range:
+            raise ValueError('random_flip and scale_range require '
+                             'graph_augmentation')
+        dataset_params['data_augm_kwargs']['crop_size'] = cfg.crop_size
+    if cfg.scale_range and not cfg.crop_size:
+        raise ValueError('scale_range requires crop_size')
     dataset_params['data_augm_kwargs']['return_optical_flow'] = cfg.of
     dataset_params['return_one_hot'] = False
     dataset_params['return_01c'] = True
@@ -173,6 +308,26 @@ def __parse_config(argv=None):
         cfg.val_input_shape = [None] + list(Dataset.data_shape)
         if cfg.crop_size:
             cfg.input_shape[1:3] = cfg.crop_size
+    # The shape of the training batches fed to the graph
+    cfg.feed_input_shape = (cfg.val_input_shape if cfg.graph_augmentation
+                            else cfg.input_shape)
+    if cfg.val_graph == 'shared':
+        # The same placeholder and towers get the training and the
+        # validation batches
+        if cfg.input_mode == 'queue' or cfg.graph_augmentation:
+            raise ValueError('val_graph shared is not compatible with the '
+                             'queue input_mode and graph_augmentation')
+        if cfg.static_tower_split and cfg.batch_size != cfg.val_batch_size:
+            raise ValueError('val_graph shared with static_tower_split '
+                             'requires batch_size == val_batch_size')
+        cfg.input_shape = [a if a == b else None for a, b in
+                           zip(cfg.input_shape, cfg.val_input_shape)]
+        cfg.feed_input_shape = cfg.input_shape
+    if cfg.memory_report and cfg.input_mode == 'queue':
+        raise ValueError('memory_report requires the feed_dict input_mode')
+    if cfg.memory_report and (cfg.job_name or cfg.local_workers):
+        raise ValueError('memory_report is not supported in distributed '
+                         'mode')
     dataset_params['use_threads'] = cfg.use_threads
     dataset_params['nthreads'] = cfg.nthreads
     dataset_params['remove_per_img_mean'] = cfg.remove_per_img_mean
@@ -191,6 +346,79 @@ def __parse_config(argv=None):
         'use_threads': False,  # prevent shuffling
         # prevent crop
         'data_augm_kwargs': {'return_optical_flow': cfg.of}})
+    if cfg.of and cfg.flow_store_dir:
+        # Read the precomputed flow rather than computing it in the loader
+        if not cfg.uint8_inputs and (cfg.remove_mean or cfg.divide_by_std):
+            raise ValueError('The dataset mean and std cannot be removed on '
+                             'the host from the stored optical flow, use '
+                             'uint8_inputs to normalize in the graph')
+        Dataset = flow_store_dataset(Dataset, cfg.flow_store_dir,
+                                     cfg.dataset, cfg.of)
+        for params in (cfg.dataset_params, cfg.valid_params):
+            params['data_augm_kwargs']['return_optical_flow'] = None
+    if cfg.uint8_inputs:
+        # Feed the raw frames and labels and normalize them in the graph
+        if cfg.of and not cfg.flow_store_dir:
+            raise ValueError('uint8_inputs does not support the optical '
+                             'flow computed by the loader, please use '
+                             'flow_store_dir')
+        cfg.input_dtype = 'uint8'
+        max_label = max([Dataset.nclasses - 1] +
+                        list(getattr(Dataset, 'void_labels', [])))
+        cfg.label_dtype = 'uint8' if max_label < 2 ** 8 else 'uint16'
+        for params in (cfg.dataset_params, cfg.valid_params):
+            params.update({'return_0_255': True,
+                           'remove_mean': False,
+                           'divide_by_std': False,
+                           'remove_per_img_mean': False,
+                           'divide_by_per_img_std': False})
+    # Compute the statistics the dataset does not ship
+    need_mean = ((cfg.remove_mean and getattr(Dataset, 'mean', None) is None)
+                 or (cfg.divide_by_std and
+                     getattr(Dataset, 'std', None) is None))
+    need_freqs = (cfg.class_balance and
+                  getattr(Dataset, 'class_freqs', None) is None)
+    cfg.class_freqs = getattr(Dataset, 'class_freqs', None)
+    if need_mean or need_freqs:
+        stats = dataset_stats(Dataset, cfg.dataset, 'train',
+                              cfg.dataset_params, cfg.stats_cache_dir,
+                              cfg.nprocs)
+        cfg.class_freqs = stats['class_freqs']
+        tf.logging.info('Void pixels: {:.2%} of the training set'.format(
+            stats['void_fraction']))
+        if need_mean:
+            nchannels = Dataset.data_shape[-1]
+            Dataset = type(Dataset.__name__, (Dataset,),
+                           {'mean': np.array(stats['mean'][:nchannels]),
+                            'std': np.array(stats['std'][:nchannels])})
+    if cfg.job_name == 'worker' and len(cfg.worker_hosts) > 1:
+        # Each worker trains on a disjoint shard of the training set
+        if cfg.shards_dir:
+            raise ValueError('The shards of shards_dir cannot be split '
+                             'among the workers')
+        Dataset = sharded_dataset(Dataset, len(cfg.worker_hosts),
+                                  cfg.task_index)
+    if cfg.frame_cache_mb:
+        if cfg.nprocs:
+            raise ValueError('frame_cache_mb is not supported with nprocs: '
+                             'each worker process would have its own cache '
+                             'and get the sequences round robin. Use '
+                             'use_threads instead')
+        if cfg.of and not cfg.flow_store_dir:
+            raise ValueError('frame_cache_mb only caches the optical flow '
+                             'read from flow_store_dir')
+        # Load each frame (and its stored flow) of overlapping sequences
+        # once
+        Dataset = frame_cache_dataset(Dataset, cfg.frame_cache_mb * 1024 ** 2)
+    cfg.RawDataset = Dataset
+    if cfg.shards_dir:
+        # Serve the batches from the shards written by `convert`
+        cfg.Dataset = shard_dataset(os.path.join(cfg.shards_dir,
+                                                 cfg.dataset), Dataset)
+    elif cfg.nprocs:
+        # Build the batches in worker processes
+        cfg.Dataset = process_pool_dataset(Dataset, cfg.nprocs,
+                                           cfg.ordered_batches)
     cfg.void_labels = getattr(Dataset, 'void_labels', [])
     cfg.nclasses = Dataset.non_void_nclasses
     cfg.nclasses_w_void = Dataset.nclasses
@@ -217,26 +445,32 @@ def __parse_config(argv=None):
                     max(1, cfg.val_every_epochs) - 1)
 
 
-def __run(build_model):
+def __class_weights():
     cfg = gflags.cfg
+    cfg.class_weights = None
+    if cfg.class_balance:
+        w_freq = class_balance_weights(cfg.class_freqs, cfg.class_balance)
+        tf.logging.info('Class balance weights: {}'.format(w_freq))
+        cfg.class_weights = w_freq.astype(cfg._FLOATX)
 
-    # ============ Class balance
-    # assert class_balance in [None, 'median_freq_cost', 'rare_freq_cost'], (
-    #     'The balance class method is not implemented')
 
-    # if class_balance in ['median_freq_cost', 'rare_freq_cost']:
-    #     if not hasattr(Dataset, 'class_freqs'):
-    #         raise RuntimeError('class_freqs is missing for dataset '
-    #                            '{}'.format(Dataset.name))
-    #     freqs = Dataset.class_freqs
+def build_graphs(argv, build_model, graph):
+    '''Parse the config from `argv` and build the graphs in `graph`
 
-    #     if class_balance == 'median_freq_cost':
-    #         w_freq = np.median(freqs) / freqs
-    #     elif class_balance == 'rare_freq_cost':
-    #         w_freq = 1 / (cfg.nclasses * freqs)
+    Return the dict of the placeholders, fetches and ops of the training
+    and validation graphs, as the main loop uses them, to run them outside
+    of the main loop (e.g., in the benchmarks).
+    '''
+    __parse_config(argv)
+    __class_weights()
+    return __build_graphs(build_model, graph)
 
-    #     tf.logging.info("Class balance weights", w_freq)
-    #     cfg.class_balance = w_freq
+
+def __run(build_model):
+    cfg = gflags.cfg
+
+    # ============ Class balance
+    __class_weights()
 
     # ============ Train/validation
     # Load data
@@ -252,109 +486,62 @@ def __run(build_model):
 
     # BUILD GRAPH
     tf_config = tf.ConfigProto(allow_soft_placement=True)
+    configure_cpus(tf_config)
+
+    master = cfg.supervisor_master
+    device_setter = None
+    if cfg.job_name == 'ps':
+        return run_ps(tf_config)
+    elif cfg.job_name == 'worker':
+        server = tf.train.Server(cluster_spec(), job_name='worker',
+                                 task_index=cfg.task_index, config=tf_config)
+        master = server.target
+        # Place the variables on the parameter servers
+        device_setter = tf.train.replica_device_setter(
+            worker_device='/job:worker/task:%d' % cfg.task_index,
+            cluster=cluster_spec())
 
     tf.logging.info("Building the model ...")
     # with graph:
-    with tf.Graph().as_default() as graph:
-        cfg.global_step = tf.Variable(0, trainable=False, name='global_step',
-                                      dtype='int32')
-        inputs = tf.placeholder(shape=cfg.input_shape,
-                                dtype=cfg._FLOATX, name='inputs')
-        val_inputs = tf.placeholder(shape=cfg.val_input_shape,
-                                    dtype=cfg._FLOATX, name='val_inputs')
-        labels = tf.placeholder(shape=[None], dtype='int32', name='labels')
-
-        prev_err = tf.placeholder(shape=(),
-                                  dtype=cfg._FLOATX, name='prev_err')
-        if cfg.lr_decay is None:
-            lr = cfg.lr
-        elif cfg.lr_decay == 'exp':
-            lr = tf.train.exponential_decay(cfg.lr,
-                                            cfg.global_step,
-                                            cfg.decay_steps,
-                                            cfg.decay_rate,
-                                            staircase=cfg.staircase)
-        elif cfg.lr_decay == 'piecewise':
-            lr = tf.train.piecewise_constant(cfg.global_step,
-                                             cfg.lr_boundaries,
-                                             cfg.lr_values)
-        elif cfg.lr_decay == 'polynomial':
-            lr = tf.train.polynomial_decay(cfg.lr,
-                                           cfg.global_step,
-                                           cfg.decay_steps,
-                                           end_learning_rate=cfg.end_lr,
-                                           power=cfg.power,
-                                           cycle=cfg.staircase)
-
-        elif cfg.lr_decay == 'natural_exp':
-            lr = tf.train.natural_exp_decay(cfg.lr,
-                                            cfg.global_step,
-                                            cfg.decay_steps,
-                                            cfg.decay_rate,
-                                            staircase=cfg.staircase)
-        elif cfg.lr_decay == 'inverse_time':
-            lr = tf.train.inverse_time_decay(cfg.lr,
-                                             cfg.global_step,
-                                             cfg.decay_steps,
-                                             cfg.decay_rate,
-                                             staircase=cfg.staircase)
+    with tf.Graph().as_default() as graph, tf.device(device_setter):
+        graph_cache = None
+        if cfg.graph_cache and cfg.job_name is None:
+            graph_cache = GraphCache(cfg.checkpoints_dir,
+                                     graph_key(build_model))
+        if graph_cache is not None and graph_cache.exists():
+            t_load = time()
+            built = graph_cache.load()
+            tf.logging.info('Graph loaded from {} in {:.2f}s'.format(
+                graph_cache.meta_path, time() - t_load))
         else:
-            raise NotImplementedError()
-
-        cfg.Optimizer = cfg.Optimizer(learning_rate=lr, **cfg.optimizer_params)
-
-        # TODO is there another way to split the input in chunks when
-        # batchsize is not a multiple of num_splits?
-        # Split in chunks, the size of each is provided in input_split_dim
-        inputs_split_dim = tf.placeholder(shape=[cfg.num_splits],
-                                          dtype='int32',
-                                          name='inputs_split_dim')
-        labels_split_dim = tf.placeholder(shape=[cfg.num_splits],
-                                          dtype='int32',
-                                          name='label_split_dim')
-        placeholders = [inputs, labels, inputs_split_dim, labels_split_dim,
-                        prev_err]
-        val_placeholders = [val_inputs, labels, inputs_split_dim,
-                            labels_split_dim]
-
-        # Model parameters on the FIRST device specified in cfg.devides
-        # Gradient Average and the rest on the operations are on CPU
-        with tf.device('/cpu:0'):
-            # Model compilation
-            # -----------------
-            train_outs, train_summary_op, train_reset_cm_op = build_graph(
-                placeholders, cfg.input_shape, build_model, True)
-
-            val_outs, val_summary_ops, val_reset_cm_op = build_graph(
-                val_placeholders, cfg.val_input_shape, build_model, False)
-            if cfg.hyperparams_summaries is not None:
-                sum_text = []
-                for (key_header,
-                     list_value) in cfg.hyperparams_summaries.iteritems():
-
-                    header_list = []
-                    text_list = []
-                    for v in list_value:
-                        header_list.append('**'+v+'**')
-                        text_list.append(str(getattr(cfg, v)))
-                    header_tensor = tf.constant(header_list)
-                    text_tensor = tf.constant(text_list)
-
-                    sum_text.append(tf.summary.text(
-                        key_header, tf.reshape(
-                            tf.concat([header_tensor, text_tensor], axis=0),
-                            [2, -1])))
-                sum_text_op = tf.summary.merge(sum_text)
-
-            # Group global and local init into one op. Could be split into
-            # two different ops and passed to `init_op` and `local_init_op`
-            init_op = tf.group(tf.global_variables_initializer(),
-                               tf.local_variables_initializer())
-            saver = tf.train.Saver(max_to_keep=cfg.checkpoints_to_keep)
+            built = __build_graphs(build_model, graph)
+            if graph_cache is not None:
+                graph_cache.save(built)
+        cfg.global_step = built['global_step']
+        cfg.val_feed_dict = dict(built['val_feed_dict'])
+        placeholders = built['placeholders']
+        enqueue_ops = built['enqueue_ops']
+        train_outs = built['train_outs']
+        train_summary_ops = built['train_summary_ops']
+        val_placeholders = built['val_placeholders']
+        val_outs = built['val_outs']
+        val_summary_ops = built['val_summary_ops']
+        val_reset_cm_op = built['val_reset_cm_op']
+        sync_optimizer = built['sync_optimizer']
+        saver = built['saver']
+
+        if cfg.memory_report:
+            # Run the traced steps in a throwaway session, with new
+            # variables: the experiment and its checkpoints are untouched
+            with tf.Session(config=tf_config) as sess:
+                sess.run(built['init_op'])
+                cfg.sess = sess
+                return memory_report(placeholders, train_outs, cfg.Dataset,
+                                     cfg.dataset_params)
 
         sv = Supervisor(
             graph=graph,
-            init_op=init_op,
+            init_op=built['init_op'],
             summary_op=None,
             global_step=cfg.global_step,
             logdir=cfg.checkpoints_dir,
@@ -362,20 +549,25 @@ def __run(build_model):
             saver=saver,
             # session_manager
             # summary_writer
-            save_model_secs=300)
+            save_model_secs=300,
+            **built['sv_kwargs'])
         cfg.sv = sv
 
-        with sv.managed_session(cfg.supervisor_master, tf_config) as sess:
+        with sv.managed_session(master, tf_config) as sess:
             cfg.sess = sess
+            if sync_optimizer is not None and cfg.is_chief:
+                # Start aggregating the gradients of the workers
+                sv.start_queue_runners(sess, [built['chief_queue_runner']])
+                sess.run(built['sync_init_op'])
             if cfg.debug:
                 from tensorflow.python import debug as tf_debug
                 sess = tf_debug.LocalCLIDebugWrapperSession(sess)
                 sess.add_tensor_filter("has_inf_or_nan",
                                        tf_debug.has_inf_or_nan)
 
-            if cfg.hyperparams_summaries is not None:
+            if cfg.hyperparams_summaries is not None and cfg.is_chief:
                 # write Hyper parameters text summaries
-                summary_str = cfg.sess.run(sum_text_op)
+                summary_str = cfg.sess.run(built['sum_text_op'])
                 sv.summary_computed(cfg.sess, summary_str)
 
             # Supervisor will always restore if a model is there.
@@ -392,9 +584,10 @@ def __run(build_model):
             if not cfg.do_validation_only:
                 # Start training loop
                 main_loop_kwags = {'placeholders': placeholders,
+                                   'enqueue_ops': enqueue_ops,
                                    'val_placeholders': val_placeholders,
                                    'train_outs': train_outs,
-                                   'train_summary_op': train_summary_op,
+                                   'train_summary_ops': train_summary_ops,
                                    'val_outs': val_outs,
                                    'val_summary_ops': val_summary_ops,
                                    'val_reset_cm_op': val_reset_cm_op,
@@ -409,13 +602,216 @@ def __run(build_model):
                 # Perform validation only
                 mean_iou = {}
                 for s in cfg.val_on_sets:
-                    from validate import validate
                     mean_iou[s] = validate(
                         val_placeholders,
                         val_outs,
                         val_summary_ops[s],
                         val_reset_cm_op,
                         which_set=s)
+                finish_validation()
+
+
+def __build_graphs(build_model, graph):
+    '''Build the training and validation graphs in `graph`
+
+    Return a dict with the placeholders, the fetches and the ops that the
+    session needs to run them (see `graph_cache.GraphCache`).
+    '''
+    cfg = gflags.cfg
+    cfg.global_step = tf.Variable(0, trainable=False, name='global_step',
+                                  dtype='int32')
+    inputs = tf.placeholder(shape=cfg.feed_input_shape,
+                            dtype=cfg.input_dtype, name='inputs')
+    val_inputs = tf.placeholder(shape=cfg.val_input_shape,
+                                dtype=cfg.input_dtype, name='val_inputs')
+    labels = tf.placeholder(shape=[None], dtype=cfg.label_dtype,
+                            name='labels')
+
+    prev_err = tf.placeholder(shape=(),
+                              dtype=cfg._FLOATX, name='prev_err')
+    if cfg.lr_decay is None:
+        lr = cfg.lr
+    elif cfg.lr_decay == 'exp':
+        lr = tf.train.exponential_decay(cfg.lr,
+                                        cfg.global_step,
+                                        cfg.decay_steps,
+                                        cfg.decay_rate,
+                                        staircase=cfg.staircase)
+    elif cfg.lr_decay == 'piecewise':
+        lr = tf.train.piecewise_constant(cfg.global_step,
+                                         cfg.lr_boundaries,
+                                         cfg.lr_values)
+    elif cfg.lr_decay == 'polynomial':
+        lr = tf.train.polynomial_decay(cfg.lr,
+                                       cfg.global_step,
+                                       cfg.decay_steps,
+                                       end_learning_rate=cfg.end_lr,
+                                       power=cfg.power,
+                                       cycle=cfg.staircase)
+
+    elif cfg.lr_decay == 'natural_exp':
+        lr = tf.train.natural_exp_decay(cfg.lr,
+                                        cfg.global_step,
+                                        cfg.decay_steps,
+                                        cfg.decay_rate,
+                                        staircase=cfg.staircase)
+    elif cfg.lr_decay == 'inverse_time':
+        lr = tf.train.inverse_time_decay(cfg.lr,
+                                         cfg.global_step,
+                                         cfg.decay_steps,
+                                         cfg.decay_rate,
+                                         staircase=cfg.staircase)
+    else:
+        raise NotImplementedError()
+
+    cfg.Optimizer = cfg.Optimizer(learning_rate=lr, **cfg.optimizer_params)
+    sync_optimizer = None
+    chief_queue_runner = sync_init_op = None
+    if cfg.job_name == 'worker' and cfg.sync_replicas:
+        # Aggregate the gradients of all the workers at each step
+        nworkers = len(cfg.worker_hosts)
+        sync_optimizer = tf.train.SyncReplicasOptimizer(
+            cfg.Optimizer, replicas_to_aggregate=nworkers,
+            total_num_replicas=nworkers)
+        cfg.Optimizer = sync_optimizer
+
+    # TODO is there another way to split the input in chunks when
+    # batchsize is not a multiple of num_splits?
+    # Split in chunks, the size of each is provided in input_split_dim
+    if cfg.static_tower_split:
+        # The batches are padded to a fixed size and split evenly, the
+        # mask tells apart the samples from the padding
+        sample_mask = tf.placeholder(shape=[None], dtype=cfg._FLOATX,
+                                     name='sample_mask')
+        placeholders = [inputs, labels, sample_mask, prev_err]
+        val_placeholders = [val_inputs, labels, sample_mask]
+    else:
+        inputs_split_dim = tf.placeholder(shape=[cfg.num_splits],
+                                          dtype='int32',
+                                          name='inputs_split_dim')
+        labels_split_dim = tf.placeholder(shape=[cfg.num_splits],
+                                          dtype='int32',
+                                          name='label_split_dim')
+        placeholders = [inputs, labels, inputs_split_dim,
+                        labels_split_dim, prev_err]
+        val_placeholders = [val_inputs, labels, inputs_split_dim,
+                            labels_split_dim]
+
+    # Model parameters on the FIRST device specified in cfg.devides
+    # Gradient Average and the rest on the operations are on CPU
+    with tf.device('/cpu:0'):
+        # Input pipeline
+        # --------------
+        train_placeholders = placeholders
+        enqueue_ops = None
+        if cfg.input_mode == 'queue':
+            # A feeder thread enqueues the batches fed to the
+            # placeholders, the training graph dequeues them directly
+            in_placeholders = placeholders[:-1]
+            input_queue = tf.FIFOQueue(
+                capacity=max(1, cfg.prefetch_depth),
+                dtypes=[p.dtype for p in in_placeholders],
+                name='input_queue')
+            enqueue_op = input_queue.enqueue(in_placeholders)
+            close_op = input_queue.close(cancel_pending_enqueues=True)
+            enqueue_ops = (in_placeholders, enqueue_op, close_op,
+                           input_queue.size())
+            train_placeholders = input_queue.dequeue()
+            for p, t in zip(in_placeholders, train_placeholders):
+                t.set_shape(p.get_shape())
+            train_placeholders.append(prev_err)
+        elif cfg.input_mode != 'feed_dict':
+            raise NotImplementedError('Unknown input mode: {}'.format(
+                cfg.input_mode))
+
+        # Model compilation
+        # -----------------
+        t_build = time()
+        train_outs, train_summary_ops, train_reset_cm_op = build_graph(
+            train_placeholders, cfg.input_shape, build_model, True)
+
+        cfg.val_feed_dict = {}
+        if cfg.val_graph == 'shared':
+            # Evaluate with the training towers in inference mode
+            val_outs = cfg.shared_val_graph['outs']
+            val_summary_ops = cfg.shared_val_graph['summary_ops']
+            val_reset_cm_op = cfg.shared_val_graph['reset_cm_op']
+            val_placeholders = placeholders[:-1]
+            cfg.val_feed_dict = {
+                cfg.shared_val_graph['is_training']: False}
+        else:
+            val_outs, val_summary_ops, val_reset_cm_op = build_graph(
+                val_placeholders, cfg.val_input_shape, build_model,
+                False)
+        t_build = time() - t_build
+        graph_def_bytes = graph.as_graph_def().ByteSize()
+        tf.logging.info('Model built in {:.2f}s: {} nodes, {:.2f} MB '
+                        '({} validation graph)'.format(
+                            t_build, len(graph.get_operations()),
+                            graph_def_bytes / 1024. ** 2,
+                            cfg.val_graph))
+        sum_text_op = None
+        if cfg.hyperparams_summaries is not None:
+            sum_text = []
+            for (key_header,
+                 list_value) in cfg.hyperparams_summaries.iteritems():
+
+                header_list = []
+                text_list = []
+                for v in list_value:
+                    header_list.append('**'+v+'**')
+                    text_list.append(str(getattr(cfg, v)))
+                header_tensor = tf.constant(header_list)
+                text_tensor = tf.constant(text_list)
+
+                sum_text.append(tf.summary.text(
+                    key_header, tf.reshape(
+                        tf.concat([header_tensor, text_tensor], axis=0),
+                        [2, -1])))
+            sum_text_op = tf.summary.merge(sum_text)
+
+        sv_kwargs = {}
+        if cfg.job_name == 'worker':
+            # The chief initializes the variables, each worker its own
+            # local variables
+            init_op = tf.global_variables_initializer()
+            local_init_op = tf.local_variables_initializer()
+            if sync_optimizer is not None:
+                with tf.control_dependencies([local_init_op]):
+                    local_init_op = tf.group(
+                        sync_optimizer.chief_init_op if cfg.is_chief
+                        else sync_optimizer.local_step_init_op)
+                chief_queue_runner = (
+                    sync_optimizer.get_chief_queue_runner())
+                sync_init_op = sync_optimizer.get_init_tokens_op()
+            sv_kwargs = {'is_chief': cfg.is_chief,
+                         'local_init_op': local_init_op,
+                         'recovery_wait_secs': 1}
+        else:
+            # Group global and local init into one op. Could be split
+            # into two different ops and passed to `init_op` and
+            # `local_init_op`
+            init_op = tf.group(tf.global_variables_initializer(),
+                               tf.local_variables_initializer())
+        saver = tf.train.Saver(max_to_keep=cfg.checkpoints_to_keep)
+
+    return {'global_step': cfg.global_step,
+            'placeholders': placeholders,
+            'val_placeholders': val_placeholders,
+            'enqueue_ops': enqueue_ops,
+            'train_outs': train_outs,
+            'train_summary_ops': train_summary_ops,
+            'val_outs': val_outs,
+            'val_summary_ops': val_summary_ops,
+            'val_reset_cm_op': val_reset_cm_op,
+            'val_feed_dict': list(cfg.val_feed_dict.items()),
+            'sum_text_op': sum_text_op,
+            'init_op': init_op,
+            'saver': saver,
+            'sv_kwargs': sv_kwargs,
+            'sync_optimizer': sync_optimizer,
+            'chief_queue_runner': chief_queue_runner,
+            'sync_init_op': sync_init_op}
 
 
 def build_graph(placeholders, input_shape, build_model, is_training):
@@ -426,40 +822,102 @@ def build_graph(placeholders, input_shape, build_model, is_training):
     devices = cfg.devices
     nclasses = cfg.nclasses
     global_step = cfg.global_step
-    if is_training:
-        [inputs, labels, input_split_dim,
-         labels_split_dim, prev_err] = placeholders
+    if cfg.static_tower_split:
+        inputs, labels, sample_mask = placeholders[:3]
     else:
-        [inputs, labels, input_split_dim, labels_split_dim] = placeholders
+        inputs, labels, input_split_dim, labels_split_dim = placeholders[:4]
+    if is_training:
+        prev_err = placeholders[-1]
+
+    # The mask of the pixels padded by the augmentation, when the dataset
+    # has no void label to mark them
+    pad_mask = None
+    if is_training and cfg.graph_augmentation:
+        if len(cfg.void_labels):
+            inputs, labels, labels_per_sample = augment_batch(
+                inputs, labels, cfg.crop_size, cfg.random_flip,
+                cfg.scale_range, cfg.void_labels[0])
+        else:
+            inputs, labels, labels_per_sample, pad_mask = augment_batch(
+                inputs, labels, cfg.crop_size, cfg.random_flip,
+                cfg.scale_range, return_pixel_mask=True)
+        if not cfg.static_tower_split:
+            labels_split_dim = input_split_dim * labels_per_sample
+
+    if cfg.uint8_inputs:
+        # Normalize on device rather than on the host
+        inputs = normalize_inputs(inputs, getattr(cfg.Dataset, 'mean', None),
+                                  getattr(cfg.Dataset, 'std', None),
+                                  cfg.BaseDataset.data_shape[-1])
+        labels = tf.cast(labels, 'int32')
 
     # Split the input among the GPUs (batchwise)
-    inputs_per_gpu = tf.split(inputs, input_split_dim, 0)
-    labels_per_gpu = tf.split(labels, labels_split_dim, 0)
+    if cfg.static_tower_split:
+        # Every device gets the same, static, number of samples
+        input_shape = ([cfg.batch_size if is_training else
+                        cfg.val_batch_size] + list(input_shape[1:]))
+        inputs_per_gpu = tf.split(inputs, cfg.num_splits, 0)
+        labels_per_gpu = tf.split(labels, cfg.num_splits, 0)
+        masks_per_gpu = tf.split(sample_mask, cfg.num_splits, 0)
+        pad_masks_per_gpu = ([None] * cfg.num_splits if pad_mask is None
+                             else tf.split(pad_mask, cfg.num_splits, 0))
+    else:
+        inputs_per_gpu = tf.split(inputs, input_split_dim, 0)
+        labels_per_gpu = tf.split(labels, labels_split_dim, 0)
+        masks_per_gpu = [None] * cfg.num_splits
+        pad_masks_per_gpu = ([None] * cfg.num_splits if pad_mask is None
+                             else tf.split(pad_mask, labels_split_dim, 0))
     for gpu_input in inputs_per_gpu:
         gpu_input.set_shape(input_shape)
 
+    # With val_graph shared, the training towers also serve the validation,
+    # in inference mode when the is_training tensor is fed False
+    model_is_training = is_training
+    shared_val = is_training and cfg.val_graph == 'shared'
+    if shared_val:
+        model_is_training = tf.placeholder_with_default(True, [],
+                                                        name='is_training')
+
     # Init variables
     tower_grads = []
     tower_preds = []
     tower_soft_preds = []
     tower_losses = []
+    tower_val_losses = []
     summaries = {}
     if is_training:
         summaries['training'] = tf.get_collection_ref(key='train_summaries')
+        summaries_norms = tf.get_collection_ref(key='train_norm_summaries')
+        summaries_histograms = tf.get_collection_ref(
+            key='train_histogram_summaries')
     else:
         for k in cfg.val_on_sets:
             summaries[k] = tf.get_collection_ref(key='val_' + k + '_summaries')
     tower_suffix = 'train' if is_training else 'val'
 
+    # The L2 penalty is the same for every tower: it is computed once and
+    # its gradient is added to the averaged gradients, unless the
+    # gradients of each tower are processed (noise, multipliers, clipping).
+    # As when it was added to the loss of each pixel, it is scaled by the
+    # ratio of pixels to unmasked pixels of each tower (see
+    # `l2_penalty_scale`), averaged over the towers
+    decay = is_training and bool(weight_decay)
+    penalty_scales = []
+    decay_per_tower = decay and cfg.accumulate_steps == 1 and (
+        cfg.grad_noise_scale is not None or
+        cfg.grad_multiplier is not None or
+        cfg.max_grad_norm is not None)
+
     # inputs_per_gpu, labels_per_gpu are lists
-    for dev_idx, (dev_inputs, dev_labels) in enumerate(zip(inputs_per_gpu,
-                                                           labels_per_gpu)):
+    for dev_idx, (dev_inputs, dev_labels, dev_mask, dev_pad_mask) in \
+            enumerate(zip(inputs_per_gpu, labels_per_gpu, masks_per_gpu,
+                          pad_masks_per_gpu)):
         with tf.device(devices[dev_idx]):
             reuse_variables = not is_training or dev_idx > 0
             with tf.name_scope('GPU{}_{}'.format(dev_idx, tower_suffix)):
                 with tf.variable_scope(cfg.model_name, reuse=reuse_variables):
 
-                    net_out = build_model(dev_inputs, is_training)
+                    net_out = build_model(dev_inputs, model_is_training)
                     softmax_pred = slim.softmax(net_out)
                     tower_soft_preds.append(softmax_pred)
 
@@ -474,20 +932,64 @@ def build_graph(placeholders, input_shape, build_model, is_training):
                     if (loss_fn is not
                             tf.nn.sparse_softmax_cross_entropy_with_logits):
                         net_out = softmax_pred
+                    pixel_mask = None
+                    if dev_mask is not None:
+                        pixel_mask = expand_sample_mask(dev_mask, dev_labels)
+                    if dev_pad_mask is not None:
+                        dev_pad_mask = tf.cast(dev_pad_mask, cfg._FLOATX)
+                        pixel_mask = (dev_pad_mask if pixel_mask is None
+                                      else pixel_mask * dev_pad_mask)
                     loss = apply_loss(dev_labels, net_out, loss_fn,
                                       weight_decay, is_training,
-                                      return_mean_loss=True)
-                    tower_losses.append(loss)
+                                      return_mean_loss=True,
+                                      class_weights=(cfg.class_weights
+                                                     if is_training
+                                                     else None),
+                                      pixel_mask=pixel_mask,
+                                      add_l2_penalty=False)
                     # Save this GPU's loss summary
                     for k, s in summaries.iteritems():
                         s.append(tf.summary.scalar('Loss', loss))
+                    tower_weight = None
+                    if dev_mask is not None:
+                        # Weight the towers by their number of samples, so
+                        # that the padding does not dilute the loss and the
+                        # averaged gradients
+                        tower_weight = (
+                            tf.reduce_sum(dev_mask) * cfg.num_splits /
+                            tf.maximum(tf.reduce_sum(sample_mask), 1.))
+                        loss *= tower_weight
+                    tower_losses.append(loss)
+                    if decay:
+                        penalty_scale = l2_penalty_scale(dev_labels,
+                                                         pixel_mask)
+                        if tower_weight is not None:
+                            penalty_scale *= tower_weight
+                        penalty_scales.append(penalty_scale)
+                    if shared_val:
+                        # The validation loss, without the L2 penalty and
+                        # the class balance
+                        val_loss = apply_loss(dev_labels, net_out, loss_fn,
+                                              weight_decay, False,
+                                              return_mean_loss=True,
+                                              pixel_mask=pixel_mask)
+                        if tower_weight is not None:
+                            val_loss *= tower_weight
+                        tower_val_losses.append(val_loss)
 
                     # Gradients
                     if is_training:
 
                         # 1) Compute gradients
-                        grads = optimizer.compute_gradients(
-                             loss, colocate_gradients_with_ops=True)
+                        if cfg.recompute:
+                            # Recompute the activations in the backward
+                            # pass rather than keeping them in memory
+                            grads = recompute.compute_gradients(
+                                loss, checkpoints=cfg.recompute,
+                                colocate_gradients_with_ops=True)
+                        else:
+                            grads = optimizer.compute_gradients(
+                                 loss, colocate_gradients_with_ops=True)
 
                         # 2) Process gradients, average them later
 
@@ -531,36 +1033,17 @@ def build_graph(placeholders, input_shape, build_model, is_training):
 
                         else:
                             raise NotImplementedError()
-                        grads = process_gradients(grads,
-                                                  grad_noise_scale,
-                                                  cfg.grad_multiplier,
-                                                  cfg.max_grad_norm)
+                        if cfg.accumulate_steps == 1:
+                            if decay_per_tower:
+                                grads = add_weight_decay(
+                                    grads, weight_decay * penalty_scale)
+                            grads = process_gradients(grads,
+                                                      grad_noise_scale,
+                                                      cfg.grad_multiplier,
+                                                      cfg.max_grad_norm)
 
             if is_training:
 
-                # Add histograms for variables, grads and grad norms.
-                for gradient, variable in grads:
-                    if isinstance(gradient, tf.IndexedSlices):
-                        grad_values = gradient.values
-                    else:
-                        grad_values = gradient
-
-                    if grad_values is not None:
-                        var_name = variable.name.replace(":", "_")
-                        var_name = var_name.replace(
-                            cfg.model_name+"/", "")
-                        if cfg.group_summaries and var_name.count('/') >= 2:
-                            var_name = var_name.replace("/", "_", 1)
-                        summaries["training"].append(
-                            tf.summary.histogram("Tower%d_Gradients_%s" %
-                                                 (dev_idx, var_name),
-                                                 grad_values))
-
-                        summaries["training"].append(
-                            tf.summary.scalar("Tower%d_GradientNorm_%s" %
-                                              (dev_idx, var_name),
-                                              tf.global_norm([grad_values])))
-
                 summaries["training"].append(
                     tf.summary.scalar("Tower%d_Global_norm/clipped_grad_norm" %
                                       dev_idx,
@@ -569,11 +1052,6 @@ def build_graph(placeholders, input_shape, build_model, is_training):
                 # Save gradients for each gpu to be averaged out
                 tower_grads.append(grads)
 
-            # Print regularization
-            for v in tf.get_collection(
-                    tf.GraphKeys.REGULARIZATION_LOSSES):
-                tf.logging.debug('Regularization losses:\n{}'.format(v))
-
     # Convert from list of tensors to tensor, and average
     preds = tf.concat(tower_preds, axis=0)
     softmax_preds = tf.concat(tower_soft_preds, axis=0)
@@ -583,20 +1061,78 @@ def build_graph(placeholders, input_shape, build_model, is_training):
     mask = tf.ones_like(labels)
     if len(cfg.void_labels):
         mask = tf.cast(tf.less_equal(labels, nclasses), tf.int32)
+    if cfg.static_tower_split:
+        mask *= tf.cast(expand_sample_mask(sample_mask, labels), mask.dtype)
+    if pad_mask is not None:
+        mask *= tf.cast(pad_mask, mask.dtype)
     preds_flat = tf.reshape(preds, [-1])
     m_iou, per_class_iou, cm_update_op, reset_cm_op = compute_mean_iou(
         labels, preds_flat, nclasses, mask)
     # Compute the average *per variable* across the towers
     avg_tower_loss = tf.reduce_mean(tower_losses)
+    if decay:
+        # The weight decay of the averaged gradients
+        weight_decay *= tf.reduce_mean(penalty_scales)
+        penalty = weight_decay * l2_penalty()
+        summaries['training'].append(tf.summary.scalar('L2_penalty',
+                                                       penalty))
+        avg_tower_loss += penalty
+
+    # Print regularization
+    for v in tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES):
+        tf.logging.debug('Regularization losses:\n{}'.format(v))
 
     if is_training:
         # Impose graph dependency so that update operations are computed
         # even if they're are not explicit in the outputs os session.run
-        grads_and_vars = average_gradients(tower_grads)
+        grads_and_vars = average_gradients(tower_grads, cfg.tower_groups,
+                                           cfg.grad_bucket_mb)
+        if decay and not decay_per_tower and cfg.accumulate_steps == 1:
+            grads_and_vars = add_weight_decay(grads_and_vars, weight_decay)
+        # The histograms and the norms of the averaged gradients, rather
+        # than of the gradients of each tower
+        for gradient, variable in grads_and_vars:
+            if isinstance(gradient, tf.IndexedSlices):
+                grad_values = gradient.values
+            else:
+                grad_values = gradient
+            if grad_values is None:
+                continue
+            var_name = variable.name.replace(":", "_")
+            var_name = var_name.replace(cfg.model_name+"/", "")
+            if cfg.group_summaries and var_name.count('/') >= 2:
+                var_name = var_name.replace("/", "_", 1)
+            summaries_norms.append(
+                tf.summary.scalar("GradientNorm_%s" % var_name,
+                                  tf.global_norm([grad_values])))
+            summaries_histograms.append(
+                tf.summary.histogram("Gradients_%s" % var_name,
+                                     grad_values))
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        if cfg.accumulate_steps > 1:
+            # Accumulate the gradients (and run the update ops) at each
+            # step, process and apply them once every accumulate_steps
+            accum_op, grads_and_vars, accumulators = accumulate_gradients(
+                grads_and_vars)
+            accum_op = tf.group(accum_op, *update_ops)
+            update_ops = [accum_op]
+            if decay:
+                # The variables do not change while accumulating. The
+                # penalty is scaled as for the batch of the last step
+                grads_and_vars = add_weight_decay(grads_and_vars,
+                                                  weight_decay)
+            grads_and_vars = process_gradients(grads_and_vars,
+                                               grad_noise_scale,
+                                               cfg.grad_multiplier,
+                                               cfg.max_grad_norm)
         with tf.control_dependencies(update_ops):
             train_op = optimizer.apply_gradients(grads_and_vars=grads_and_vars,
                                                  global_step=global_step)
+        if cfg.accumulate_steps > 1:
+            # Reset the accumulators once the gradients are applied
+            with tf.control_dependencies([train_op]):
+                train_op = tf.group(*[tf.assign(a, tf.zeros_like(a))
+                                      for a in accumulators])
         # TODO: Averaged gradients visualisation
         # Add the histograms of the gradients
         # with tf.name_scope('grad_summaries'):
@@ -618,7 +1154,8 @@ def build_graph(placeholders, input_shape, build_model, is_training):
             if cfg.group_summaries and var_name.count('/') >= 2:
                 var_name = var_name.replace("/", "_", 1)
             var_name = 'Variables_' + var_name
-            summaries['training'].append(tf.summary.histogram(var_name, var))
+            summaries_histograms.append(tf.summary.histogram(var_name,
+                                                             var))
 
     # Trainining or Validation summaries
     with tf.name_scope('summaries_{}'.format(tower_suffix)):
@@ -633,22 +1170,189 @@ def build_graph(placeholders, input_shape, build_model, is_training):
         # gradients, the trainable variables and the activations.
 
         if is_training:
-            train_summary_op = tf.summary.merge(summaries['training'])
+            # Each tier of summaries is merged in its own op, fetched with
+            # its own frequency
+            train_summary_ops = {
+                'scalars': tf.summary.merge(summaries['training'])}
+            freqs = train_summary_freqs()
+            for tier, s in [('norms', summaries_norms),
+                            ('histograms', summaries_histograms)]:
+                if freqs[tier] > 0 and s:
+                    train_summary_ops[tier] = tf.summary.merge(s)
+            if shared_val:
+                avg_val_loss = tf.reduce_mean(tower_val_losses)
+                val_summary_ops = {}
+                for k in cfg.val_on_sets:
+                    val_summary_ops[k] = tf.summary.merge([
+                        tf.summary.scalar('Mean_tower_loss_' + k,
+                                          avg_val_loss)])
+                cfg.shared_val_graph = {
+                    'is_training': model_is_training,
+                    'outs': [preds, softmax_preds, m_iou, per_class_iou,
+                             avg_val_loss, cm_update_op],
+                    'summary_ops': val_summary_ops,
+                    'reset_cm_op': reset_cm_op}
         else:
             val_summary_ops = {}
             for k, s in summaries.iteritems():
                 val_summary_ops[k] = tf.summary.merge(s)
 
     if is_training:
-        return [avg_tower_loss, train_op], train_summary_op, reset_cm_op
+        train_outs = [avg_tower_loss, train_op]
+        if cfg.accumulate_steps > 1:
+            train_outs.append(accum_op)
+        return train_outs, train_summary_ops, reset_cm_op
     else:
         return ([preds, softmax_preds, m_iou, per_class_iou, avg_tower_loss,
                  cm_update_op], val_summary_ops, reset_cm_op)
 
 
-def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
-              val_outs, val_summary_ops, val_reset_cm_op, loss_fn, Dataset,
-              dataset_params, valid_params, sv, saver):
+def prepare_batch(minibatch, npixels, batch_size=None):
+    '''Convert a minibatch of the dataset into the values to be fed
+
+    Return the inputs, the flattened labels and the size of the chunk of
+    inputs and labels of each device or, with `static_tower_split`, the
+    inputs and the flattened labels padded to the full batch size (i.e.,
+    `batch_size`, `cfg.batch_size` by default, per device) and the mask of
+    the samples.
+    '''
+    cfg = gflags.cfg
+    batch_size = batch_size or cfg.batch_size
+    x_batch, y_batch = minibatch['data'], minibatch['labels']
+    # sh = inputs.shape  # do NOT provide a list of shapes
+    x_in = np.asarray(x_batch, dtype=cfg.input_dtype)
+    y_in = y_batch.astype(cfg.label_dtype)
+    if cfg.static_tower_split:
+        x_in, y_in, sample_mask = pad_batch(x_in, y_in, batch_size *
+                                            cfg.num_splits)
+        return x_in, y_in.ravel(), sample_mask
+    y_in = y_in.ravel()
+
+    # TODO evaluate if it's possible to pass num_splits inputs in
+    # a list, rather than the input as a whole and the shape of
+    # the splits as a tensor.
+    split_dim, labels_split_dim = compute_chunk_size(x_batch.shape[0],
+                                                     npixels)
+    return x_in, y_in, split_dim, labels_split_dim
+
+
+def memory_report(placeholders, train_outs, Dataset, dataset_params):
+    '''Measure the peak memory of the training steps
+
+    Runs `memory_report_steps` traced training steps with two batch sizes
+    (the configured one and half of it) and reports the peak memory of
+    each device, the largest ops, the memory of the host process and the
+    largest batch size that fits `memory_budget_mb` (the memory of the
+    host by default). The report is logged and saved in the checkpoints
+    directory. The steps update the variables of `cfg.sess`, which should
+    be a throwaway session.
+    '''
+    cfg = gflags.cfg
+    params = deepcopy(dataset_params)
+    params['batch_size'] *= cfg.num_splits
+    rss_start = rss_bytes()
+    train = Dataset(which_set='train', return_list=False, **params)
+    minibatch = train.next()
+    rss_loader = rss_bytes() - rss_start
+    npixels = np.prod(train.data_shape[:2])
+    train.finish()
+
+    batch_size = cfg.batch_size
+    batch_sizes = ([max(1, batch_size // 2), batch_size] if batch_size > 1
+                   else [1, 2])
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    steps = {}
+    device_peaks = {}
+    for b in batch_sizes:
+        # Repeat the samples if the batch is larger than the minibatch
+        idx = np.arange(b * cfg.num_splits) % len(minibatch['data'])
+        sub_batch = {'data': minibatch['data'][idx],
+                     'labels': minibatch['labels'][idx]}
+        batch = prepare_batch(sub_batch, npixels, b)
+        in_values = list(batch) + [1.]
+        feed_dict = {p: v for (p, v) in zip(placeholders, in_values)}
+        step = None
+        for _ in range(max(1, cfg.memory_report_steps)):
+            run_metadata = tf.RunMetadata()
+            cfg.sess.run(train_outs[:2], feed_dict=feed_dict,
+                         options=options, run_metadata=run_metadata)
+            mem = step_memory(run_metadata, cfg.devices)
+            for d, m in mem['devices'].iteritems():
+                peaks = device_peaks.setdefault(d, {})
+                peaks[b] = max(peaks.get(b, 0), m['peak_bytes'])
+            peak = max([0] + [d['peak_bytes']
+                              for d in mem['devices'].values()])
+            if step is None or peak > step['peak_bytes']:
+                step = dict(mem, peak_bytes=peak)
+        steps[b] = step
+
+    budget = cfg.memory_budget_mb * 1024 ** 2 or host_memory_bytes()
+    if not cfg.memory_budget_mb and any(
+            'gpu' in d.lower() for d in cfg.devices):
+        tf.logging.warning('The memory of the GPUs is not known, set '
+                           '--memory_budget_mb to forecast the batch size')
+    # Forecast on each device measured with every batch size
+    max_batch_size = forecast_batch_size(
+        batch_sizes, {d: [peaks[b] for b in batch_sizes]
+                      for d, peaks in device_peaks.iteritems()
+                      if len(peaks) == len(batch_sizes)}, budget)
+
+    # The validation threads keep up to IMG_QUEUE_SIZE batches of inputs,
+    # raw inputs, labels, predictions and softmax predictions
+    x_in, y_in = minibatch['data'], minibatch['labels']
+    sample_bytes = (2 * x_in.nbytes + y_in.nbytes) / float(len(x_in))
+    sample_bytes += y_in[0].size * (8 + 4 * cfg.nclasses)
+    img_queue_bytes = int(IMG_QUEUE_SIZE * sample_bytes *
+                          cfg.val_batch_size * cfg.num_splits)
+
+    report = {'hash': cfg.hash,
+              'devices': cfg.devices,
+              'batch_size': batch_size,
+              'steps': {str(b): s for b, s in steps.iteritems()},
+              'budget_bytes': budget,
+              'max_batch_size': max_batch_size,
+              'host': {'rss_bytes': rss_bytes(),
+                       'peak_rss_bytes': peak_rss_bytes(),
+                       'loader_bytes': rss_loader,
+                       'img_queue_bytes_estimate': img_queue_bytes}}
+    mb = 1024. ** 2
+    for b in batch_sizes:
+        tf.logging.info('Batch size {}: peak {:.1f} MB ({})'.format(
+            b, steps[b]['peak_bytes'] / mb, ', '.join(
+                '{} {:.1f} MB'.format(d, s['peak_bytes'] / mb)
+                for d, s in sorted(steps[b]['devices'].iteritems()))))
+    for op in steps[batch_size]['top_ops']:
+        tf.logging.info('  {:.1f} MB {} ({})'.format(
+            op['output_bytes'] / mb, op['op'], op['device']))
+    tf.logging.info('Host: RSS {:.1f} MB (peak {:.1f} MB), loader {:.1f} MB, '
+                    'validation image queue ~{:.1f} MB'.format(
+                        report['host']['rss_bytes'] / mb,
+                        report['host']['peak_rss_bytes'] / mb,
+                        rss_loader / mb, img_queue_bytes / mb))
+    tf.logging.info('Largest batch size (per device) within {:.0f} MB: '
+                    '{}'.format(budget / mb, max_batch_size))
+    tf.logging.info('Memory report saved in {}'.format(
+        save_report(report, cfg.checkpoints_dir)))
+    return report
+
+
+def train_summary_freqs():
+    '''Return the frequency (in steps) of each tier of training summaries
+
+    The scalars (losses, global norms) are cheap, the per variable norms of
+    the gradients and the histograms of the gradients and of the variables
+    are not. 0 disables a tier (but the scalars).
+    '''
+    cfg = gflags.cfg
+    return {'scalars': max(1, cfg.train_summary_freq),
+            'norms': cfg.train_norms_summary_freq,
+            'histograms': cfg.train_histograms_summary_freq}
+
+
+def main_loop(placeholders, val_placeholders, train_outs,
+              train_summary_ops, val_outs, val_summary_ops, val_reset_cm_op,
+              loss_fn, Dataset, dataset_params, valid_params, sv, saver,
+              enqueue_ops=None):
 
     # Add TqdmHandler
     handler = TqdmHandler()
@@ -669,7 +1373,6 @@ def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
         **dataset_params)
 
     # Setup loop parameters
-    cum_iter = sv.global_step.eval(cfg.sess)
     val_skip = cfg.val_skip
     patience_counter = 0
     estop = False
@@ -684,78 +1387,174 @@ def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
     if pygtk and cfg.debug_of:
         cv2.namedWindow("rgb-optflow")
 
+    # Prepare the next batches in background while the current one is
+    # being processed
+    npixels = np.prod(train.data_shape[:2])
+    prefetcher = None
+    if enqueue_ops is not None:
+        # The graph dequeues the batches from the input queue
+        prefetcher = QueueFeeder(train, partial(prepare_batch,
+                                                npixels=npixels),
+                                 sv.coord, cfg.sess, *enqueue_ops).start()
+    elif cfg.prefetch_depth:
+        prefetcher = Prefetcher(train, partial(prepare_batch,
+                                               npixels=npixels),
+                                cfg.prefetch_depth, sv.coord).start()
+
+    # With accumulate_steps, the variables are updated (and global_step
+    # incremented) every accumulate_steps batches and at the end of the epoch
+    steps_per_epoch = -(-train.nbatches // cfg.accumulate_steps)  # ceil
+    # global_step counts the steps of the epochs of every worker in
+    # asynchronous mode, each worker training on its own shard
+    global_steps_per_epoch = steps_per_epoch
+    if cfg.job_name == 'worker' and not cfg.sync_replicas:
+        global_steps_per_epoch *= max(1, len(cfg.worker_hosts))
+    summary_freqs = train_summary_freqs()
+    timer = StepTimer()
+    max_steps_reached = False
+    t_data_load = None
+
+    def describe():
+        postfix = {'loss': '{:.3f}'.format(loss_value)}
+        if t_data_load is not None:
+            postfix['D'] = '{:.2f}s'.format(t_data_load)
+        return '({:3d}) Ep {:d}'.format(cum_iter, epoch_id + 1), postfix
+
     while not sv.should_stop():
-        epoch_id = cum_iter // train.nbatches
-        pbar = tqdm(total=train.nbatches,
-                    bar_format='{n_fmt}/{total_fmt}{desc}'
-                               '{percentage:3.0f}%|{bar}| '
-                               '[{elapsed}<{remaining},'
-                               '{rate_fmt}{postfix}]')
+        # The step is counted on the host and read from the graph only at
+        # the beginning of the epochs and on the summary steps (the other
+        # workers also increment it)
+        cum_iter = sv.global_step.eval(cfg.sess)
+        epoch_id = cum_iter // global_steps_per_epoch
+        pbar = ThrottledProgress(cfg.progress_secs,
+                                 total=train.nbatches,
+                                 bar_format='{n_fmt}/{total_fmt}{desc}'
+                                            '{percentage:3.0f}%|{bar}| '
+                                            '[{elapsed}<{remaining},'
+                                            '{rate_fmt}{postfix}]')
+        epoch_start = time()
+        epoch_steps = 0
 
         for batch_id in range(train.nbatches):
-            cum_iter = sv.global_step.eval(cfg.sess)
-            iter_start = time()
-
-            # inputs and labels
-            minibatch = train.next()
-            t_data_load = time() - iter_start
-            x_batch, y_batch = minibatch['data'], minibatch['labels']
-            # sh = inputs.shape  # do NOT provide a list of shapes
-            x_in = x_batch
-            y_in = y_batch.flatten()
-            if pygtk and cfg.debug_of:
-                for x_b in x_in:
-                    for x_frame in x_b:
-                        rgb_of_frame = np.concatenate(
-                            [x_frame[..., :3], x_frame[..., 3:]],
-                            axis=1).astype(np.float32)
-                        rgb_of_frame = cv2.cvtColor(rgb_of_frame,
-                                                    cv2.COLOR_RGB2BGR)
-                        cv2.imshow("rgb-optflow", rgb_of_frame)
-                        cv2.waitKey(100)
-            # reset_states(model, sh)
-
-            # TODO evaluate if it's possible to pass num_splits inputs in
-            # a list, rather than the input as a whole and the shape of
-            # the splits as a tensor.
-
-            split_dim, labels_split_dim = compute_chunk_size(
-                x_batch.shape[0], np.prod(train.data_shape[:2]))
-
-            # Create dictionary to feed the input placeholders
-            # placeholders = [inputs, labels, which_set,
-            #                 input_split_dim, labels_split_dim]
+            timer.start()
 
             # Do not add noise if loss is less than threshold
             # TODO: It should be IoU or any other metric, but in this
             # case our loss is Dice Coefficient so it's fine
             loss_value = -1.0 if loss_value < -cfg.thresh_loss else loss_value
-            in_values = [x_in, y_in, split_dim, labels_split_dim,
-                         1 + loss_value]
-            feed_dict = {p: v for (p, v) in zip(placeholders, in_values)}
 
-            # train_op does not return anything, but must be in the
-            # outputs to update the gradient
-            if cum_iter % cfg.train_summary_freq == 0:
-                loss_value, _, summary_str = cfg.sess.run(
-                    train_outs + [train_summary_op],
-                    feed_dict=feed_dict)
-                sv.summary_computed(cfg.sess, summary_str)
+            if enqueue_ops is not None:
+                # Only the previous error has to be fed, the inputs are
+                # dequeued by the graph. Wait for them here, so that the
+                # dequeue does not charge the wait to 'run'
+                if not prefetcher.wait():  # Stop requested
+                    break
+                timer.lap('data')
+                t_data_load = timer.current['data']
+                feed_dict = {placeholders[-1]: 1 + loss_value}
             else:
-                loss_value, _ = cfg.sess.run(train_outs, feed_dict=feed_dict)
+                # inputs and labels
+                if prefetcher is not None:
+                    batch = prefetcher.next()
+                    if batch is None:  # Stop requested
+                        break
+                else:
+                    batch = prepare_batch(train.next(), npixels)
+                timer.lap('data')
+                t_data_load = timer.current['data']
+                x_in = batch[0]
+                if pygtk and cfg.debug_of:
+                    for x_b in x_in:
+                        for x_frame in x_b:
+                            rgb_of_frame = np.concatenate(
+                                [x_frame[..., :3], x_frame[..., 3:]],
+                                axis=1).astype(np.float32)
+                            rgb_of_frame = cv2.cvtColor(rgb_of_frame,
+                                                        cv2.COLOR_RGB2BGR)
+                            cv2.imshow("rgb-optflow", rgb_of_frame)
+                            cv2.waitKey(100)
+                # reset_states(model, sh)
+
+                # Create dictionary to feed the input placeholders
+                # placeholders = [inputs, labels, input_split_dim,
+                #                 labels_split_dim, prev_err]
+                # or [inputs, labels, sample_mask, prev_err]
+                in_values = list(batch) + [1 + loss_value]
+                feed_dict = {p: v for (p, v) in zip(placeholders, in_values)}
+            timer.lap('feed')
 
-            pbar.set_description('({:3d}) Ep {:d}'.format(cum_iter+1,
-                                                          epoch_id+1))
-            pbar.set_postfix({'D': '{:.2f}s'.format(t_data_load),
-                              'loss': '{:.3f}'.format(loss_value)})
-            pbar.update(1)
+            # train_op does not return anything, but must be in the
+            # outputs to update the gradient. With accumulate_steps, the
+            # other steps only accumulate the gradients
+            apply_step = ((batch_id + 1) % cfg.accumulate_steps == 0 or
+                          batch_id == train.nbatches - 1)
+            step_outs = (train_outs[:2] if apply_step else
+                         [train_outs[0], train_outs[-1]])
+            # Fetch the tiers of summaries due at this step
+            summary_ops = []
+            if apply_step and cfg.is_chief:
+                summary_ops = [op for tier, op in
+                               sorted(train_summary_ops.iteritems())
+                               if cum_iter % summary_freqs[tier] == 0]
+            # Trace a step every trace_every_steps
+            run_kwargs = {}
+            trace = (apply_step and cfg.is_chief and cfg.trace_every_steps and
+                     cum_iter % cfg.trace_every_steps == 0)
+            if trace:
+                run_kwargs = {'options': tf.RunOptions(
+                                  trace_level=tf.RunOptions.FULL_TRACE),
+                              'run_metadata': tf.RunMetadata()}
+            try:
+                outs = cfg.sess.run(step_outs + summary_ops,
+                                    feed_dict=feed_dict, **run_kwargs)
+            except tf.errors.OutOfRangeError:
+                # The input queue has been closed
+                break
+            timer.lap('run')
+            loss_value = outs[0]
+            if apply_step:
+                cum_iter += 1
+            if trace:
+                save_chrome_trace(run_kwargs['run_metadata'], os.path.join(
+                    cfg.train_checkpoints_dir,
+                    'timeline_{}.json'.format(cum_iter)))
+            if summary_ops:
+                cum_iter = sv.global_step.eval(cfg.sess)
+                for summary_str in outs[len(step_outs):]:
+                    sv.summary_computed(cfg.sess, summary_str,
+                                        global_step=cum_iter)
+                sv.summary_computed(cfg.sess, timer.summary(),
+                                    global_step=cum_iter)
+                timer.lap('summary')
+            # The traced steps are slower, do not count them
+            timer.end(record=not trace)
+            epoch_steps += 1
+            pbar.update(describe)
+            if cfg.max_steps and cum_iter >= cfg.max_steps:
+                max_steps_reached = True
+                break
 
         # It's the end of the epoch
-        pbar.close()
+        pbar.close(describe)
+        epoch_time = time() - epoch_start
+        cfg.train_throughput = {
+            'input_mode': cfg.input_mode,
+            'steps': epoch_steps,
+            'secs': epoch_time,
+            'steps_per_sec': epoch_steps / max(epoch_time, 1e-8),
+            'step_secs_percentiles': timer.percentiles().get('step')}
+        tf.logging.info('Epoch {}: {:.2f} steps/s ({} input mode)'.format(
+            epoch_id + 1, cfg.train_throughput['steps_per_sec'],
+            cfg.input_mode))
+        tf.logging.info(str(timer))
+        frame_cache = getattr(Dataset, 'frame_cache', None)
+        if frame_cache is not None and frame_cache.hits + frame_cache.misses:
+            tf.logging.info(str(frame_cache))
         # valid_wait = 0 if valid_wait == 1 else valid_wait - 1
 
         # Is it also the last epoch?
-        if sv.should_stop() or epoch_id == max_epochs - 1:
+        if (sv.should_stop() or epoch_id == max_epochs - 1 or
+                max_steps_reached):
             last_epoch = True
 
         # Early stop if patience is over
@@ -765,11 +1564,12 @@ def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
             estop = True
 
         # TODO use tf.contrib.learn.monitors.ValidationMonitor?
-        # Validate if last epoch, early stop or we reached valid_every
-        if last_epoch or estop or not val_skip:
+        # Validate if last epoch, early stop or we reached valid_every.
+        # Only the chief validates and saves the best model
+        if cfg.is_chief and cfg.val_on_sets and (last_epoch or estop or
+                                                 not val_skip):
             # Validate
             mean_iou = {}
-            from validate import validate
             for s in cfg.val_on_sets:
                 mean_iou[s] = validate(
                     val_placeholders,
@@ -794,6 +1594,7 @@ def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
                 saver.save(cfg.sess, checkpoint_path,
                            global_step=cfg.global_step)
                 t_save = time() - t_save
+                timer.add('checkpoint', t_save)
                 tf.logging.info('Checkpoint saved in {}s'.format(t_save))
 
                 patience_counter = 0
@@ -814,6 +1615,12 @@ def main_loop(placeholders, val_placeholders, train_outs, train_summary_op,
             sv.request_stop()
             break
 
+    if prefetcher is not None:
+        prefetcher.stop()
+    finish_validation()
+    if not history_acc:
+        return None
+
     max_valid_idx = np.argmax(np.array(history_acc))
     best = history_acc[max_valid_idx]
     (valid_mean_iou) = best
@@ -0,0 +1,125 @@
+'''Peak memory of the training steps and forecast of the largest batch
+
+The peak memory of each device is read from the `RunMetadata` of steps
+traced with `FULL_TRACE`, the memory of the host process from /proc. The
+peak memory of a step grows about linearly with the batch size, so two
+batch sizes are enough to predict the largest one that fits a budget.
+'''
+import json
+import os
+import re
+import resource
+
+import numpy as np
+import tensorflow as tf
+
+
+def rss_bytes():
+    '''Return the resident set size of this process'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    '''Return the peak resident set size of this process'''
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def host_memory_bytes():
+    '''Return the physical memory of the host'''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _device_name(device):
+    '''Return e.g. `gpu:0` for `/job:localhost/.../device:GPU:0`
+
+    Return None for the pseudo-devices of the GPU streams and copies
+    (e.g., `.../device:GPU:0/stream:all` or `.../device:GPU:0/memcpy`),
+    whose ops are also reported on the GPU itself.
+    '''
+    if re.search(r'/(stream:[^/]*|memcpy)$', device):
+        return None
+    spec = tf.DeviceSpec.from_string(device)
+    return '{}:{}'.format((spec.device_type or 'cpu').lower(),
+                          spec.device_index or 0)
+
+
+def step_memory(run_metadata, devices, top_ops=10):
+    '''Return the memory used by a traced step
+
+    Params
+    ------
+    run_metadata:
+        The `RunMetadata` of a step run with `FULL_TRACE`
+    devices:
+        The devices of the towers, i.e., `cfg.devices`
+    top_ops:
+        The number of ops to report, by decreasing size of their outputs
+
+    Return a dict with the peak bytes of each device (and the indices of
+    the towers it runs) and the largest ops.
+    '''
+    tower_devices = [_device_name(d) for d in devices]
+    peaks = {}
+    ops = []
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        name = _device_name(dev_stats.device)
+        if name is None:
+            continue
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peaks[name] = max(peaks.get(name, 0), mem.peak_bytes)
+            nbytes = sum(o.tensor_description.allocation_description
+                         .requested_bytes for o in node_stats.output)
+            if nbytes:
+                ops.append((nbytes, node_stats.node_name, name))
+    ops.sort(reverse=True)
+    return {
+        'devices': {d: {'peak_bytes': p,
+                        'towers': [i for i, t in enumerate(tower_devices)
+                                   if t == d]}
+                    for d, p in peaks.iteritems()},
+        'top_ops': [{'op': op, 'device': d, 'output_bytes': b}
+                    for b, op, d in ops[:top_ops]]}
+
+
+def forecast_batch_size(batch_sizes, device_peaks, budget_bytes):
+    '''Return the largest batch size whose peak memory fits the budget
+
+    Fits `peak = fixed + per_sample * batch_size` on the measures of each
+    device and returns the smallest of the forecasts of the devices, since
+    the busiest device is not necessarily the one whose memory grows the
+    fastest.
+
+    Params
+    ------
+    batch_sizes:
+        The batch sizes of the measures
+    device_peaks:
+        A dict device -> the peak bytes of the device with each batch size
+    budget_bytes:
+        The memory of each device
+
+    Return None if the peak of no device grows with the batch size.
+    '''
+    forecasts = []
+    for peak_bytes in device_peaks.values():
+        per_sample, fixed = np.polyfit(batch_sizes, peak_bytes, 1)
+        if per_sample > 0:
+            forecasts.append(max(0, int((budget_bytes - fixed) //
+                                        per_sample)))
+    return min(forecasts) if forecasts else None
+
+
+def save_report(report, checkpoints_dir):
+    '''Save `report` as memory_report.json in `checkpoints_dir`'''
+    if not os.path.exists(checkpoints_dir):
+        os.makedirs(checkpoints_dir)
+    path = os.path.join(checkpoints_dir, 'memory_report.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
@@ -0,0 +1,166 @@
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import threading
+from time import sleep
+
+import tensorflow as tf
+
+
+class Prefetcher(object):
+    '''Prepare the upcoming batches of a dataset in a background thread
+
+    Calls `dataset.next()` and `prepare_fn` on the result in a separate
+    thread, keeping at most `depth` prepared batches in a bounded queue.
+    This allows to overlap the loading of the batch of step N+1 with the
+    computation of step N.
+
+    The thread is registered to the coordinator `coord`: it stops as soon
+    as a stop is requested and reports its exceptions to the coordinator.
+
+    Params
+    ------
+    dataset:
+        The dataset to load the batches from
+    prepare_fn:
+        A callable that takes the dict returned by `dataset.next()` and
+        returns the values to be fed to the graph
+    depth:
+        The maximum number of prepared batches to keep in memory
+    coord:
+        A `tf.train.Coordinator`, usually `sv.coord`
+    '''
+    def __init__(self, dataset, prepare_fn, depth, coord,
+                 name='prefetcher'):
+        self.dataset = dataset
+        self.prepare_fn = prepare_fn
+        self.coord = coord
+        self.queue = Queue.Queue(maxsize=depth)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)  # Die when main dies
+
+    def start(self):
+        self._thread.start()
+        self.coord.register_thread(self._thread)
+        return self
+
+    def should_stop(self):
+        return self._stop_event.is_set() or self.coord.should_stop()
+
+    def _run(self):
+        try:
+            while not self.should_stop():
+                self._put(self.prepare_fn(self.dataset.next()))
+        except Exception as e:
+            tf.logging.error('Error in the {} thread: {}'.format(
+                self._thread.name, e))
+            self.coord.request_stop(e)
+
+    def _put(self, batch):
+        # Do not block forever on a full queue, or we would not notice
+        # stop requests
+        while not self.should_stop():
+            try:
+                self.queue.put(batch, timeout=0.1)
+                break
+            except Queue.Full:
+                continue
+
+    def next(self):
+        '''Return the next prepared batch
+
+        Return None if a stop has been requested before a batch was
+        available.'''
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self.should_stop() or not self._thread.is_alive():
+                    return None
+
+    def stop(self):
+        '''Stop the thread and release the prepared batches'''
+        self._stop_event.set()
+        self._thread.join()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class QueueFeeder(Prefetcher):
+    '''Enqueue the batches of a dataset in a TF queue from a background thread
+
+    Rather than keeping the prepared batches in memory, feed them to
+    `enqueue_op`, so that the graph can dequeue them directly and the
+    training step does not need to feed the inputs.
+
+    Params
+    ------
+    dataset:
+        The dataset to load the batches from
+    prepare_fn:
+        A callable that takes the dict returned by `dataset.next()` and
+        returns the values to be fed to `placeholders`
+    coord:
+        A `tf.train.Coordinator`, usually `sv.coord`
+    sess:
+        The session used to run `enqueue_op`
+    placeholders:
+        The placeholders of the values enqueued by `enqueue_op`
+    enqueue_op:
+        The op that enqueues the values of `placeholders`
+    close_op:
+        The op that closes the queue, cancelling the pending enqueues
+    size_op:
+        The op that returns the number of elements in the queue
+    '''
+    def __init__(self, dataset, prepare_fn, coord, sess, placeholders,
+                 enqueue_op, close_op, size_op, name='queue_feeder'):
+        super(QueueFeeder, self).__init__(dataset, prepare_fn, 1, coord,
+                                          name=name)
+        self.sess = sess
+        self.placeholders = placeholders
+        self.enqueue_op = enqueue_op
+        self.close_op = close_op
+        self.size_op = size_op
+
+    def _run(self):
+        try:
+            super(QueueFeeder, self)._run()
+        finally:
+            # Do not leave the graph waiting on an empty queue: once closed
+            # the dequeue raises an OutOfRangeError
+            self.sess.run(self.close_op)
+
+    def _put(self, batch):
+        feed_dict = {p: v for (p, v) in zip(self.placeholders, batch)}
+        try:
+            self.sess.run(self.enqueue_op, feed_dict=feed_dict)
+        except (tf.errors.CancelledError, tf.errors.OutOfRangeError):
+            # The queue has been closed: we are stopping
+            self._stop_event.set()
+
+    def wait(self, poll_secs=0.001):
+        '''Wait until a batch is in the queue
+
+        The dequeue of the graph then does not block, so that the time
+        spent waiting for the data is not charged to the session run.
+
+        Return False if a stop has been requested (or the thread has
+        ended) before a batch was available.'''
+        while self.sess.run(self.size_op) == 0:
+            if self.should_stop() or not self._thread.is_alive():
+                return False
+            sleep(poll_secs)
+        return True
+
+    def next(self):
+        raise RuntimeError('The batches of a QueueFeeder are dequeued by '
+                           'the graph')
+
+    def stop(self):
+        '''Close the queue and stop the thread'''
+        self._stop_event.set()
+        self.sess.run(self.close_op)
+        self._thread.join()
@@ -0,0 +1,151 @@
+import gflags
+import numpy as np
+import tensorflow as tf
+
+
+def normalize_inputs(inputs, mean=None, std=None, nchannels=None):
+    '''Convert uint8 inputs to float and normalize them in the graph
+
+    Mirrors the preprocessing that `dataset_loaders` applies on the host:
+    the inputs are scaled to [0, 1], then the dataset mean and std and the
+    per image (or frame) mean and std are removed according to
+    `remove_mean`, `divide_by_std`, `remove_per_img_mean` and
+    `divide_by_per_img_std`. Only the first `nchannels` channels (the
+    image) are normalized, the others (e.g., the optical flow appended
+    with `of`) are only converted to float.
+
+    Params
+    ------
+    inputs:
+        A uint8 tensor of images [b, 0, 1, c] or sequences [b, t, 0, 1, c]
+    mean:
+        The per channel mean of the dataset, in [0, 1]
+    std:
+        The per channel std dev of the dataset, in [0, 1]
+    nchannels:
+        The number of channels of the image. Defaults to all the channels
+    '''
+    cfg = gflags.cfg
+    with tf.name_scope('normalize_inputs'):
+        x = tf.cast(inputs, cfg._FLOATX)
+        extra = None
+        if (nchannels is not None and
+                nchannels != inputs.get_shape().as_list()[-1]):
+            x, extra = x[..., :nchannels], x[..., nchannels:]
+        x /= 255.
+
+        def per_channel(values):
+            values = np.asarray(values, dtype=cfg._FLOATX).reshape([-1])
+            if nchannels is not None:
+                values = values[:nchannels]
+            return tf.constant(values)
+
+        if cfg.remove_mean:
+            if mean is None:
+                tf.logging.warning('The dataset has no mean, remove_mean '
+                                   'will be ignored')
+            else:
+                x -= per_channel(mean)
+        if cfg.divide_by_std:
+            if std is None:
+                tf.logging.warning('The dataset has no std, divide_by_std '
+                                   'will be ignored')
+            else:
+                x /= per_channel(std)
+        # Per image (or frame) statistics
+        img_axes = [-3, -2, -1]
+        if cfg.remove_per_img_mean:
+            x -= tf.reduce_mean(x, axis=img_axes, keep_dims=True)
+        if cfg.divide_by_per_img_std:
+            _, var = tf.nn.moments(x, axes=[len(x.get_shape()) + a
+                                            for a in img_axes],
+                                   keep_dims=True)
+            x /= tf.sqrt(var) + 1e-7
+        if extra is not None:
+            x = tf.concat([x, extra], axis=-1)
+    return x
+
+
+def augment_batch(inputs, labels, crop_size=None, flip=False,
+                  scale_range=None, void_label=0, return_pixel_mask=False):
+    '''Randomly scale, crop and flip a batch in the graph
+
+    Each sample (image or sequence) is augmented independently. The
+    frames of a sequence share the same transformation, as well as the
+    inputs and the labels.
+
+    Params
+    ------
+    inputs:
+        A tensor of images [b, 0, 1, c] or sequences [b, t, 0, 1, c]
+    labels:
+        The labels of the inputs [b, 0, 1] or [b, t', 0, 1], with t' either
+        t or 1 (e.g., when only the middle frame is labelled)
+    crop_size:
+        The size [0, 1] of the random crop. The samples smaller than the
+        crop (e.g., after the scale) are padded with zeros and `void_label`
+    flip:
+        If True, the samples are flipped horizontally with probability 0.5
+    scale_range:
+        The [min, max] range of the random scale factor. Requires
+        `crop_size`, to have a fixed output shape
+    void_label:
+        The label of the padded pixels
+    return_pixel_mask:
+        If True, also return the mask of the flattened labels, that is 0
+        for the padded pixels and 1 elsewhere. Use it when the dataset has
+        no void label, to keep the padding out of the loss
+    '''
+    with tf.name_scope('augment_batch'):
+        in_shape = tf.shape(inputs)
+        labels = tf.reshape(labels, tf.concat([in_shape[:1], [-1],
+                                               in_shape[-3:-1]], 0))
+
+        def augment(sample):
+            x, y = sample
+            m = tf.ones_like(y, 'uint8')
+            if scale_range:
+                scale = tf.random_uniform([], scale_range[0], scale_range[1])
+                size = tf.cast(tf.round(scale * tf.cast(
+                    tf.shape(x)[-3:-1], 'float32')), 'int32')
+                x = tf.image.resize_images(x, size)
+                if not inputs.dtype.is_floating:
+                    x = tf.round(x)
+                y = tf.image.resize_images(
+                    y[..., None], size,
+                    tf.image.ResizeMethod.NEAREST_NEIGHBOR)[..., 0]
+                m = tf.ones_like(y, 'uint8')
+            if crop_size:
+                ch, cw = crop_size
+                # Pad the samples smaller than the crop
+                h, w = tf.shape(x)[-3], tf.shape(x)[-2]
+                pad_h, pad_w = tf.maximum(ch - h, 0), tf.maximum(cw - w, 0)
+                x_pad = [[0, 0]] * (len(x.get_shape()) - 3)
+                y_pad = [[0, 0]] * (len(y.get_shape()) - 2)
+                x = tf.pad(x, x_pad + [[0, pad_h], [0, pad_w], [0, 0]])
+                y = tf.pad(y, y_pad + [[0, pad_h], [0, pad_w]],
+                           constant_values=void_label)
+                m = tf.pad(m, y_pad + [[0, pad_h], [0, pad_w]])
+                h, w = h + pad_h, w + pad_w
+                top = tf.random_uniform([], 0, h - ch + 1, 'int32')
+                left = tf.random_uniform([], 0, w - cw + 1, 'int32')
+                x = x[..., top:top + ch, left:left + cw, :]
+                y = y[..., top:top + ch, left:left + cw]
+                m = m[..., top:top + ch, left:left + cw]
+            if flip:
+                do_flip = tf.random_uniform([]) < 0.5
+                x = tf.cond(do_flip, lambda: tf.reverse(x, [-2]), lambda: x)
+                y = tf.cond(do_flip, lambda: tf.reverse(y, [-1]), lambda: y)
+                m = tf.cond(do_flip, lambda: tf.reverse(m, [-1]), lambda: m)
+            return (tf.saturate_cast(x, inputs.dtype),
+                    tf.cast(y, labels.dtype), m)
+
+        inputs, labels, pixel_mask = tf.map_fn(
+            augment, (inputs, labels),
+            dtype=(inputs.dtype, labels.dtype, tf.uint8), back_prop=False)
+        # Number of labels of each sample, to split the labels among devices
+        labels_per_sample = tf.size(labels) // tf.shape(labels)[0]
+    if return_pixel_mask:
+        return (inputs, tf.reshape(labels, [-1]), labels_per_sample,
+                tf.reshape(pixel_mask, [-1]))
+    return inputs, tf.reshape(labels, [-1]), labels_per_sample
@@ -0,0 +1,199 @@
+import multiprocessing as mp
+import os
+import tempfile
+import traceback
+
+import numpy as np
+
+from utils import DatasetWrapperType
+
+# Put the shared buffers in RAM whenever possible
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def process_pool_dataset(Dataset, nprocs, ordered=True):
+    '''Return a Dataset class whose batches are built by worker processes
+
+    The returned class can be used in place of `Dataset`: it accepts the
+    same parameters and exposes the same attributes.
+
+    Params
+    ------
+    Dataset:
+        A `dataset_loaders` Dataset class
+    nprocs:
+        The number of worker processes
+    ordered:
+        If True the training batches are returned in the order in which
+        `Dataset` would return them, otherwise in the order they are
+        ready. The validation batches are always returned in order.
+    '''
+    return DatasetWrapperType('ProcessPool' + Dataset.__name__,
+                              (ProcessPoolDataset,),
+                              {'Dataset': Dataset,
+                               'nprocs': nprocs,
+                               'ordered': ordered})
+
+
+class ProcessPoolDataset(object):
+    '''Build the batches of a `dataset_loaders` Dataset in worker processes
+
+    Decoding, cropping and optical flow computation are GIL-bound, so
+    parallel threads cannot use more than a few cores. This wrapper keeps
+    a Dataset in the main process to decide the content and order of the
+    batches (as `ThreadedDataset` does with `names_batches`), and sends
+    the names of each batch to a pool of processes that load it with
+    `fetch_from_dataset`. The arrays of the loaded batches are written in
+    shared memory buffers and memory-mapped by the main process, so that
+    they are never pickled.
+
+    Use `process_pool_dataset` to create the wrapper of a Dataset class.
+    '''
+    Dataset = None
+    nprocs = 1
+    ordered = True
+    # How many batches per process to request in advance
+    tasks_per_proc = 2
+
+    def __init__(self, which_set, **kwargs):
+        # Each process loads one batch at a time
+        kwargs['use_threads'] = False
+        self._dataset = self.Dataset(which_set=which_set, **kwargs)
+        # Validation relies on the order of the subsets
+        self._ordered = self.ordered or which_set != 'train'
+
+        self._tasks = mp.Queue()
+        self._results = mp.Queue()
+        self._workers = []
+        for wid in range(self.nprocs):
+            w = mp.Process(target=_worker,
+                           args=(self.Dataset, which_set, kwargs, wid,
+                                 self._tasks, self._results))
+            w.daemon = True  # Die when main dies
+            w.start()
+            self._workers.append(w)
+
+        self._submitted = 0
+        self._returned = 0
+        self._ready = {}
+        for _ in range(self.nprocs * self.tasks_per_proc):
+            self._submit()
+
+    def __getattr__(self, name):
+        # Delegate everything else (nbatches, data_shape, mask_labels, ...)
+        # to the Dataset of the main process
+        if name == '_dataset':
+            raise AttributeError(name)
+        return getattr(self._dataset, name)
+
+    def _next_names(self):
+        try:
+            return next(self._dataset.names_batches)
+        except StopIteration:
+            # End of the epoch
+            self._dataset.reset(self._dataset.shuffle_at_each_epoch)
+            return next(self._dataset.names_batches)
+
+    def _submit(self):
+        self._tasks.put((self._submitted, self._next_names()))
+        self._submitted += 1
+
+    def next(self):
+        seq = self._returned
+        while True:
+            if self._ordered and seq in self._ready:
+                ret = self._ready.pop(seq)
+                break
+            if not self._ordered and self._ready:
+                ret = self._ready.pop(min(self._ready))
+                break
+            res_seq, payload, err = self._results.get()
+            if err is not None:
+                raise RuntimeError('Error in a dataset process:\n' + err)
+            self._ready[res_seq] = payload
+        self._returned += 1
+        self._submit()
+        return _from_shared(ret)
+
+    def finish(self):
+        for _ in self._workers:
+            self._tasks.put(None)  # Poison pill, after the pending tasks
+        # Release the batches that have been loaded but not consumed
+        payloads = list(self._ready.values())
+        for _ in range(self._submitted - self._returned - len(self._ready)):
+            _, payload, err = self._results.get()
+            if err is None:
+                payloads.append(payload)
+        for payload in payloads:
+            _release_shared(payload)
+        self._ready = {}
+        for w in self._workers:
+            w.join()
+        self._dataset.finish()
+
+
+def _worker(Dataset, which_set, params, wid, tasks, results):
+    dataset = Dataset(which_set=which_set, **params)
+    # Different processes should not apply the same random augmentations
+    seed = np.random.randint(2 ** 31) + wid
+    np.random.seed(seed)
+    if hasattr(dataset, 'rng'):
+        dataset.rng = np.random.RandomState(seed)
+
+    while True:
+        task = tasks.get()
+        if task is None:  # Poison pill
+            break
+        seq, names = task
+        try:
+            batch = dataset.fetch_from_dataset(names)
+            results.put((seq, _to_shared(batch), None))
+        except Exception:
+            results.put((seq, None, traceback.format_exc()))
+    dataset.finish()
+
+
+def _to_shared(batch):
+    '''Write the numeric arrays of a batch in shared memory buffers'''
+    ret = {}
+    for k, v in batch.items():
+        if (isinstance(v, np.ndarray) and v.size and
+                not v.dtype.hasobject and v.dtype.kind not in 'SU'):
+            fd, path = tempfile.mkstemp(prefix='main_loop_tf_', suffix='.npy',
+                                        dir=SHM_DIR)
+            os.close(fd)
+            buf = np.lib.format.open_memmap(path, mode='w+', dtype=v.dtype,
+                                            shape=v.shape)
+            buf[...] = v
+            buf.flush()
+            del buf
+            ret[k] = _SharedArray(path)
+        else:
+            ret[k] = v
+    return ret
+
+
+def _from_shared(batch):
+    '''Memory-map the shared buffers of a batch'''
+    ret = {}
+    for k, v in batch.items():
+        if isinstance(v, _SharedArray):
+            arr = np.load(v.path, mmap_mode='r+')
+            # The mapping stays valid until the array is garbage collected
+            os.unlink(v.path)
+            ret[k] = arr
+        else:
+            ret[k] = v
+    return ret
+
+
+def _release_shared(batch):
+    for v in batch.values():
+        if isinstance(v, _SharedArray):
+            os.unlink(v.path)
+
+
+class _SharedArray(object):
+    '''The path of a shared memory buffer'''
+    def __init__(self, path):
+        self.path = path
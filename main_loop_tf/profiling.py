@@ -0,0 +1,90 @@
+'''Timing of the phases of the training steps
+
+`StepTimer` measures where the time of each step goes (waiting for the
+data, building the feed dict, running the session, writing the summaries
+and the checkpoints) and keeps the last `window` steps to report rolling
+percentiles, e.g., as TensorBoard scalars. `save_chrome_trace` writes the
+timeline of a traced step, to be opened in chrome://tracing.
+'''
+from collections import deque
+import os
+from time import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+PHASES = ['data', 'feed', 'run', 'summary', 'checkpoint']
+
+
+class StepTimer(object):
+    '''Rolling timings of the phases of the steps
+
+    Call `start` at the beginning of a step, `lap(phase)` at the end of
+    each phase and `end` at the end of the step. `add` charges the time of
+    something that happens between two steps (e.g., a checkpoint) to the
+    next step.
+
+    Params
+    ------
+    window:
+        The number of steps the percentiles are computed on
+    '''
+    def __init__(self, window=100):
+        self.times = {p: deque(maxlen=window) for p in PHASES + ['step']}
+        self.current = dict.fromkeys(PHASES, 0.)
+        self.last = None
+
+    def start(self):
+        self.last = time()
+
+    def lap(self, phase):
+        '''Charge the time since the last lap (or the start) to `phase`'''
+        now = time()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def add(self, phase, secs):
+        self.current[phase] += secs
+
+    def end(self, record=True):
+        '''End the step. Its times are dropped if `record` is False'''
+        if record:
+            for p, t in self.current.iteritems():
+                self.times[p].append(t)
+            self.times['step'].append(sum(self.current.values()))
+        self.current = dict.fromkeys(PHASES, 0.)
+
+    def percentiles(self, q=(50, 90, 99)):
+        '''Return a dict phase -> list of the percentiles `q` (in seconds)'''
+        return {p: np.percentile(t, q).tolist()
+                for p, t in self.times.iteritems() if t}
+
+    def summary(self, q=(50, 90, 99)):
+        '''Return the percentiles (in ms) as a Summary protobuf'''
+        values = []
+        for p, ts in sorted(self.percentiles(q).iteritems()):
+            for qi, t in zip(q, ts):
+                values.append(tf.Summary.Value(
+                    tag='StepTime/{}_p{}'.format(p, qi),
+                    simple_value=t * 1000.))
+        return tf.Summary(value=values)
+
+    def __str__(self):
+        ret = []
+        for p in PHASES + ['step']:
+            if self.times[p]:
+                p50, p90, p99 = np.percentile(self.times[p], (50, 90, 99))
+                ret.append('{} {:.1f}/{:.1f}/{:.1f}'.format(
+                    p, p50 * 1000, p90 * 1000, p99 * 1000))
+        return 'Step time (ms, p50/p90/p99): ' + ', '.join(ret)
+
+
+def save_chrome_trace(run_metadata, path):
+    '''Write the timeline of a step traced with `FULL_TRACE` to `path`'''
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tl = timeline.Timeline(run_metadata.step_stats)
+    with open(path, 'w') as f:
+        f.write(tl.generate_chrome_trace_format(show_memory=True))
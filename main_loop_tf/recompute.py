@@ -0,0 +1,202 @@
+'''Gradients that recompute the activations instead of storing them
+
+The backward pass of `tf.gradients` keeps every activation of the forward
+pass alive until its gradient is computed. `gradients` only keeps some
+of them (the checkpoints) and recomputes the others from the closest
+checkpoint when the backward pass needs them, trading some compute for a
+peak memory that grows with the number of checkpoints rather than with
+the size of the graph (e.g., with `seq_length` and `crop_size`).
+
+The checkpoints can be marked in `build_model` with `checkpoint`, or
+chosen automatically among the outputs of the convolutions and matrix
+multiplications. The outputs of the stateful ops (e.g., the random mask
+of a dropout) are always checkpoints, so that the recomputation reuses
+them rather than drawing new values.
+'''
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import graph_editor as ge
+
+CHECKPOINTS_COLLECTION = 'checkpoints'
+# The ops whose outputs are candidate checkpoints in `auto` mode
+AUTO_CHECKPOINT_OPS = ['Conv2D', 'Conv3D', 'DepthwiseConv2dNative',
+                       'MatMul', 'BatchMatMul']
+# The ops that create, read or write the variables, never recomputed
+VARIABLE_OPS = ['Variable', 'VariableV2', 'VarHandleOp', 'ReadVariableOp',
+                'Assign', 'AssignAdd', 'AssignSub', 'AssignVariableOp',
+                'AssignAddVariableOp', 'AssignSubVariableOp', 'ScatterAdd',
+                'ScatterSub', 'ScatterUpdate']
+
+
+def checkpoint(tensor):
+    '''Mark a tensor to be kept in memory for the backward pass'''
+    tf.add_to_collection(CHECKPOINTS_COLLECTION, tensor)
+    return tensor
+
+
+def compute_gradients(loss, var_list=None, checkpoints='collection',
+                      **kwargs):
+    '''Return the (gradient, variable) pairs of `loss`, as an Optimizer
+
+    Params
+    ------
+    loss:
+        The loss to be minimized
+    var_list:
+        The variables to be optimized. Defaults to the trainable variables
+    checkpoints:
+        `collection` to use the tensors marked with `checkpoint`, `auto`
+        to choose them automatically, or a list of tensors
+    '''
+    if var_list is None:
+        var_list = (tf.trainable_variables() +
+                    tf.get_collection(
+                        tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES))
+    grads = gradients([loss], var_list, checkpoints, **kwargs)
+    return list(zip(grads, var_list))
+
+
+def _is_variable_op(op):
+    '''Whether `op` creates, reads (e.g., `<variable>/read`) or writes a
+    variable'''
+    return op.type in VARIABLE_OPS or (
+        op.type == 'Identity' and op.inputs[0].dtype._is_ref_dtype)
+
+
+def _is_stateful(op):
+    '''Whether running `op` again can give different outputs or have side
+    effects (e.g., the random ops)'''
+    return op.op_def is not None and op.op_def.is_stateful
+
+
+def _backward_ops(seed_ops, stop_at_ts, within_ops):
+    '''Return the ops of `within_ops` that lead to `seed_ops`, without
+    crossing `stop_at_ts`'''
+    stop_at_ts = set(stop_at_ts)
+    ret = set()
+    stack = list(seed_ops)
+    while stack:
+        op = stack.pop()
+        if op in ret or op not in within_ops:
+            continue
+        ret.add(op)
+        stack.extend(t.op for t in op.inputs if t not in stop_at_ts)
+    return ret
+
+
+def _copy_ops(ops, checkpoints, disconnected):
+    '''Copy `ops`, reading the checkpoints from their disconnected copies
+
+    Return a dict from the original to the copied ops.
+    '''
+    _, info = ge.copy_with_input_replacements(ge.sgv(list(ops)), {})
+    copied = info._transformed_ops
+    for op, copied_op in copied.items():
+        copied_op._set_device(op.node_def.device)
+    if checkpoints:
+        ge.reroute_ts([disconnected[c] for c in checkpoints], checkpoints,
+                      can_modify=list(copied.values()))
+    return copied
+
+
+def _wait_for(ops, before):
+    '''Make `ops` run after `before`, so that the recomputation happens
+    when the backward pass reaches it rather than as soon as possible'''
+    for op in ops:
+        ci = [b for b in before if b not in op.control_inputs and b is not op]
+        if ci:
+            ge.add_control_inputs(op, ci)
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if isinstance(a, tf.IndexedSlices) or isinstance(b, tf.IndexedSlices):
+        a, b = tf.convert_to_tensor(a), tf.convert_to_tensor(b)
+    return a + b
+
+
+def auto_checkpoints(ts):
+    '''Choose about sqrt(n) of the n convolutions or matmuls in `ts`'''
+    candidates = sorted([t for t in ts if t.op.type in AUTO_CHECKPOINT_OPS],
+                        key=lambda t: t.op._id)
+    if not candidates:
+        return []
+    n = int(np.ceil(np.sqrt(len(candidates))))
+    step = len(candidates) / float(n)
+    return [candidates[int(i * step)] for i in range(n)]
+
+
+def gradients(ys, xs, checkpoints='collection', **kwargs):
+    '''As `tf.gradients`, but recompute the activations between checkpoints
+
+    The graph between `xs` and `ys` is copied in segments that end at the
+    checkpoints: the backward pass of each copy only depends on the
+    checkpoints, hence only the checkpoints are kept in memory.
+    '''
+    ys = list(ys)
+    xs = list(xs)
+    bwd_ops = ge.get_backward_walk_ops([y.op for y in ys], inclusive=True)
+    fwd_ops = ge.get_forward_walk_ops([x.op for x in xs], inclusive=True,
+                                      within_ops=bwd_ops)
+    xs_ops = set(x.op for x in xs)
+    fwd_ops = set(op for op in fwd_ops if op not in xs_ops and
+                  not _is_variable_op(op))
+    ts_all = set(t for op in fwd_ops for t in op.outputs
+                 if t.dtype.is_floating) - set(xs) - set(ys)
+
+    if checkpoints == 'collection':
+        checkpoints = tf.get_collection(CHECKPOINTS_COLLECTION)
+    elif checkpoints == 'auto':
+        checkpoints = auto_checkpoints(ts_all)
+    checkpoints = [c for c in set(checkpoints) if c in ts_all]
+    if not checkpoints:
+        tf.logging.warning('No checkpoints to recompute the gradients from, '
+                           'using tf.gradients')
+        return tf.gradients(ys, xs, **kwargs)
+    # The copies read the outputs of the stateful ops rather than running
+    # them again
+    checkpoints += [t for op in fwd_ops if _is_stateful(op)
+                    for t in op.outputs
+                    if t not in checkpoints and t not in ys]
+
+    # The backward pass of the copies stops at the checkpoints
+    disconnected = {c: tf.stop_gradient(c, name=c.op.name + '_sg')
+                    for c in checkpoints}
+
+    # Gradients of the last segment w.r.t. the checkpoints and the xs
+    copied = _copy_ops(_backward_ops([y.op for y in ys], checkpoints,
+                                     fwd_ops), checkpoints, disconnected)
+    copied_ys = [copied[y.op].outputs[y.value_index] if y.op in copied
+                 else y for y in ys]
+    boundary = [disconnected[c] for c in checkpoints]
+    dv = tf.gradients(copied_ys, boundary + xs, **kwargs)
+    _wait_for(list(copied.values()) + [g.op for g in dv if g is not None],
+              [y.op for y in ys])
+    d_checkpoints = dict(zip(checkpoints, dv[:len(checkpoints)]))
+    d_xs = dv[len(checkpoints):]
+
+    # Backpropagate through the segments ending at each checkpoint, from
+    # the last to the first. A checkpoint is processed after all the
+    # checkpoints that depend on it.
+    ancestors = {c: len(_backward_ops([c.op], [], fwd_ops).intersection(
+        d.op for d in checkpoints)) for c in checkpoints}
+    for c in sorted(checkpoints, key=lambda c: -ancestors[c]):
+        if d_checkpoints[c] is None:
+            continue
+        others = [o for o in checkpoints if o is not c]
+        ops = _backward_ops([c.op], others, fwd_ops)
+        if not ops:
+            continue
+        copied = _copy_ops(ops, others, disconnected)
+        copied_c = copied[c.op].outputs[c.value_index]
+        dv = tf.gradients([copied_c], [disconnected[o] for o in others] + xs,
+                          grad_ys=[d_checkpoints[c]], **kwargs)
+        _wait_for(list(copied.values()) + [g.op for g in dv if g is not None],
+                  [d_checkpoints[c].op])
+        for o, d in zip(others, dv[:len(others)]):
+            d_checkpoints[o] = _add(d_checkpoints[o], d)
+        d_xs = [_add(a, b) for a, b in zip(d_xs, dv[len(others):])]
+    return d_xs
@@ -0,0 +1,270 @@
+import json
+import os
+import zlib
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from utils import DatasetWrapperType
+
+# The parameters of the Dataset that change the content of the samples. They
+# are stored in the index, to verify that the shards match the config
+CONTENT_PARAMS = ['seq_length', 'overlap', 'seq_per_subset',
+                  'return_extended_sequences', 'return_middle_frame_only',
+                  'return_one_hot', 'return_01c', 'return_0_255',
+                  'remove_mean', 'divide_by_std', 'remove_per_img_mean',
+                  'divide_by_per_img_std', 'return_optical_flow']
+# The attributes of the Dataset that are stored in the index
+DATASET_ATTRIBUTES = ['data_shape', 'nclasses', 'non_void_nclasses',
+                      'void_labels', 'mask_labels', 'cmap', 'set_has_GT',
+                      'seq_length']
+# The arrays of each sample, in the order they are stored in a record
+RECORD_KEYS = ['data', 'labels', 'raw_data']
+
+
+def content_params(params):
+    '''Return the parameters of `params` that change the samples content'''
+    flat = dict(params)
+    flat.update(params.get('data_augm_kwargs') or {})
+    ret = {}
+    for k in CONTENT_PARAMS:
+        v = flat.get(k)
+        # Normalize to JSON types to compare with the index
+        ret[k] = list(v) if isinstance(v, tuple) else v
+    return ret
+
+
+def convert_to_shards(Dataset, which_set, params, shards_dir,
+                      shard_size_mb=512, compress=False):
+    '''Write a split of a Dataset in packed, fixed layout shards
+
+    Each sample (i.e., each image or sequence) of the split is stored as a
+    record made of its data, labels and raw data. The records are appended
+    to shards of at most `shard_size_mb` MB, optionally compressed with
+    zlib. An index stores the layout of the records, their position in
+    the shards, their subset and filenames and the attributes of the
+    Dataset, so that `ShardDataset` can serve the batches without the
+    original Dataset.
+
+    The samples are stored as returned by the Dataset with `params`,
+    except for the random crop, that is applied by `ShardDataset`.
+
+    Params
+    ------
+    Dataset:
+        A `dataset_loaders` Dataset class
+    which_set:
+        The split to convert
+    params:
+        The parameters of the Dataset (e.g., `cfg.dataset_params`)
+    shards_dir:
+        The directory of the shards of the dataset. The split will be
+        written in the `which_set` subdirectory.
+    shard_size_mb:
+        The maximum size of each shard
+    compress:
+        If True, each record is compressed. This saves disk space at the
+        cost of a copy and a decompression for each sample.
+    '''
+    params = dict(params)
+    params.update({'batch_size': 1,
+                   'shuffle_at_each_epoch': False,
+                   'return_list': False})
+    params['data_augm_kwargs'] = dict(params.get('data_augm_kwargs') or {})
+    params['data_augm_kwargs']['crop_size'] = None
+    dataset = Dataset(which_set=which_set, **params)
+
+    out_dir = os.path.join(shards_dir, which_set)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    layout = None
+    records = []
+    subsets = {}
+    shard_id = -1
+    shard = None
+    shard_bytes = shard_size_mb * 1024 ** 2
+    for _ in tqdm(range(dataset.nbatches), desc='Converting ' + which_set):
+        ret = dataset.next()
+        sample = [np.ascontiguousarray(ret[k][0]) for k in RECORD_KEYS]
+        if layout is None:
+            layout = [[k, list(a.shape), a.dtype.str]
+                      for k, a in zip(RECORD_KEYS, sample)]
+        elif [list(a.shape) for a in sample] != [l[1] for l in layout]:
+            raise RuntimeError('The samples of {} have different shapes: '
+                               'the shards require a fixed layout'.format(
+                                   which_set))
+        record = b''.join(a.tobytes() for a in sample)
+        if compress:
+            record = zlib.compress(record, 1)
+
+        if shard is None or shard.tell() + len(record) > shard_bytes:
+            if shard is not None:
+                shard.close()
+            shard_id += 1
+            shard = open(os.path.join(out_dir, 'shard_%05d.bin' % shard_id),
+                         'wb')
+        subset = ret['subset'][0]
+        subsets.setdefault(subset, []).append(len(records))
+        records.append({'shard': shard_id,
+                        'offset': shard.tell(),
+                        'length': len(record),
+                        'subset': subset,
+                        'filenames': np.asarray(
+                            ret['filenames'][0]).tolist()})
+        shard.write(record)
+    if shard is not None:
+        shard.close()
+
+    attributes = {}
+    for k in DATASET_ATTRIBUTES:
+        v = getattr(dataset, k, None)
+        attributes[k] = v.tolist() if isinstance(v, np.ndarray) else v
+    attributes['data_shape'] = layout[0][1][-3:] if layout else None
+    index = {'layout': layout,
+             'compressed': compress,
+             'nshards': shard_id + 1,
+             'records': records,
+             'subsets': subsets,
+             'attributes': attributes,
+             'params': content_params(params)}
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    dataset.finish()
+    tf.logging.info('{} samples of {} written in {} shards in {}'.format(
+        len(records), which_set, shard_id + 1, out_dir))
+
+
+def shard_dataset(shards_dir, Dataset):
+    '''Return a Dataset class that serves the shards in `shards_dir`
+
+    The class attributes missing in the index are taken from `Dataset`.
+    '''
+    return DatasetWrapperType('Shard' + Dataset.__name__, (ShardDataset,),
+                              {'Dataset': Dataset,
+                               'shards_dir': shards_dir})
+
+
+class ShardDataset(object):
+    '''Serve the batches of a split from memory-mapped shards
+
+    Replaces a `dataset_loaders` Dataset with the shards written by
+    `convert_to_shards`: rather than opening and decoding a file per frame,
+    each shard is memory-mapped once and the samples are sliced from it.
+    The random crop (`crop_size` in `data_augm_kwargs`) is applied when the
+    batch is assembled, all the other parameters that change the content
+    of the samples must match those used to convert the split.
+
+    Use `shard_dataset` to create the class of a dataset.
+    '''
+    Dataset = None
+    shards_dir = None
+
+    def __init__(self, which_set, batch_size=1, shuffle_at_each_epoch=True,
+                 data_augm_kwargs={}, rng=None, **kwargs):
+        self.which_set = which_set
+        self.batch_size = batch_size
+        self.shuffle_at_each_epoch = shuffle_at_each_epoch
+        self.crop_size = data_augm_kwargs.get('crop_size')
+        self.rng = rng if rng is not None else np.random.RandomState(1609)
+
+        self.path = os.path.join(self.shards_dir, which_set)
+        with open(os.path.join(self.path, 'index.json')) as f:
+            index = json.load(f)
+
+        # Verify that the shards match the requested parameters
+        kwargs['data_augm_kwargs'] = data_augm_kwargs
+        requested = content_params(kwargs)
+        for k, v in index['params'].items():
+            if requested.get(k) != v:
+                raise RuntimeError(
+                    'The shards in {} have been converted with {}={}, but '
+                    '{} was requested. Please convert the dataset '
+                    'again.'.format(self.path, k, v, requested.get(k)))
+
+        for k, v in index['attributes'].items():
+            setattr(self, k, v)
+        self.compressed = index['compressed']
+        self.records = index['records']
+        self.subsets = index['subsets']
+        self.layout = []
+        offset = 0
+        for k, shape, dtype in index['layout']:
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            self.layout.append((k, tuple(shape), dtype, offset, nbytes))
+            offset += nbytes
+        self._shards = [None] * index['nshards']
+
+        self.nsamples = len(self.records)
+        self.nbatches = int(np.ceil(self.nsamples / float(batch_size)))
+        self.reset(self.shuffle_at_each_epoch)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or type(self).Dataset is None:
+            raise AttributeError(name)
+        return getattr(type(self).Dataset, name)
+
+    def _shard(self, idx):
+        if self._shards[idx] is None:
+            self._shards[idx] = np.memmap(
+                os.path.join(self.path, 'shard_%05d.bin' % idx),
+                dtype=np.uint8, mode='r')
+        return self._shards[idx]
+
+    def reset(self, shuffle):
+        order = np.arange(self.nsamples)
+        if shuffle:
+            self.rng.shuffle(order)
+        self._batches = iter([order[i:i + self.batch_size] for i in
+                              range(0, self.nsamples, self.batch_size)])
+
+    def get_sample(self, idx):
+        '''Return the arrays of a record, as a dict'''
+        rec = self.records[idx]
+        buf = self._shard(rec['shard'])[rec['offset']:
+                                        rec['offset'] + rec['length']]
+        if self.compressed:
+            buf = np.frombuffer(zlib.decompress(buf.tobytes()),
+                                dtype=np.uint8)
+        ret = {}
+        for k, shape, dtype, offset, nbytes in self.layout:
+            ret[k] = buf[offset:offset + nbytes].view(dtype).reshape(shape)
+        return ret
+
+    def _crop(self, sample):
+        h, w = sample['data'].shape[-3:-1]
+        ch, cw = self.crop_size
+        top = self.rng.randint(0, h - ch + 1)
+        left = self.rng.randint(0, w - cw + 1)
+        sample['data'] = sample['data'][..., top:top + ch, left:left + cw, :]
+        sample['labels'] = sample['labels'][..., top:top + ch,
+                                            left:left + cw]
+        return sample
+
+    def next(self):
+        try:
+            idxs = next(self._batches)
+        except StopIteration:
+            # End of the epoch
+            self.reset(self.shuffle_at_each_epoch)
+            idxs = next(self._batches)
+        samples = [self.get_sample(i) for i in idxs]
+        if self.crop_size:
+            samples = [self._crop(s) for s in samples]
+        ret = {k: np.stack([s[k] for s in samples]) for k in RECORD_KEYS}
+        ret['subset'] = [self.records[i]['subset'] for i in idxs]
+        ret['filenames'] = np.array([self.records[i]['filenames']
+                                     for i in idxs])
+        return ret
+
+    def finish(self):
+        self._shards = [None] * len(self._shards)
+
+
+if __name__ == '__main__':
+    import sys
+    from main_loop_tf.main import convert
+
+    convert(sys.argv)
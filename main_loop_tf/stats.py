@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from process_pool import process_pool_dataset
+
+# The parameters of the Dataset that change the statistics
+STATS_PARAMS = ['seq_length', 'overlap', 'seq_per_subset',
+                'return_extended_sequences', 'return_middle_frame_only']
+STATS_AUGM_PARAMS = ['crop_size', 'return_optical_flow']
+
+
+class StatsAccumulator(object):
+    '''Accumulate the statistics of a dataset in a single pass
+
+    Counts the pixels of each class with `np.bincount` and keeps the
+    running mean and sum of squared deviations of each channel, merging
+    the moments of each batch with those accumulated so far (Chan et al.)
+    to avoid the numerical issues of the sum of squares.
+    '''
+    def __init__(self):
+        self.class_counts = np.zeros(0, dtype='int64')
+        self.npixels = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data, labels):
+        counts = np.bincount(np.asarray(labels, dtype='int64').ravel())
+        if len(counts) > len(self.class_counts):
+            counts[:len(self.class_counts)] += self.class_counts
+            self.class_counts = counts
+        else:
+            self.class_counts[:len(counts)] += counts
+
+        x = np.asarray(data, dtype='float64').reshape(-1, data.shape[-1])
+        n = len(x)
+        mean = x.mean(axis=0)
+        m2 = ((x - mean) ** 2).sum(axis=0)
+        if self.mean is None:
+            self.mean, self.m2 = mean, m2
+        else:
+            tot = self.npixels + n
+            delta = mean - self.mean
+            self.mean = self.mean + delta * n / tot
+            self.m2 = self.m2 + m2 + delta ** 2 * self.npixels * n / tot
+        self.npixels += n
+
+    def result(self, nclasses):
+        '''Return the statistics as a JSON-serializable dict'''
+        counts = np.zeros(max(nclasses, len(self.class_counts)),
+                          dtype='int64')
+        counts[:len(self.class_counts)] = self.class_counts
+        valid = counts[:nclasses].sum()
+        return {'class_counts': counts.tolist(),
+                'class_freqs': (counts[:nclasses] /
+                                float(max(valid, 1))).tolist(),
+                'void_fraction': 1 - valid / float(max(counts.sum(), 1)),
+                'mean': self.mean.tolist(),
+                'std': np.sqrt(self.m2 / max(self.npixels, 1)).tolist(),
+                'npixels': self.npixels}
+
+
+def stats_key(dataset_name, which_set, params):
+    '''Return the key of the statistics of a split with `params`'''
+    augm = params.get('data_augm_kwargs') or {}
+    key = [dataset_name, which_set]
+    key += [(k, params.get(k)) for k in STATS_PARAMS]
+    key += [(k, augm.get(k)) for k in STATS_AUGM_PARAMS]
+    return hashlib.md5(str(key).encode('utf-8')).hexdigest()
+
+
+def dataset_stats(Dataset, dataset_name, which_set, params, cache_dir,
+                  nprocs=0):
+    '''Return the statistics of a split of a Dataset
+
+    Computes, in a single pass over the split, the number of pixels of
+    each class, the frequency of the non-void classes, the fraction of void
+    pixels and the per channel mean and std dev of the inputs (in [0, 1]).
+    The batches are loaded by `nprocs` processes, if nonzero.
+
+    The statistics are cached in `cache_dir`, keyed by dataset, split and
+    the parameters that change them (e.g., the crop size).
+    '''
+    path = os.path.join(cache_dir, '{}_{}_{}.json'.format(
+        dataset_name, which_set, stats_key(dataset_name, which_set, params)))
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    params = dict(params)
+    params.update({'shuffle_at_each_epoch': False,
+                   'return_list': False,
+                   'return_0_255': False,
+                   'remove_mean': False,
+                   'divide_by_std': False,
+                   'remove_per_img_mean': False,
+                   'divide_by_per_img_std': False})
+    if nprocs:
+        Dataset = process_pool_dataset(Dataset, nprocs, ordered=False)
+    dataset = Dataset(which_set=which_set, **params)
+    acc = StatsAccumulator()
+    for _ in tqdm(range(dataset.nbatches),
+                  desc='Statistics of ' + which_set):
+        ret = dataset.next()
+        acc.update(ret['data'], ret['labels'])
+    dataset.finish()
+    stats = acc.result(dataset.non_void_nclasses)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(path, 'w') as f:
+        json.dump(stats, f)
+    tf.logging.info('Statistics of {} saved in {}'.format(which_set, path))
+    return stats
+
+
+def class_balance_weights(freqs, class_balance):
+    '''Return the weight of each class from the class frequencies'''
+    freqs = np.asarray(freqs, dtype='float64')
+    present = freqs > 0
+    w_freq = np.zeros_like(freqs)
+    if class_balance == 'median_freq_cost':
+        w_freq[present] = np.median(freqs[present]) / freqs[present]
+    elif class_balance == 'rare_freq_cost':
+        w_freq[present] = 1 / (len(freqs) * freqs[present])
+    else:
+        raise NotImplementedError('The balance class method {} is not '
+                                  'implemented'.format(class_balance))
+    return w_freq
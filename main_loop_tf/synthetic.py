@@ -0,0 +1,89 @@
+'''An in-memory Dataset of random samples, to benchmark the main loop
+
+`synthetic_dataset` returns a Dataset class with the interface of the
+`dataset_loaders` Datasets that `main_loop` and `validate` use. Its
+batches are generated once and served in a loop, so that the loading time
+is negligible and the benchmarks measure the main loop and the model.
+Select it with `--dataset synthetic`.
+'''
+import numpy as np
+
+# The number of distinct batches generated by each Dataset
+NPOOL = 4
+
+
+def synthetic_dataset(data_shape, nclasses, nbatches, seed=1609):
+    '''Return a Dataset class of random samples
+
+    Params
+    ------
+    data_shape:
+        The (height, width, channels) of the frames
+    nclasses:
+        The number of classes, none of which is void
+    nbatches:
+        The number of batches of each epoch of each split
+    '''
+    data_shape = tuple(data_shape)
+
+    class SyntheticDataset(object):
+        name = 'synthetic'
+        non_void_nclasses = nclasses
+        void_labels = []
+        mask_labels = np.arange(nclasses)
+        cmap = np.random.RandomState(seed).rand(nclasses, 3)
+        mean = np.zeros(data_shape[-1:])
+        std = np.ones(data_shape[-1:])
+        class_freqs = np.ones(nclasses) / float(nclasses)
+        set_has_GT = True
+
+        def __init__(self, which_set, batch_size=1, seq_length=0,
+                     return_middle_frame_only=False, return_0_255=False,
+                     data_augm_kwargs=None, shuffle_at_each_epoch=False,
+                     **kwargs):
+            self.which_set = which_set
+            self.batch_size = batch_size
+            self.seq_length = seq_length
+            self.shuffle_at_each_epoch = shuffle_at_each_epoch
+            self.nbatches = nbatches
+            crop_size = (data_augm_kwargs or {}).get('crop_size')
+            h, w = crop_size or data_shape[:2]
+            frames = [seq_length] if seq_length else []
+            label_frames = [] if return_middle_frame_only else frames
+            rng = np.random.RandomState(seed)
+            self._pool = []
+            for i in range(NPOOL):
+                data = rng.randint(0, 256, [batch_size] + frames +
+                                   [h, w, data_shape[-1]]).astype('uint8')
+                raw_data = data
+                if not return_0_255:
+                    data = data.astype('float32') / 255.
+                labels = rng.randint(0, nclasses, [batch_size] +
+                                     label_frames + [h, w]).astype('int32')
+                self._pool.append({
+                    'data': data,
+                    'labels': labels,
+                    'raw_data': raw_data,
+                    'subset': ['default'] * batch_size,
+                    'filenames': np.array([['{}_{}_{}'.format(
+                        which_set, i, j)] for j in range(batch_size)])})
+            self._idx = 0
+
+        def next(self):
+            ret = self._pool[self._idx % NPOOL]
+            self._idx += 1
+            return dict(ret)
+
+        def reset(self, shuffle=False):
+            self._idx = 0
+
+        def finish(self):
+            pass
+
+        def get_names(self):
+            return {'default': ['{}_{}'.format(self.which_set, i)
+                                for i in range(nbatches * self.batch_size)]}
+
+    SyntheticDataset.data_shape = data_shape
+    SyntheticDataset.nclasses = nclasses
+    return SyntheticDataset
@@ -0,0 +1,55 @@
+'''Short trainings in their own process, to measure their throughput
+
+`run_trial` runs a training in a new process, without validation and with
+a temporary checkpoints directory, and returns the result the process
+writes as JSON (e.g., its `cfg.train_throughput`). It is shared by the
+autotuning (see `autotune.py`) and the benchmarks.
+'''
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def run_trial(cmd, out_flag, quiet=False):
+    '''Run the training `cmd` in a new process and return its result
+
+    Params
+    ------
+    cmd:
+        The command line of the training, e.g., `[sys.executable] + argv`
+    out_flag:
+        The flag of the file the process writes its result to, as JSON
+    quiet:
+        If True, the output of the process is discarded
+
+    Return the result, or None if the process failed.
+    '''
+    tmp_dir = tempfile.mkdtemp()
+    out = os.path.join(tmp_dir, 'trial.json')
+    cmd = list(cmd) + ['--val_on_sets', '',
+                       '--restore_model', 'False',
+                       '--checkpoints_dir', tmp_dir,
+                       '--max_epochs', '1',
+                       '--graph_cache=false',
+                       '--' + out_flag, out]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = devnull if quiet else None
+            ret = subprocess.call(cmd, stdout=output, stderr=output)
+        if ret != 0 or not os.path.exists(out):
+            return None
+        with open(out) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def step_secs(throughput):
+    '''Return the time of a step of a `cfg.train_throughput`'''
+    percentiles = throughput.get('step_secs_percentiles')
+    if percentiles:
+        # The median step time is not affected by the first (slow) steps
+        return percentiles[0]
+    return throughput['secs'] / max(throughput['steps'], 1)
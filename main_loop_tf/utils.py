@@ -1,6 +1,7 @@
 import logging
 from subprocess import check_output
 import sys
+import time
 import tqdm
 
 import gflags
@@ -43,10 +44,49 @@ def compute_chunk_size(batch_size, npixels):
     return split_dim, labels_split_dim
 
 
+def pad_batch(x_batch, y_batch, batch_size):
+    '''Pad a batch with zeros to `batch_size` samples
+
+    Return the padded inputs and labels and the mask of the samples, that
+    is 1 for the samples of the batch and 0 for the padding.
+    '''
+    cfg = gflags.cfg
+    npad = batch_size - len(x_batch)
+    if npad < 0:
+        raise ValueError('The batch has {} samples, more than {}'.format(
+            len(x_batch), batch_size))
+    sample_mask = np.zeros(batch_size, dtype=cfg._FLOATX)
+    sample_mask[:len(x_batch)] = 1
+    if npad:
+        x_batch = np.concatenate([x_batch, np.zeros(
+            (npad,) + x_batch.shape[1:], dtype=x_batch.dtype)])
+        y_batch = np.concatenate([y_batch, np.zeros(
+            (npad,) + y_batch.shape[1:], dtype=y_batch.dtype)])
+    return x_batch, y_batch, sample_mask
+
+
+def expand_sample_mask(sample_mask, labels):
+    '''Return the mask of each element of the flattened labels
+
+    Repeats the mask of each sample for each of its labels.
+    '''
+    nsamples = tf.shape(sample_mask)[0]
+    per_sample = tf.size(labels) // nsamples
+    return tf.reshape(tf.tile(tf.expand_dims(sample_mask, 1),
+                              [1, per_sample]), [-1])
+
+
 def apply_loss(labels, net_out, loss_fn, weight_decay, is_training,
-               return_mean_loss=False, mask_voids=True):
+               return_mean_loss=False, mask_voids=True, class_weights=None,
+               pixel_mask=None, add_l2_penalty=True):
     '''Applies the user-specified loss function and returns the loss
 
+    If `class_weights` is given, the loss of each pixel is multiplied by
+    the weight of its class (see `stats.class_balance_weights`). The pixels
+    where `pixel_mask` is 0 (e.g., the padding) are ignored. With
+    `add_l2_penalty` False the L2 penalty is left to the caller, e.g., to
+    compute it once for all the towers (see `add_weight_decay`).
+
     Note:
         SoftmaxCrossEntropyWithLogits expects labels NOT to be one-hot
         and net_out to be one-hot.
@@ -54,42 +94,97 @@ def apply_loss(labels, net_out, loss_fn, weight_decay, is_training,
 
     cfg = gflags.cfg
 
+    mask = _loss_mask(labels, pixel_mask, mask_voids)
     if mask_voids and len(cfg.void_labels):
         # TODO Check this
         print('Masking the void labels')
-        mask = tf.not_equal(labels, cfg.void_labels)
-        labels *= tf.cast(mask, 'int32')  # void_class --> 0 (random class)
-        # Train loss
-        loss = loss_fn(labels=labels,
-                       logits=tf.reshape(net_out, [-1, cfg.nclasses]))
-        mask = tf.cast(mask, 'float32')
+        # void_class --> 0 (random class)
+        labels *= tf.cast(tf.not_equal(labels, cfg.void_labels), 'int32')
+    # Train loss
+    loss = loss_fn(labels=labels,
+                   logits=tf.reshape(net_out, [-1, cfg.nclasses]))
+    if mask is not None:
         loss *= mask
-    else:
-        # Train loss
-        loss = loss_fn(labels=labels,
-                       logits=tf.reshape(net_out, [-1, cfg.nclasses]))
 
-    if is_training:
+    if class_weights is not None:
+        loss *= tf.gather(tf.constant(class_weights, dtype=loss.dtype),
+                          labels)
+
+    if is_training and add_l2_penalty:
         loss = apply_l2_penalty(loss, weight_decay)
 
     # Return the mean loss (over pixels *and* batches)
     if return_mean_loss:
-        if mask_voids and len(cfg.void_labels):
-            return tf.reduce_sum(loss) / tf.reduce_sum(mask)
+        if mask is not None:
+            # A tower can be only padding
+            return tf.reduce_sum(loss) / tf.maximum(tf.reduce_sum(mask), 1.)
         else:
             return tf.reduce_mean(loss)
     else:
         return loss
 
 
-def apply_l2_penalty(loss, weight_decay):
+def _loss_mask(labels, pixel_mask=None, mask_voids=True):
+    '''Return the mask of the pixels `apply_loss` averages on, or None'''
+    cfg = gflags.cfg
+    mask = None
+    if mask_voids and len(cfg.void_labels):
+        mask = tf.cast(tf.not_equal(labels, cfg.void_labels), 'float32')
+    if pixel_mask is not None:
+        pixel_mask = tf.cast(pixel_mask, 'float32')
+        mask = pixel_mask if mask is None else mask * pixel_mask
+    return mask
+
+
+def l2_penalty_scale(labels, pixel_mask=None, mask_voids=True):
+    '''Return the factor of the L2 penalty in the mean loss of `apply_loss`
+
+    The penalty is added to the loss of every pixel, the masked ones (e.g.,
+    void) included, before the loss is averaged over the pixels that are
+    not masked: in the mean loss it is scaled by the number of pixels over
+    the number of pixels that are not masked.
+    '''
+    mask = _loss_mask(labels, pixel_mask, mask_voids)
+    if mask is None:
+        return tf.constant(1.)
+    return (tf.cast(tf.size(mask), mask.dtype) /
+            tf.maximum(tf.reduce_sum(mask), 1.))
+
+
+def _decayed(variable):
+    '''Whether the L2 penalty applies to `variable`'''
+    return 'bias' not in variable.name
+
+
+def l2_penalty():
+    '''Return the L2 penalty of the trainable variables but the biases'''
     with tf.variable_scope('L2_regularization'):
-        trainable_variables = tf.trainable_variables()
-        l2_penalty = tf.add_n([tf.nn.l2_loss(v) for v in trainable_variables
-                               if 'bias' not in v.name])
-        loss += l2_penalty * weight_decay
+        return tf.add_n([tf.nn.l2_loss(v) for v in tf.trainable_variables()
+                         if _decayed(v)])
+
+
+def apply_l2_penalty(loss, weight_decay):
+    return loss + l2_penalty() * weight_decay
+
 
-    return loss
+def add_weight_decay(grads_and_vars, weight_decay):
+    '''Add the gradient of the L2 penalty to the gradients
+
+    The gradient of `weight_decay * l2_penalty()` w.r.t. each variable is
+    `weight_decay * variable`: adding it to the (averaged) gradients is the
+    same as adding the penalty to the loss of every tower, without
+    computing the penalty and its gradient once per tower.
+    '''
+    trainable = set(tf.trainable_variables())
+    ret = []
+    with tf.name_scope('weight_decay'):
+        for grad, var in grads_and_vars:
+            if var in trainable and _decayed(var):
+                decay = weight_decay * tf.convert_to_tensor(var)
+                grad = decay if grad is None else (
+                    tf.convert_to_tensor(grad) + decay)
+            ret.append((grad, var))
+    return ret
 
 
 def process_gradients(gradients,
@@ -138,7 +233,7 @@ def process_gradients(gradients,
     return gradients
 
 
-def average_gradients(tower_grads):
+def average_gradients(tower_grads, tower_groups=None, bucket_size_mb=0):
     """Calculate the average gradient for each shared variable across all towers.
 
     Note that this function provides a synchronization point across all towers.
@@ -147,38 +242,182 @@ def average_gradients(tower_grads):
     tower_grads: List of lists of (gradient, variable) tuples. The outer list
       is over individual gradients. The inner list is over the gradient
       calculation for each tower.
+    tower_groups: Optional list of (device, tower indices) pairs, e.g., the
+      towers of each NUMA node (see `cpu_layout.cpu_tower_groups`). The
+      gradients of each group are first averaged on the device of the group,
+      so that only one gradient per group crosses the groups.
+    bucket_size_mb: If nonzero, the dense gradients are packed (per dtype)
+      in flat buckets of at most this size and each bucket is averaged at
+      once, rather than each gradient on its own. The result is the same,
+      with much fewer ops.
     Returns:
      List of pairs of (gradient, variable) where the gradient has been averaged
-     across all towers.
+     across all towers. The sparse gradients (`tf.IndexedSlices`) are
+     averaged without densifying them, the missing (None) gradients count
+     as zero.
     """
+    if tower_groups:
+        ntowers = float(len(tower_grads))
+        group_grads = []
+        for device, towers in tower_groups:
+            with tf.device(device):
+                # Weight each group by its number of towers
+                weight = len(towers) * len(tower_groups) / ntowers
+                group_grads.append([
+                    (_scale_gradient(g, weight), v)
+                    for g, v in average_gradients(
+                        [tower_grads[t] for t in towers],
+                        bucket_size_mb=bucket_size_mb)])
+        return average_gradients(group_grads, bucket_size_mb=bucket_size_mb)
+
+    if len(tower_grads) == 1:
+        # Nothing to average
+        return list(tower_grads[0])
+
+    ntowers = len(tower_grads)
     average_grads = []
+    dense = []
     for grad_and_vars in zip(*tower_grads):
         # Note that each grad_and_vars looks like the following:
         #   ((grad0_gpu0, var0_gpu0), ... , (grad0_gpuN, var0_gpuN))
-        # TODO no need for the loop here
-        # grad.append(mean(grad_gpu[0..N]), var_gpu0)
-        grads = []
-        for g, _ in grad_and_vars:
-            # Add 0 dimension to the gradients to represent the tower.
-            expanded_g = tf.expand_dims(g, 0)
-
-            # Append on a 'tower' dimension which we will average over below.
-            grads.append(expanded_g)
-
-        # Average over the 'tower' dimension.
-        grad = tf.concat(axis=0, values=grads)
-        grad = tf.reduce_mean(grad, 0)
-
         # Keep in mind that the Variables are redundant because they are shared
         # across towers. So .. we will just return the first tower's pointer to
         # the Variable.
         v = grad_and_vars[0][1]
-        grad_and_var = (grad, v)
-        average_grads.append(grad_and_var)
+        grads = [g for g, _ in grad_and_vars if g is not None]
+        if not grads:
+            average_grads.append((None, v))
+        elif all(isinstance(g, tf.IndexedSlices) for g in grads):
+            average_grads.append((_average_sparse(grads, ntowers), v))
+        else:
+            # Densify the sparse gradients mixed with dense ones and
+            # replace the missing gradients with zeros
+            grads = [tf.convert_to_tensor(g) if g is not None else None
+                     for g, _ in grad_and_vars]
+            grads = [g if g is not None else tf.zeros_like(v) for g in grads]
+            dense.append((len(average_grads), grads))
+            average_grads.append((None, v))
+
+    if bucket_size_mb:
+        buckets = _gradient_buckets(dense, bucket_size_mb * 1024 ** 2)
+    else:
+        buckets = [[entry] for entry in dense]
+    for bucket in buckets:
+        for idx, grad in zip([idx for idx, _ in bucket],
+                             _average_dense(bucket, ntowers)):
+            average_grads[idx] = (grad, average_grads[idx][1])
 
     return average_grads
 
 
+def accumulate_gradients(grads_and_vars):
+    """Accumulate the gradients over several steps
+
+    Creates an accumulator (a local variable) for each gradient and a
+    counter of the accumulated steps.
+
+    Returns:
+     The op that adds the gradients to the accumulators, the list of pairs
+     of (mean accumulated gradient, variable) and the list of the
+     accumulators. The mean gradients depend on the accumulation op, so
+     that evaluating them accumulates the gradients of the current step too.
+     The accumulators have to be reset (e.g., after applying the gradients)
+     by the caller.
+    """
+    accumulators = []
+    updates = []
+    with tf.variable_scope('gradient_accumulation'):
+        count = tf.Variable(0., trainable=False, name='count',
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        accumulators.append(count)
+        updates.append(tf.assign_add(count, 1.))
+        for i, (g, v) in enumerate(grads_and_vars):
+            if g is None:
+                continue
+            with tf.colocate_with(v):
+                acc = tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                  trainable=False, name='acc_%d' % i,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            accumulators.append(acc)
+            if isinstance(g, tf.IndexedSlices):
+                updates.append(tf.scatter_add(acc, g.indices, g.values))
+            else:
+                updates.append(tf.assign_add(acc, g))
+        accum_op = tf.group(*updates)
+
+        mean_grads_and_vars = []
+        with tf.control_dependencies([accum_op]):
+            # read_value() creates the reads inside the control
+            # dependencies: the cached snapshots of the variables could be
+            # read before the accumulation
+            count_value = tf.maximum(count.read_value(), 1.)
+            accs = iter(accumulators[1:])
+            for g, v in grads_and_vars:
+                if g is not None:
+                    g = next(accs).read_value() / count_value
+                mean_grads_and_vars.append((g, v))
+    return accum_op, mean_grads_and_vars, accumulators
+
+
+def _scale_gradient(grad, scale):
+    if grad is None:
+        return None
+    if isinstance(grad, tf.IndexedSlices):
+        return tf.IndexedSlices(grad.values * scale, grad.indices,
+                                grad.dense_shape)
+    return grad * scale
+
+
+def _average_sparse(grads, ntowers):
+    """Average sparse gradients by concatenating their slices"""
+    values = tf.concat([g.values for g in grads], axis=0)
+    indices = tf.concat([g.indices for g in grads], axis=0)
+    return tf.IndexedSlices(values / ntowers, indices, grads[0].dense_shape)
+
+
+def _gradient_buckets(dense, max_bytes):
+    """Pack the dense gradients in buckets of the same dtype and bounded size
+
+    The gradients of unknown size are put in a bucket on their own.
+    """
+    buckets = []
+    open_buckets = {}  # dtype -> (bucket, size in bytes)
+    for idx, grads in dense:
+        dtype = grads[0].dtype.base_dtype
+        nelems = grads[0].get_shape().num_elements()
+        if nelems is None:
+            buckets.append([(idx, grads)])
+            continue
+        nbytes = nelems * dtype.size
+        bucket, size = open_buckets.get(dtype, (None, 0))
+        if bucket is None or size + nbytes > max_bytes:
+            bucket, size = [], 0
+            buckets.append(bucket)
+        bucket.append((idx, grads))
+        open_buckets[dtype] = (bucket, size + nbytes)
+    return buckets
+
+
+def _average_dense(bucket, ntowers):
+    """Average the dense gradients of a bucket over the towers"""
+    if len(bucket) == 1:
+        grads = bucket[0][1]
+        # Add 0 dimension to the gradients to represent the tower, then
+        # average over it.
+        grad = tf.concat(axis=0, values=[tf.expand_dims(g, 0) for g in grads])
+        return [tf.reduce_mean(grad, 0)]
+
+    # Average the flattened gradients of the bucket at once
+    flat = []
+    for tower in range(ntowers):
+        flat.append(tf.concat([tf.reshape(grads[tower], [-1])
+                               for _, grads in bucket], axis=0))
+    avg = tf.reduce_mean(tf.stack(flat), 0)
+    sizes = [grads[0].get_shape().num_elements() for _, grads in bucket]
+    return [tf.reshape(g, grads[0].get_shape())
+            for g, (_, grads) in zip(tf.split(avg, sizes), bucket)]
+
+
 def save_repos_hash(params_dict, this_repo_name, packages=['theano']):
     # Repository hash and diff
     params_dict[this_repo_name + '_hash'] = check_output('git rev-parse HEAD',
@@ -217,6 +456,19 @@ def fig2array(fig):
     return buf
 
 
+class DatasetWrapperType(type):
+    '''Metaclass of the classes that wrap a `dataset_loaders` Dataset
+
+    The class attributes that are not defined in the wrapper (e.g.,
+    `data_shape`, `non_void_nclasses`, `void_labels`, ...) are looked up in
+    the wrapped class, stored in the `Dataset` class attribute.
+    '''
+    def __getattr__(cls, name):
+        if name.startswith('__') or cls.Dataset is None:
+            raise AttributeError(name)
+        return getattr(cls.Dataset, name)
+
+
 class TqdmHandler(logging.StreamHandler):
     # From https://github.com/tqdm/tqdm/issues/193#issuecomment-233212170
     def __init__(self):
@@ -225,3 +477,50 @@ class TqdmHandler(logging.StreamHandler):
     def emit(self, record):
         msg = self.format(record)
         tqdm.tqdm.write(msg)
+
+
+class ThrottledProgress(object):
+    '''A tqdm progress bar refreshed at most every `interval` seconds
+
+    Formatting the description and the postfix of the bar at every step is
+    a measurable share of the step time of small models: `update` only
+    calls `describe` (and refreshes the bar) when the bar is due.
+
+    Params
+    ------
+    interval:
+        The minimum number of seconds between two refreshes
+    kwargs:
+        The arguments of `tqdm.tqdm`
+    '''
+    def __init__(self, interval, **kwargs):
+        self.pbar = tqdm.tqdm(**kwargs)
+        self.interval = interval
+        self.pending = 0
+        self.last = 0
+
+    def update(self, describe):
+        '''Count one step
+
+        `describe` returns the description and the postfix dict of the bar
+        '''
+        self.pending += 1
+        now = time.time()
+        if now - self.last >= self.interval:
+            desc, postfix = describe()
+            self.pbar.set_description(desc, refresh=False)
+            self.pbar.set_postfix(postfix, refresh=False)
+            self.pbar.update(self.pending)
+            self.pending = 0
+            self.last = now
+
+    def close(self, describe=None):
+        '''Show the pending steps (and `describe`) and close the bar'''
+        if self.pending:
+            if describe is not None:
+                desc, postfix = describe()
+                self.pbar.set_description(desc, refresh=False)
+                self.pbar.set_postfix(postfix, refresh=False)
+            self.pbar.update(self.pending)
+            self.pending = 0
+        self.pbar.close()
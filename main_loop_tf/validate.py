@@ -1,3 +1,4 @@
+from copy import deepcopy
 import math
 import numpy as np
 import os
@@ -5,6 +6,8 @@ try:
     import Queue
 except ImportError:
     import queue as Queue
+import shutil
+import tempfile
 import threading
 from warnings import warn
 
@@ -12,7 +15,10 @@ import gflags
 from tqdm import tqdm
 import tensorflow as tf
 
-from utils import compute_chunk_size, fig2array
+from utils import compute_chunk_size, fig2array, pad_batch
+
+# The number of batches waiting to be saved as images
+IMG_QUEUE_SIZE = 10
 
 
 def validate(placeholders,
@@ -24,25 +30,9 @@ def validate(placeholders,
              nthreads=2):
 
     cfg = gflags.cfg
-    if getattr(cfg.valid_params, 'resize_images', False):
-        warn('Forcing resize_images to False in evaluation.')
-        cfg.valid_params.update({'resize_images': False})
-
-    cfg.valid_params['batch_size'] *= cfg.num_splits
-    this_set = cfg.Dataset(
-        which_set=which_set,
-        **cfg.valid_params)
-    save_basedir = os.path.join('samples', cfg.model_name,
-                                this_set.which_set)
-    img_queue = Queue.Queue(maxsize=10)
-    sentinel = object()  # Poison pill
-    for _ in range(nthreads):
-        t = threading.Thread(
-            target=save_images,
-            args=(img_queue, save_basedir, sentinel))
-        t.setDaemon(True)  # Die when main dies
-        t.start()
-        cfg.sv.coord.register_thread(t)
+    val_set = get_validation_set(which_set, nthreads)
+    this_set = val_set.dataset
+    img_queue = val_set.img_queue
 
     # TODO posso distinguere training da valid??
     # summary_writer = tf.summary.FileWriter(logdir=cfg.val_checkpoints_dir,
@@ -66,12 +56,11 @@ def validate(placeholders,
     # Reset Confusion Matrix at the beginning of validation
     cfg.sess.run(val_reset_cm_op)
 
-    for bidx in range(this_set.nbatches):
+    for bidx, ret in enumerate(val_set.batches()):
         if cfg.sv.should_stop():  # Stop requested
             break
         cidx = (epoch_id*this_set.nbatches) + bidx
 
-        ret = this_set.next()
         x_batch, y_batch = ret['data'], ret['labels']
         subset = ret['subset'][0]
         f_batch = ret['filenames']
@@ -91,11 +80,6 @@ def validate(placeholders,
                 # reset_states(model, x_batch.shape)
             prev_subset = subset
 
-        # TODO remove duplication of code
-        # Compute the shape of the input chunk for each GPU
-        split_dim, lab_split_dim = compute_chunk_size(
-            x_batch.shape[0], np.prod(this_set.data_shape[:2]))
-
         if cfg.seq_length and cfg.seq_length > 1:
             x_in = x_batch
             y_in = y_batch[:, cfg.seq_length // 2, ...]  # 4D: not one-hot
@@ -105,9 +89,20 @@ def validate(placeholders,
 
         # if cfg.use_second_path:
         #     x_in = [x_in[..., :3], x_in[..., 3:]]
-        y_in = y_in.flatten()
-        in_values = [x_in, y_in, split_dim, lab_split_dim]
+        x_in = np.asarray(x_in, dtype=cfg.input_dtype)
+        y_in = y_in.astype(cfg.label_dtype)
+        if cfg.static_tower_split:
+            x_in, y_in, sample_mask = pad_batch(
+                x_in, y_in, cfg.val_batch_size * cfg.num_splits)
+            in_values = [x_in, y_in.ravel(), sample_mask]
+        else:
+            # TODO remove duplication of code
+            # Compute the shape of the input chunk for each GPU
+            split_dim, lab_split_dim = compute_chunk_size(
+                x_batch.shape[0], np.prod(this_set.data_shape[:2]))
+            in_values = [x_in, y_in.ravel(), split_dim, lab_split_dim]
         feed_dict = {p: v for (p, v) in zip(placeholders, in_values)}
+        feed_dict.update(getattr(cfg, 'val_feed_dict', {}))
 
         if this_set.set_has_GT:
             # Class balance
@@ -150,6 +145,9 @@ def validate(placeholders,
             mIoU = 0
             summary_str = cfg.sess.run(val_summary_op, feed_dict=feed_dict)
             cfg.sv.summary_computed(cfg.sess, summary_str, global_step=cidx)
+        # Drop the predictions of the padding
+        y_pred_batch = y_pred_batch[:len(x_batch)]
+        y_soft_batch = y_soft_batch[:len(x_batch)]
         pbar.update(1)
         # TODO there is no guarantee that this will be processed
         # in order. We could use condition variables, e.g.,
@@ -160,10 +158,6 @@ def validate(placeholders,
                        raw_data_batch, y_pred_batch, y_soft_batch))
     pbar.close()
 
-    # Kill the threads
-    for _ in range(nthreads):
-        img_queue.put(sentinel)
-
     # Write the summaries
     class_labels = this_set.mask_labels[:this_set.non_void_nclasses]
     if cfg.summary_per_subset:
@@ -180,10 +174,169 @@ def validate(placeholders,
         write_IoUs_summaries({'global_mean': mIoU}, step=cidx)
 
     img_queue.join()  # Wait for the threads to be done
-    this_set.finish()  # Close the dataset
     return mIoU
 
 
+def get_validation_set(which_set, nthreads=2):
+    '''Return the validation set `which_set`
+
+    The validation sets are created the first time they are requested and
+    kept alive (with their image saving threads) until
+    `finish_validation` is called.
+    '''
+    cfg = gflags.cfg
+    if not hasattr(cfg, 'val_sets'):
+        cfg.val_sets = {}
+    if which_set not in cfg.val_sets:
+        cfg.val_sets[which_set] = ValidationSet(which_set, nthreads)
+    return cfg.val_sets[which_set]
+
+
+def finish_validation():
+    '''Close the validation sets and stop their threads'''
+    cfg = gflags.cfg
+    for val_set in getattr(cfg, 'val_sets', {}).values():
+        val_set.finish()
+    cfg.val_sets = {}
+
+
+class ValidationSet(object):
+    '''A validation Dataset that is reused across epochs
+
+    Holds the Dataset of a validation split, the threads that save the
+    images of its predictions and, if `val_cache_mb` or
+    `val_cache_spill_dir` are set, a cache of its decoded batches. Since
+    the validation batches are deterministic, after the first epoch the
+    batches are served by the cache without loading them again.
+    '''
+    def __init__(self, which_set, nthreads=2):
+        cfg = gflags.cfg
+        params = deepcopy(cfg.valid_params)
+        if params.get('resize_images', False):
+            warn('Forcing resize_images to False in evaluation.')
+            params['resize_images'] = False
+        params['batch_size'] *= cfg.num_splits
+        self.dataset = cfg.Dataset(which_set=which_set, **params)
+        self.nbatches = self.dataset.nbatches
+        self._consumed = 0
+
+        self.cache = None
+        if params.get('shuffle_at_each_epoch'):
+            if cfg.val_cache_mb or cfg.val_cache_spill_dir:
+                warn('The validation batches change at each epoch, they '
+                     'will not be cached.')
+        elif cfg.val_cache_mb or cfg.val_cache_spill_dir:
+            self.cache = BatchCache(self.nbatches,
+                                    cfg.val_cache_mb * 1024 ** 2,
+                                    cfg.val_cache_spill_dir)
+
+        save_basedir = os.path.join('samples', cfg.model_name,
+                                    self.dataset.which_set)
+        self.img_queue = Queue.Queue(maxsize=IMG_QUEUE_SIZE)
+        self.sentinel = object()  # Poison pill
+        self.threads = []
+        for _ in range(nthreads):
+            t = threading.Thread(
+                target=save_images,
+                args=(self.img_queue, save_basedir, self.sentinel))
+            t.setDaemon(True)  # Die when main dies
+            t.start()
+            cfg.sv.coord.register_thread(t)
+            self.threads.append(t)
+
+    def batches(self):
+        '''Iterate over the batches of one epoch'''
+        if self.cache is not None and self.cache.complete:
+            for bidx in range(self.nbatches):
+                yield self.cache.get(bidx)
+            return
+
+        # Rewind the dataset if the previous epoch was interrupted
+        if self._consumed % self.nbatches:
+            self.dataset.reset(self.dataset.shuffle_at_each_epoch)
+            self._consumed = 0
+        for bidx in range(self.nbatches):
+            ret = self.dataset.next()
+            self._consumed += 1
+            if self.cache is not None:
+                self.cache.put(bidx, ret)
+            yield ret
+
+    def finish(self):
+        for _ in self.threads:
+            self.img_queue.put(self.sentinel)
+        for t in self.threads:
+            t.join()
+        self.dataset.finish()  # Close the dataset
+        if self.cache is not None:
+            self.cache.close()
+
+
+class BatchCache(object):
+    '''Cache the batches of a deterministic dataset
+
+    Keeps up to `max_bytes` of batches in memory and, if `spill_dir` is
+    provided, writes the others in files in `spill_dir` and
+    memory-maps them.
+    '''
+    def __init__(self, nbatches, max_bytes, spill_dir=None):
+        self.nbatches = nbatches
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.spill_dir = None
+        if spill_dir:
+            if not os.path.exists(spill_dir):
+                os.makedirs(spill_dir)
+            self.spill_dir = tempfile.mkdtemp(prefix='val_cache_',
+                                              dir=spill_dir)
+        self.batches = {}
+        # True once the batches overflow max_bytes without a spill_dir
+        self.disabled = False
+
+    @property
+    def complete(self):
+        return len(self.batches) == self.nbatches
+
+    def put(self, bidx, batch):
+        if self.disabled or bidx in self.batches:
+            return
+        size = sum(v.nbytes for v in batch.values()
+                   if isinstance(v, np.ndarray))
+        if self.nbytes + size <= self.max_bytes:
+            self.batches[bidx] = batch
+            self.nbytes += size
+        elif self.spill_dir is not None:
+            self.batches[bidx] = self._spill(bidx, batch)
+        else:
+            tf.logging.warning('The validation batches do not fit in '
+                               'val_cache_mb, they will be loaded at each '
+                               'epoch. Consider setting val_cache_spill_dir')
+            # A partial cache is never used, release its memory
+            self.batches.clear()
+            self.nbytes = 0
+            self.disabled = True
+
+    def get(self, bidx):
+        return self.batches[bidx]
+
+    def _spill(self, bidx, batch):
+        ret = {}
+        for k, v in batch.items():
+            if isinstance(v, np.ndarray) and not v.dtype.hasobject:
+                path = os.path.join(self.spill_dir, '{}_{}.npy'.format(bidx,
+                                                                       k))
+                np.save(path, v)
+                ret[k] = np.load(path, mmap_mode='r')
+            else:
+                ret[k] = v
+        return ret
+
+    def close(self):
+        self.batches = {}
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
 def write_IoUs_summaries(IoUs, step=None, class_labels=[]):
     cfg = gflags.cfg
 
@@ -212,7 +365,7 @@ def save_images(img_queue, save_basedir, sentinel):
             tf.logging.debug('Save images thread stopping for sv.should_stop')
             break
         try:
-            img = img_queue.get(False)
+            img = img_queue.get(True, 0.5)
             if img == sentinel:  # Validation is over, die
                 tf.logging.debug('Save images thread stopping for sentinel')
                 img_queue.task_done()